@@ -1,3 +1,6 @@
+import os
+import sys
+import argparse
 import pandas as pd
 import numpy as np
 
@@ -8,6 +11,15 @@ from sklearn.model_selection import GridSearchCV
 
 import coremltools as ct
 
+# Stage profiling shared with the blm-recorder-trainer CLIs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "blm-recorder-trainer"))
+from profiling import timed, ProfileSession, add_profiling_args
+
+parser = argparse.ArgumentParser()
+add_profiling_args(parser)
+args = parser.parse_args()
+profile_session = ProfileSession.from_args("train_trajectory_models", args).start()
+
 #######################################
 # 1. Define a parser for cells with R/L
 #######################################
@@ -44,12 +56,13 @@ def parse_rl(value):
 #######################################
 # 2. Load and parse the CSV
 #######################################
-df = pd.read_csv("trajectory-data.csv")
+with timed("load_csv"):
+    df = pd.read_csv("trajectory-data.csv")
 
-# Apply parse_rl to every column you care about.
-# If you know exactly which columns may contain R/L, you can limit to those.
-for col in df.columns:
-    df[col] = df[col].apply(parse_rl)
+    # Apply parse_rl to every column you care about.
+    # If you know exactly which columns may contain R/L, you can limit to those.
+    for col in df.columns:
+        df[col] = df[col].apply(parse_rl)
 
 #######################################
 # 3. Add two new columns:
@@ -150,7 +163,8 @@ for model_name, target_col in targets.items():
         n_jobs=-1,
         verbose=1
     )
-    grid_search.fit(X_train, y_train)
+    with timed("grid_search", model=model_name):
+        grid_search.fit(X_train, y_train)
     
     # Print the best params
     print(f"\n=== Best params for {model_name} ===")
@@ -172,13 +186,30 @@ for model_name, target_col in targets.items():
 #######################################
 for model_name, pipeline in best_pipelines.items():
     # You can name the output feature same as model_name or something else
-    coreml_model = ct.converters.sklearn.convert(
-        pipeline,
-        input_features=feature_cols,
-        output_feature_names=model_name
-    )
-    
-    # Save as e.g. "GolfTrajectoryModel_roll_yd.mlmodel", etc.
-    mlmodel_filename = f"trajectory_model_{model_name}.mlmodel"
-    coreml_model.save(mlmodel_filename)
+    with timed("export", model=model_name):
+        coreml_model = ct.converters.sklearn.convert(
+            pipeline,
+            input_features=feature_cols,
+            output_feature_names=model_name
+        )
+
+        # Save as e.g. "GolfTrajectoryModel_roll_yd.mlmodel", etc.
+        mlmodel_filename = f"trajectory_model_{model_name}.mlmodel"
+        coreml_model.save(mlmodel_filename)
     print(f"Saved {mlmodel_filename}")
+
+
+#######################################
+# 6. Report the model sizes
+#######################################
+# coremltools' weight compression (float16, int8, palettization) only applies to neural
+# networks / ML programs, not to tree ensembles: these models are as big as their number
+# of nodes, so n_estimators, max_depth and min_samples_leaf are what makes them smaller.
+for model_name, pipeline in best_pipelines.items():
+    mlmodel_filename = f"trajectory_model_{model_name}.mlmodel"
+    forest = pipeline.named_steps["regressor"]
+    num_nodes = sum(tree.tree_.node_count for tree in forest.estimators_)
+    size_kb = os.path.getsize(mlmodel_filename) / 1024
+    print(f"{mlmodel_filename}: {size_kb:.0f} KB, {len(forest.estimators_)} trees, {num_nodes} nodes")
+
+profile_session.stop()
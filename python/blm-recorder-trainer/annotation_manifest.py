@@ -0,0 +1,89 @@
+# annotation_manifest.py
+
+import os
+import json
+import hashlib
+
+# Lives next to annotations.json in a dataset/vX folder
+MANIFEST_FILENAME = "annotations-manifest.json"
+
+
+def file_sha1(path):
+    """
+    Returns the hex SHA-1 of a file's contents.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def fingerprint(path):
+    """
+    Returns the size/mtime/hash fields stored for an image in the manifest.
+    """
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha1": file_sha1(path)
+    }
+
+
+def is_unchanged(entry, path):
+    """
+    True if the image at path is still the one described by its manifest entry.
+    Only hashes the file when its size or mtime changed; if the contents turn out to be
+    the same, the entry's mtime is refreshed so the next check is cheap again.
+    """
+    if not entry or not os.path.isfile(path):
+        return False
+    stat = os.stat(path)
+    if stat.st_size == entry.get("size") and stat.st_mtime == entry.get("mtime"):
+        return True
+    if stat.st_size != entry.get("size"):
+        return False
+    if file_sha1(path) == entry.get("sha1"):
+        entry["mtime"] = stat.st_mtime
+        return True
+    return False
+
+
+def load_manifest(dataset_dir):
+    """
+    Returns { filename: entry } from the dataset's manifest, or {} if there is none.
+    Each entry holds size, mtime, sha1, model_version (the model that produced the label,
+    None if unknown) and reviewed (True once a human saved it in annotation_tool.py).
+    """
+    manifest_path = os.path.join(dataset_dir, MANIFEST_FILENAME)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            if isinstance(data, dict):
+                return data
+    return {}
+
+
+def save_manifest(dataset_dir, manifest):
+    """
+    Atomically writes the manifest next to annotations.json.
+    """
+    manifest_path = os.path.join(dataset_dir, MANIFEST_FILENAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def mark_reviewed(dataset_dir, filename):
+    """
+    Records that a human reviewed (and possibly corrected) the label of filename,
+    so incremental auto-annotation never overwrites it.
+    """
+    manifest = load_manifest(dataset_dir)
+    entry = manifest.get(filename, {"model_version": None})
+    entry.update(fingerprint(os.path.join(dataset_dir, filename)))
+    entry["reviewed"] = True
+    manifest[filename] = entry
+    save_manifest(dataset_dir, manifest)
@@ -3,6 +3,9 @@ import json
 import argparse
 from flask import Flask, render_template_string, request, redirect, url_for, send_from_directory
 
+from annotation_manifest import mark_reviewed
+from inference_server import InferenceClient
+
 app = Flask(__name__)
 
 # Define your radio options here
@@ -19,6 +22,7 @@ CLUB_SPEED_UNITS = ["MPH", "KMH", "MPS", "None"]
 annotations_data = []
 images_list = []
 images_dir = None
+inference_client = None  # set with --server to prefill unannotated images
 ANNOTATIONS_FILENAME = "annotations.json"
 
 # Language=jinja2
@@ -281,7 +285,7 @@ def show_image(index):
     # Find existing annotation or create default
     annotation = next((item for item in annotations_data if item["filename"] == current_image), None)
     if not annotation:
-        annotation = {"filename": current_image, "screen": SCREEN_OPTIONS[0]}
+        annotation = predict_annotation(current_image) or {"filename": current_image, "screen": SCREEN_OPTIONS[0]}
         annotations_data.append(annotation)
 
     # --- NEW: Load any .json that matches the .png basename ---
@@ -352,6 +356,9 @@ def save_and_go(index):
 
     write_annotations_file()
 
+    # Protect this label from being overwritten by incremental auto-annotation
+    mark_reviewed(images_dir, filename)
+
     # Handle navigation (previous/next/stay)
     direction = request.form.get("direction", "stay")
     if direction == "next":
@@ -368,6 +375,25 @@ def save_and_go(index):
         # Stay on this image
         return redirect(url_for('show_image', index=index))
 
+def predict_annotation(filename):
+    """
+    Asks the inference server (if any) for the labels of an image that has no annotation
+    yet, so the form starts out prefilled. Returns None if there is no server or it fails.
+    """
+    if inference_client is None:
+        return None
+    from auto_annotator import KEYS, build_record  # only needed with --server
+
+    try:
+        labels = inference_client.predict_files([os.path.join(images_dir, filename)])[0]
+    except OSError as e:
+        print(f"[WARN] Inference server unavailable: {e}")
+        return None
+    if not labels:
+        return None
+    temp_record = {key: labels.get(key, {}).get("label", "None") for key in KEYS}
+    return build_record(filename, temp_record)
+
 def write_annotations_file():
     """Write the in-memory annotations_data list to annotations.json in images_dir."""
     json_path = os.path.join(images_dir, ANNOTATIONS_FILENAME)
@@ -388,8 +414,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--images_dir", type=str, required=True,
                         help="Path to directory containing .png images.")
+    parser.add_argument("--server", type=str, default=None,
+                        help="URL of a running inference_server.py (i.e. 'http://127.0.0.1:8765') used to prefill new images.")
     args = parser.parse_args()
 
+    if args.server:
+        inference_client = InferenceClient(args.server)
+
     images_dir = args.images_dir
     if not os.path.isdir(images_dir):
         print(f"Error: Directory '{images_dir}' does not exist.")
@@ -0,0 +1,303 @@
+# arch_search.py
+
+import os
+import json
+import math
+import time
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import argparse
+
+from tensorflow.keras import backend, models
+from train_classifier import KeyClassifier, measure_latency_ms
+from numpy_backend import NumpyModel
+from dataset_stage import DatasetStage
+from train_all import (
+    KEYS, DATASET_DIR, CACHE_DIR, ball_roi_json, club_roi_json, screen_roi_json,
+    load_rois_from_file, thread_budget, init_worker
+)
+
+SEARCH_DIR = "./search"
+
+# Every combination is a candidate: (width, height) of the crops, filters of the conv
+# blocks and width of the hidden dense layer. (64, 32) / (32, 64) / 128 is train_all's model.
+SEARCH_SPACE = dict(
+    image_size=[(64, 32), (48, 24), (32, 16)],
+    filters=[(8, 16), (16, 32), (32, 64)],
+    dense_units=[32, 64, 128]
+)
+
+# Search runs use fewer augmented copies per image than the final training
+SEARCH_AUG_PER_SAMPLE = 20
+
+
+class TrialKeyClassifier(KeyClassifier):
+    """
+    KeyClassifier that always holds out whole base images, so trials are compared on
+    images none of their training samples were augmented from.
+    """
+
+    holdout_base_images = True
+
+
+def config_name(config):
+    width, height = config["image_size"]
+    return f"{width}x{height}-f{'-'.join(str(f) for f in config['filters'])}-d{config['dense_units']}"
+
+
+def classifier_cost(image_size, channels, filters, dense_units, num_classes):
+    """
+    Analytic (FLOPs, parameters) of one forward pass of KeyClassifier.build_model's CNN,
+    counting a multiply-add as 2 FLOPs.
+    """
+    height, width = image_size[1], image_size[0]
+    flops = 0
+    params = 0
+    in_channels = channels
+    for num_filters in filters:
+        height, width = height - 2, width - 2  # 3x3 'valid' conv
+        flops += 2 * 9 * in_channels * num_filters * height * width
+        params += 9 * in_channels * num_filters + num_filters
+        height, width = height // 2, width // 2  # 2x2 max pooling
+        in_channels = num_filters
+    features = height * width * in_channels
+    flops += 2 * features * dense_units + 2 * dense_units * num_classes
+    params += features * dense_units + dense_units + dense_units * num_classes + num_classes
+    return flops, params
+
+
+def run_trial(key_name, roi, dataset_version, stage, config, epochs, aug_per_sample, seed, output_dir):
+    """
+    Trains one config from scratch for `epochs` and returns its held-out accuracy and cost.
+    Runs in a worker process.
+    """
+    start = time.perf_counter()
+    classifier = TrialKeyClassifier(
+        dataset_dir=DATASET_DIR,
+        dataset_version=dataset_version,
+        key_name=key_name,
+        roi=roi,
+        output_model_path=os.path.join(output_dir, f"{config_name(config)}-e{epochs}"),
+        image_size=tuple(config["image_size"]),
+        aug_per_sample=aug_per_sample,
+        dataset_stage=stage,
+        seed=seed,
+        channels=stage.channels
+    )
+    classifier.gather_data()
+    classifier.build_model(filters=config["filters"], dense_units=config["dense_units"])
+    classifier.train(epochs=epochs, batch_size=32)
+
+    holdout_X = classifier.holdout_X.astype(np.float32) / 255.0
+    predictions = classifier.model.predict(holdout_X, batch_size=256, verbose=0).argmax(axis=1)
+    flops, params = classifier_cost(config["image_size"], stage.channels, config["filters"],
+                                    config["dense_units"], len(classifier.class_labels))
+    backend.clear_session()
+
+    return {
+        "name": config_name(config),
+        "config": config,
+        "epochs": epochs,
+        "accuracy": float(np.mean(predictions == classifier.holdout_y)) if len(predictions) else 0.0,
+        "holdout_images": int(len(predictions)),
+        "flops": flops,
+        "params": params,
+        "seconds": time.perf_counter() - start,
+        "model_path": classifier.output_model_path + ".h5"
+    }
+
+
+def dominates(a, b):
+    """
+    True if trial a is at least as accurate and as cheap as b, and better in one of them.
+    """
+    return (
+        a["accuracy"] >= b["accuracy"] and a["flops"] <= b["flops"]
+        and (a["accuracy"] > b["accuracy"] or a["flops"] < b["flops"])
+    )
+
+
+def pareto_front(results):
+    """
+    Trials no other trial dominates, cheapest first.
+    """
+    front = [r for r in results if not any(dominates(other, r) for other in results)]
+    return sorted(front, key=lambda r: r["flops"])
+
+
+def pareto_ranks(results):
+    """
+    Non-dominated sorting: rank 0 is the Pareto front, rank 1 the front without it, etc.
+    Returns one rank per result.
+    """
+    ranks = [None] * len(results)
+    remaining = list(range(len(results)))
+    rank = 0
+    while remaining:
+        front = [i for i in remaining if not any(dominates(results[j], results[i]) for j in remaining)]
+        for i in front:
+            ranks[i] = rank
+        remaining = [i for i in remaining if ranks[i] is None]
+        rank += 1
+    return ranks
+
+
+def rung_epochs(min_epochs, max_epochs, eta):
+    """
+    Epoch budget of each successive-halving rung, e.g. 1, 3, 9 for (1, 9, 3) or 1, 3, 10 for (1, 10, 3).
+    """
+    epochs = [max_epochs]
+    while epochs[0] // eta >= min_epochs:
+        epochs.insert(0, epochs[0] // eta)
+    return epochs
+
+
+def search_key(executor, key_name, roi, dataset_version, stages, configs, min_epochs, max_epochs, eta,
+               aug_per_sample, seed, output_dir):
+    """
+    Successive halving for one key: every config gets min_epochs, then only the best
+    1/eta of each rung is retrained with eta times the epochs, up to max_epochs. Configs
+    are ranked by Pareto rank (accuracy vs. FLOPs) and then accuracy, so cheap configs
+    that are nearly as good survive next to the most accurate ones.
+    Returns all trials, in rung order.
+    """
+    trials = []
+    alive = list(configs)
+    epochs_per_rung = rung_epochs(min_epochs, max_epochs, eta)
+    for rung, epochs in enumerate(epochs_per_rung):
+        print(f"[INFO] '{key_name}' rung {rung + 1}/{len(epochs_per_rung)}: {len(alive)} configs x {epochs} epochs")
+        futures = [
+            executor.submit(
+                run_trial, key_name, roi, dataset_version, stages[tuple(config["image_size"])].subset([key_name]),
+                config, epochs, aug_per_sample, seed, output_dir
+            )
+            for config in alive
+        ]
+        results = [future.result() for future in futures]
+        for result in results:
+            result["rung"] = rung
+            print(f"[INFO] '{key_name}' {result['name']} @ {epochs} epochs: "
+                  f"accuracy {result['accuracy']:.4f}, {result['flops'] / 1e6:.2f} MFLOPs")
+        trials.extend(results)
+
+        if rung == len(epochs_per_rung) - 1:
+            return trials
+        ranks = pareto_ranks(results)
+        order = sorted(range(len(results)), key=lambda i: (ranks[i], -results[i]["accuracy"], results[i]["flops"]))
+        alive = [results[i]["config"] for i in order[:max(1, math.ceil(len(results) / eta))]]
+
+
+def highest_rung_trials(trials):
+    """
+    The trial of every config at the highest rung it reached. A config dropped early is
+    only compared with its shorter training, which its "epochs" tag makes visible.
+    """
+    latest = {}
+    for trial in trials:
+        if trial["name"] not in latest or trial["rung"] > latest[trial["name"]]["rung"]:
+            latest[trial["name"]] = trial
+    return list(latest.values())
+
+
+def add_latency(results, runs=100):
+    """
+    Measures batch-1 CPU latency (TensorFlow and NumPy backend) of trained trials, one at
+    a time in this process so the measurements don't compete with training workers.
+    """
+    for result in results:
+        model = models.load_model(result["model_path"])
+        numpy_model = NumpyModel.load(result["model_path"])
+        width, height = result["config"]["image_size"]
+        x = np.zeros((1, height, width, model.input_shape[-1]), dtype=np.float32)
+        result["keras_latency_ms"] = measure_latency_ms(lambda batch: model(batch, training=False), x, runs)
+        result["numpy_latency_ms"] = measure_latency_ms(numpy_model, x, runs)
+        backend.clear_session()
+
+
+def main(dataset_version, keys=None, jobs=1, min_epochs=1, max_epochs=9, eta=3, aug_per_sample=SEARCH_AUG_PER_SAMPLE,
+         channels=3, cache_dir=CACHE_DIR, seed=0):
+    all_rois = {
+        **load_rois_from_file(ball_roi_json),
+        **load_rois_from_file(club_roi_json),
+        **load_rois_from_file(screen_roi_json)
+    }
+    keys = sorted(keys or KEYS)
+    key_rois = {key_name: all_rois.get(key_name) for key_name in keys}
+    configs = [
+        {"image_size": list(image_size), "filters": list(filters), "dense_units": dense_units}
+        for image_size, filters, dense_units in itertools.product(
+            SEARCH_SPACE["image_size"], SEARCH_SPACE["filters"], SEARCH_SPACE["dense_units"]
+        )
+    ]
+
+    # Each image is decoded once per crop size, for every searched key
+    stages = {
+        image_size: DatasetStage(
+            dataset_dir=DATASET_DIR,
+            dataset_version=dataset_version,
+            rois=key_rois,
+            image_size=image_size,
+            cache_dir=cache_dir,
+            channels=channels
+        ).load()
+        for image_size in SEARCH_SPACE["image_size"]
+    }
+
+    intra_op_threads, inter_op_threads = thread_budget(jobs)
+    print(f"[INFO] Searching {len(configs)} configs for {len(keys)} keys with {jobs} workers, "
+          f"epochs {rung_epochs(min_epochs, max_epochs, eta)}")
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(intra_op_threads, inter_op_threads)
+    ) as executor:
+        for key_name in keys:
+            output_dir = os.path.join(SEARCH_DIR, dataset_version, key_name)
+            trials = search_key(
+                executor, key_name, key_rois[key_name], dataset_version, stages, configs,
+                min_epochs, max_epochs, eta, aug_per_sample, seed, output_dir
+            )
+            # Cheap configs that lost out at an early rung can still be on the front, with
+            # fewer epochs of training than the survivors
+            front = pareto_front(highest_rung_trials(trials))
+            add_latency(front)
+
+            result_path = os.path.join(SEARCH_DIR, dataset_version, f"{key_name}.pareto.json")
+            with open(result_path, "w", encoding="utf-8") as f:
+                json.dump({"key_name": key_name, "pareto": front, "trials": trials}, f, indent=2)
+
+            print(f"[INFO] '{key_name}' Pareto front ({result_path}):")
+            print(f"  {'config':<26} {'epochs':>6} {'accuracy':>9} {'MFLOPs':>8} {'params':>9} {'numpy ms':>9}")
+            for result in front:
+                print(f"  {result['name']:<26} {result['epochs']:>6} {result['accuracy']:>9.4f} {result['flops'] / 1e6:>8.2f} "
+                      f"{result['params']:>9} {result['numpy_latency_ms']['p50']:>9.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", type=str, required=True, help="Dataset version to search on (i.e. 'v1').")
+    parser.add_argument("--keys", type=str, nargs="+", default=None, help="Keys to search (default: all).")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of trials to train in parallel worker processes.")
+    parser.add_argument("--min-epochs", type=int, default=1, help="Epochs of the first (widest) rung.")
+    parser.add_argument("--max-epochs", type=int, default=9, help="Epochs of the last rung.")
+    parser.add_argument("--eta", type=int, default=3, help="Keep 1/eta of the configs per rung, with eta times the epochs.")
+    parser.add_argument("--aug-per-sample", type=int, default=SEARCH_AUG_PER_SAMPLE,
+                        help="Augmented copies per image during the search.")
+    parser.add_argument("--channels", type=int, choices=(1, 3), default=3, help="Input channels of the searched models.")
+    parser.add_argument("--cache-dir", type=str, default=CACHE_DIR, help="Folder for the preprocessed crop cache.")
+    args = parser.parse_args()
+
+    main(
+        args.dataset,
+        keys=args.keys,
+        jobs=args.jobs,
+        min_epochs=args.min_epochs,
+        max_epochs=args.max_epochs,
+        eta=args.eta,
+        aug_per_sample=args.aug_per_sample,
+        channels=args.channels,
+        cache_dir=args.cache_dir
+    )
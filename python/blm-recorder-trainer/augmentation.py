@@ -0,0 +1,152 @@
+# augmentation.py
+
+import numpy as np
+import cv2
+
+# scipy.ndimage fill modes used by ImageDataGenerator -> OpenCV border modes
+BORDER_MODES = {
+    "nearest": cv2.BORDER_REPLICATE,
+    "constant": cv2.BORDER_CONSTANT,
+    "reflect": cv2.BORDER_REFLECT,
+    "wrap": cv2.BORDER_WRAP,
+}
+
+
+def affine_matrices(tx, ty, shear, zx, zy, height, width):
+    """
+    cv2.warpAffine inverse-map matrices, shape (n, 2, 3), for per-sample arrays of
+    ImageDataGenerator transform parameters (shear in degrees).
+
+    Follows apply_affine_transform of the pinned Keras 2.12: shift @ shear @ zoom is
+    centered with transform_matrix_offset_center(m, height, width) and then swapped so its
+    first axis is the column axis. As a result tx (the height shift) moves columns and ty
+    (the width shift) rows, and the center is (col, row) = (height / 2 + 0.5, width / 2 + 0.5).
+    These quirks are kept on purpose, so the augmented data matches what the models were
+    trained on with ImageDataGenerator. In that swapped frame the matrix is already in
+    OpenCV's (x, y) order.
+    """
+    n = len(tx)
+    shear = np.deg2rad(shear)
+    transform = np.zeros((n, 3, 3))
+    transform[:, 0, 0] = zx
+    transform[:, 0, 1] = -np.sin(shear) * zy
+    transform[:, 0, 2] = tx
+    transform[:, 1, 1] = np.cos(shear) * zy
+    transform[:, 1, 2] = ty
+    transform[:, 2, 2] = 1.0
+
+    o_x = height / 2 + 0.5
+    o_y = width / 2 + 0.5
+    offset = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]], dtype=np.float64)
+    reset = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]], dtype=np.float64)
+    return (offset @ transform @ reset)[:, :2, :]
+
+
+class BatchAugmenter:
+    """
+    Vectorized replacement for ImageDataGenerator.flow(batch_size=1) loops.
+
+    The random shift/shear/zoom/brightness parameters for a whole batch are drawn at once
+    with NumPy (same distributions as ImageDataGenerator.get_random_transform, different
+    random stream) and composed into one affine matrix per sample the way Keras 2.12's
+    apply_affine_transform does, axis swap included (see affine_matrices). Each sample is
+    then warped with a single cv2.warpAffine call (bilinear, like order=1) and brightness
+    is applied to the whole batch in one go. OpenCV's fixed-point bilinear sampling can
+    differ from scipy.ndimage by one gray level.
+
+    Args:
+        width_shift_range (float): Max horizontal shift as a fraction of the width.
+        height_shift_range (float): Max vertical shift as a fraction of the height.
+        brightness_range (tuple[float, float]): Range for the brightness factor, or None.
+        shear_range (float): Max shear angle in degrees (same unit as ImageDataGenerator).
+        zoom_range (float or tuple[float, float]): Zoom in [1 - z, 1 + z], or an explicit range.
+        fill_mode (str): 'nearest', 'constant', 'reflect' or 'wrap'.
+        seed (int): Seed for reproducible augmentation. None draws a fresh seed.
+    """
+
+    def __init__(
+        self,
+        width_shift_range=0.0,
+        height_shift_range=0.0,
+        brightness_range=None,
+        shear_range=0.0,
+        zoom_range=0.0,
+        fill_mode="nearest",
+        seed=None
+    ):
+        if fill_mode not in BORDER_MODES:
+            raise ValueError(f"Unsupported fill_mode '{fill_mode}', expected one of {list(BORDER_MODES)}")
+
+        self.width_shift_range = width_shift_range
+        self.height_shift_range = height_shift_range
+        self.brightness_range = brightness_range
+        self.shear_range = shear_range
+        if np.isscalar(zoom_range):
+            self.zoom_range = (1.0 - zoom_range, 1.0 + zoom_range)
+        else:
+            self.zoom_range = tuple(zoom_range)
+        self.fill_mode = fill_mode
+        self.rng = np.random.default_rng(seed)
+
+    def random_transforms(self, n, height, width):
+        """
+        Draws n random transforms for (height, width) images.
+
+        Returns:
+            matrices (np.ndarray): (n, 2, 3) inverse-map matrices for cv2.warpAffine.
+            brightness (np.ndarray): (n,) brightness factors, or None if disabled.
+        """
+        rng = self.rng
+
+        # Same parameters as ImageDataGenerator.get_random_transform: tx is the height
+        # shift (in rows), ty the width shift (in columns)
+        tx = rng.uniform(-self.height_shift_range, self.height_shift_range, n) * height
+        ty = rng.uniform(-self.width_shift_range, self.width_shift_range, n) * width
+        shear = rng.uniform(-self.shear_range, self.shear_range, n)
+        zx = rng.uniform(self.zoom_range[0], self.zoom_range[1], n)
+        zy = rng.uniform(self.zoom_range[0], self.zoom_range[1], n)
+        matrices = affine_matrices(tx, ty, shear, zx, zy, height, width)
+
+        brightness = None
+        if self.brightness_range is not None:
+            brightness = rng.uniform(self.brightness_range[0], self.brightness_range[1], n)
+        return matrices, brightness
+
+    def apply(self, images, matrices, brightness=None):
+        """
+        Warps images[i] with matrices[i] and scales it by brightness[i].
+        images is a uint8 array of shape (n, h, w) or (n, h, w, c); the result has the same shape.
+        """
+        images = np.asarray(images)
+        n, height, width = images.shape[:3]
+        border_mode = BORDER_MODES[self.fill_mode]
+        flags = cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP
+
+        out = np.empty(images.shape, dtype=np.uint8)
+        for i in range(n):
+            warped = cv2.warpAffine(images[i], matrices[i], (width, height), flags=flags, borderMode=border_mode)
+            out[i] = warped.reshape(out.shape[1:])
+
+        if brightness is not None:
+            # Same as ImageDataGenerator's brightness shift: stretch each sample to [0, 255]
+            # (array_to_img(scale=True)), then ImageEnhance.Brightness: scale, round and clip
+            flat = out.reshape(n, -1)
+            x_min = flat.min(axis=1, keepdims=True).astype(np.float32)
+            x_range = flat.max(axis=1, keepdims=True).astype(np.float32) - x_min
+            stretch = np.where(x_range > 0, 255.0 / np.maximum(x_range, 1), 1.0).astype(np.float32)
+            scaled = flat - x_min
+            scaled *= stretch * brightness.reshape(n, 1).astype(np.float32)
+            np.rint(scaled, out=scaled)
+            np.clip(scaled, 0, 255, out=scaled)
+            out = scaled.astype(np.uint8).reshape(out.shape)
+        return out
+
+    def augment(self, images, n_per_image=1):
+        """
+        Returns n_per_image augmented copies of every image, grouped per source image
+        (the copies of images[0] first, then images[1], ...), as uint8.
+        """
+        images = np.asarray(images, dtype=np.uint8)
+        repeated = np.repeat(images, n_per_image, axis=0)
+        matrices, brightness = self.random_transforms(len(repeated), images.shape[1], images.shape[2])
+        return self.apply(repeated, matrices, brightness)
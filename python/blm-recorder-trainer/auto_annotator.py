@@ -1,9 +1,20 @@
 # auto_annotator.py
 
 import os
+import io
 import json
+import time
+import textwrap
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
 from PIL import Image
-from key_inference import KeyInference  # or whatever file you keep the KeyInference class in
+from key_inference import KeyInference, MultiKeyInference, MULTI_HEAD_NAME, BACKENDS  # or whatever file you keep the KeyInference class in
+from screen_gate import ScreenGate, SCREEN_GATE_NAME
+from annotation_manifest import load_manifest, save_manifest, fingerprint, is_unchanged
+from dataset_pack import DatasetPack, load_version_annotations
+from profiling import timed, ProfileSession, add_profiling_args
 import argparse
 
 KEYS = {
@@ -16,6 +27,17 @@ KEYS = {
     "club-speed-units", # screen: club
 }
 
+BALL_KEYS = {"hla-direction", "spin-axis-direction", "ball-speed-units", "carry-units"}
+CLUB_KEYS = {"path-direction", "aoa-direction", "club-speed-units"}
+
+# Keys whose models need to run for each screen detected by the screen gate
+SCREEN_KEYS = {
+    "Ball": BALL_KEYS,
+    "Club": CLUB_KEYS,
+    "Both": BALL_KEYS | CLUB_KEYS,
+    "None": set(),
+}
+
 def get_screen_value(annotation_record):
     ball_screen = False
     club_screen = False
@@ -40,6 +62,40 @@ def get_screen_value(annotation_record):
     else:
         return "None"
 
+def load_annotations(dataset_dir, pack=None):
+    """
+    Returns the records of an existing annotations.json (or of the labels packed with the
+    folder's DatasetPack, see load_version_annotations), or [] if there are none.
+    """
+    try:
+        data, _ = load_version_annotations(dataset_dir, pack)
+    except FileNotFoundError:
+        return []
+    return data if isinstance(data, list) else []
+
+def build_record(filename, temp_record, screen=None):
+    """
+    Turns the raw per-key predictions for one image into its annotation record,
+    keeping only the keys that belong to the detected screen. If screen is None it is
+    derived from the predictions themselves.
+    """
+    if screen is None:
+        screen = get_screen_value(temp_record)
+    record = {
+        "filename": filename,
+        "screen": screen
+    }
+    if screen == "Ball" or screen == "Both":
+        record["hla-direction"] = temp_record["hla-direction"]
+        record["spin-axis-direction"] = temp_record["spin-axis-direction"]
+        record["ball-speed-units"] = temp_record["ball-speed-units"]
+        record["carry-units"] = temp_record["carry-units"]
+    if screen == "Club" or screen == "Both":
+        record["path-direction"] = temp_record["path-direction"]
+        record["aoa-direction"] = temp_record["aoa-direction"]
+        record["club-speed-units"] = temp_record["club-speed-units"]
+    return record
+
 class AutoAnnotator:
     """
     Loads KeyInference objects for each key from a given model directory,
@@ -47,19 +103,47 @@ class AutoAnnotator:
     an auto-generated annotations.json.
     """
 
-    def __init__(self, keys, model_path):
+    def __init__(self, keys, model_path, multi_head=False, gate=False, backend="keras"):
         """
         Args:
             keys (iterable[str]): The set of keys, e.g. [
               'hla-direction', 'spin-axis-direction', 'ball-speed-units', ...
             ]
             model_path (str): Path to the folder containing <key>.h5 and <key>.json sidecars.
+            multi_head (bool): Use the single multi-head model (multi-head.h5) for all keys
+              instead of one model per key.
+            gate (bool): Detect the screen first with the screen gate (screen-gate.npz) and
+              only run the key models of that screen; "None" frames run no key model at all.
+            backend (str): "keras" runs the models with TensorFlow, "numpy" with the
+              TensorFlow-free NumpyModel (per-key models only).
         """
         self.keys = keys
         self.model_path = model_path
+        self.model_version = os.path.basename(os.path.normpath(model_path))  # e.g. 'v3'
 
-        # Load one KeyInference model per key
+        # Cheap template-matching screen classifier, run before any key model
+        self.gate = None
+        if gate:
+            gate_path = os.path.join(self.model_path, f"{SCREEN_GATE_NAME}.npz")
+            if not os.path.isfile(gate_path):
+                raise FileNotFoundError(f"Missing screen gate at {gate_path}")
+            print(f"[INFO] Loading screen gate from {gate_path}")
+            self.gate = ScreenGate.load(gate_path)
+
+        # Load one KeyInference model per key, or one model for all of them
         self.classifiers = {}
+        self.multi_classifier = None
+        if multi_head:
+            if backend != "keras":
+                raise ValueError("The multi-head model only runs on the keras backend")
+            h5_model_path = os.path.join(self.model_path, f"{MULTI_HEAD_NAME}.h5")
+            print(f"[INFO] Loading multi-head model from {h5_model_path}")
+            self.multi_classifier = MultiKeyInference(h5_model_path)
+            missing = set(self.keys) - set(self.multi_classifier.keys)
+            if missing:
+                raise ValueError(f"Multi-head model at {h5_model_path} has no head for {sorted(missing)}")
+            return
+
         for key_name in self.keys:
             # We assume your trained models are named something like "hla-direction.h5"
             # with a sidecar "hla-direction.json"
@@ -68,74 +152,253 @@ class AutoAnnotator:
             if not os.path.isfile(h5_model_path):
                 raise FileNotFoundError(f"Missing model for {key_name} at {h5_model_path}")
 
-            print(f"[INFO] Loading model for key '{key_name}' from {h5_model_path}")
-            self.classifiers[key_name] = KeyInference(h5_model_path)
+            print(f"[INFO] Loading {backend} model for key '{key_name}' from {h5_model_path}")
+            self.classifiers[key_name] = KeyInference(h5_model_path, backend=backend)
+
+    def _preprocess_file(self, dataset_dir, filename, pack=None):
+        """
+        Decodes one image (or takes its frame from the dataset's pack, if it's current) and
+        returns (screen, { key: model input }), or None if the file can't be read. Without a
+        screen gate, screen is None and every key is preprocessed; with one, only the keys
+        of the detected screen are. Runs on the decode thread pool.
+        """
+        filepath = os.path.join(dataset_dir, filename)
+        try:
+            if pack is not None and pack.is_current(filename, dataset_dir):
+                img = pack.frame(filename)  # grayscale, no decode needed
+            else:
+                with timed("decode"), Image.open(filepath) as pil_image:
+                    img = cv2.cvtColor(np.array(pil_image.convert("RGB")), cv2.COLOR_RGB2BGR)
+        except OSError as e:
+            print(f"[WARN] Skipping unreadable image {filepath}: {e}")
+            return None
+
+        screen = None
+        key_names = self.keys
+        if self.gate is not None:
+            with timed("screen_gate"):
+                screen = self.gate.predict(img)
+            key_names = SCREEN_KEYS[screen]
+            if not key_names:
+                return screen, {}  # nothing to run on this frame
+
+        with timed("preprocess"):
+            if self.multi_classifier is not None:
+                return screen, self.multi_classifier.preprocess_image(img)
+            return screen, {
+                key_name: self.classifiers[key_name].preprocess_image(img)
+                for key_name in key_names if key_name in self.classifiers
+            }
+
+    def _predict_inputs(self, inputs_list):
+        """
+        Runs one batch of preprocessed images through the models, one forward pass per key
+        (or a single pass for the multi-head model). Images only contribute to the keys
+        they have inputs for. Returns a { key: label } dict per image.
+        """
+        results = [{} for _ in inputs_list]
+        if self.multi_classifier is not None:
+            rows = [i for i, inputs in enumerate(inputs_list) if inputs]
+            if rows:
+                stacked = {
+                    key_name: np.stack([inputs_list[i][key_name] for i in rows])
+                    for key_name in inputs_list[rows[0]]
+                }
+                with timed("predict", key=MULTI_HEAD_NAME):
+                    labels = self.multi_classifier.predict_arrays(stacked)
+                for j, i in enumerate(rows):
+                    results[i] = {key_name: labels[key_name][j] for key_name in labels}
+            return results
+
+        for key_name, classifier in self.classifiers.items():
+            rows = [i for i, inputs in enumerate(inputs_list) if key_name in inputs]
+            if not rows:
+                continue
+            with timed("predict", key=key_name):
+                labels, _ = classifier.predict_arrays(np.stack([inputs_list[i][key_name] for i in rows]))
+            for i, label in zip(rows, labels):
+                results[i][key_name] = label
+        return results
+
+    def _run_pipeline(self, dataset_dir, filenames, out, workers, batch_size, pack=None):
+        """
+        Annotates filenames with the pipelined decode -> batch -> predict loop, streaming
+        each finished record to the open file `out`. Returns { filename: record }.
+        """
+        max_in_flight = max(2 * batch_size, workers)
+        records = {}
+
+        start = time.perf_counter()
+        num_done = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+
+            def write_batch(batch_filenames, batch_items):
+                screens = [screen for screen, _ in batch_items]
+                temp_records = self._predict_inputs([inputs for _, inputs in batch_items])
+                for filename, screen, temp_record in zip(batch_filenames, screens, temp_records):
+                    record = build_record(filename, temp_record, screen)
+                    out.write(",\n" if records else "\n")
+                    out.write(textwrap.indent(json.dumps(record, indent=2), "  "))
+                    records[filename] = record
+                out.flush()
+
+            # Keep a bounded window of decode jobs in flight, consumed in file order
+            pending = deque()
+            image_iter = iter(filenames)
+            batch_filenames = []
+            batch_items = []
+            while True:
+                while len(pending) < max_in_flight:
+                    filename = next(image_iter, None)
+                    if filename is None:
+                        break
+                    pending.append((filename, pool.submit(self._preprocess_file, dataset_dir, filename, pack)))
+                if not pending:
+                    break
+
+                filename, future = pending.popleft()
+                item = future.result()
+                num_done += 1
+                if item is not None:
+                    batch_filenames.append(filename)
+                    batch_items.append(item)
+
+                if len(batch_items) >= batch_size or (not pending and batch_items):
+                    write_batch(batch_filenames, batch_items)
+                    batch_filenames = []
+                    batch_items = []
+                    elapsed = time.perf_counter() - start
+                    print(f"[INFO] {num_done}/{len(filenames)} images "
+                          f"({num_done / max(elapsed, 1e-9):.1f} images/sec)")
+
+        return records
+
+    def annotate_files(self, dataset_dir, filenames, workers=None, batch_size=64):
+        """
+        Runs the auto_annotate pipeline on filenames in dataset_dir and returns
+        { filename: record } without writing anything to the folder.
+        """
+        with io.StringIO() as out:
+            return self._run_pipeline(dataset_dir, filenames, out, workers or os.cpu_count() or 1, batch_size)
 
-    def auto_annotate(self, dataset_dir):
+    def auto_annotate(self, dataset_dir, workers=None, batch_size=64, incremental=False):
         """
         Iterates over images in dataset_dir, runs each classifier,
         and saves the resulting predictions to <dataset_dir>/annotations.json.
+
+        The work is pipelined: a thread pool decodes images and extracts the ROI crops
+        ahead of the models, crops are grouped into batches of batch_size images per key,
+        and finished records are streamed to annotations.json.partial until the final
+        annotations.json is written. If the folder has a DatasetPack, the packed frames of
+        unchanged images are used instead of decoding their files.
+
+        In incremental mode the existing annotations.json is merged instead of overwritten.
+        Using the manifest (see annotation_manifest.py), only images that are new, whose
+        file changed, or whose label came from a different model version are inferred.
+        Labels a human reviewed in annotation_tool.py, and labels of unknown origin
+        (annotated before the manifest existed), are kept as they are.
+
+        Args:
+            dataset_dir (str): Folder with the images to annotate.
+            workers (int): Decode threads. Defaults to the number of CPUs.
+            batch_size (int): Images per model forward pass.
+            incremental (bool): Only annotate new/changed/stale images and merge the results.
         """
         # Gather all images in dataset_dir (e.g. .png, .jpg, etc.)
         all_images = [
             f for f in os.listdir(dataset_dir)
-            if f.lower().endswith(".png") or f.lower().endswith(".jpg")
+            if (f.lower().endswith(".png") or f.lower().endswith(".jpg"))
+            and os.path.isfile(os.path.join(dataset_dir, f))
         ]
         all_images.sort()
 
-        annotations = []
-        for filename in all_images:
-            filepath = os.path.join(dataset_dir, filename)
-            if not os.path.isfile(filepath):
-                continue
-
-            # Create an annotation record for this image
+        output_path = os.path.join(dataset_dir, "annotations.json")
+        partial_path = output_path + ".partial"
+        workers = workers or os.cpu_count() or 1
 
-            # Load the image
-            temp_record = {}
-            with Image.open(filepath).convert("RGB") as pil_image:
-                # For each key, run inference
-                for key_name, classifier in self.classifiers.items():
-                    predicted_label = classifier.predict_class(pil_image)
-                    temp_record[key_name] = predicted_label
+        pack = DatasetPack.open(dataset_dir)
+        existing = {}
+        manifest = {}
+        to_annotate = all_images
+        if incremental:
+            existing = {record["filename"]: record for record in load_annotations(dataset_dir, pack)}
+            manifest = load_manifest(dataset_dir)
+            to_annotate = []
+            for filename in all_images:
+                entry = manifest.get(filename)
+                if filename not in existing:
+                    to_annotate.append(filename)  # new image
+                elif entry is None:
+                    continue  # label of unknown origin, keep it
+                elif not is_unchanged(entry, os.path.join(dataset_dir, filename)):
+                    to_annotate.append(filename)  # image changed since it was labeled
+                elif entry.get("reviewed"):
+                    continue  # human-reviewed, never overwrite
+                elif entry.get("model_version") not in (None, self.model_version):
+                    to_annotate.append(filename)  # produced by another model version
+            print(f"[INFO] Incremental: {len(to_annotate)} of {len(all_images)} images need inference")
 
-            screen = get_screen_value(temp_record)
-            record = {
-                "filename": filename,
-                "screen": screen
-            }
-            if screen == "Ball" or screen == "Both":
-                record["hla-direction"] = temp_record["hla-direction"]
-                record["spin-axis-direction"] = temp_record["spin-axis-direction"]
-                record["ball-speed-units"] = temp_record["ball-speed-units"]
-                record["carry-units"] = temp_record["carry-units"]
-            elif screen == "Club" or screen == "Both":
-                record["path-direction"] = temp_record["path-direction"]
-                record["aoa-direction"] = temp_record["aoa-direction"]
-                record["club-speed-units"] = temp_record["club-speed-units"]
+        if pack is not None:
+            print(f"[INFO] Reading unchanged images from {pack.pack_path} ({len(pack)} frames)")
 
-            annotations.append(record)
+        start = time.perf_counter()
+        with open(partial_path, "w", encoding="utf-8") as out:
+            out.write("[")
+            inferred = self._run_pipeline(dataset_dir, to_annotate, out, workers, batch_size, pack)
+            out.write("\n]" if inferred else "]")
 
+        # Merge: new predictions replace stale records, everything else is kept,
+        # including records of images that are no longer in the folder
+        merged = dict(existing)
+        merged.update(inferred)
+        annotations = [merged[filename] for filename in all_images if filename in merged]
+        annotations += [record for filename, record in existing.items() if filename not in all_images]
 
-        # Save to "annotations.json" in dataset_dir
-        output_path = os.path.join(dataset_dir, "annotations.json")
-        with open(output_path, "w", encoding="utf-8") as f:
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(annotations, f, indent=2)
+        os.replace(tmp_path, output_path)
+        os.remove(partial_path)
+
+        # Remember which model produced each new label (a full run starts a fresh manifest)
+        for filename in inferred:
+            entry = fingerprint(os.path.join(dataset_dir, filename))
+            entry["model_version"] = self.model_version
+            entry["reviewed"] = False
+            manifest[filename] = entry
+        save_manifest(dataset_dir, manifest)
 
-        print(f"[INFO] Wrote auto-generated annotations to {output_path}")
+        elapsed = time.perf_counter() - start
+        print(f"[INFO] Wrote auto-generated annotations to {output_path} "
+              f"({len(inferred)} images inferred in {elapsed:.1f}s, {len(inferred) / max(elapsed, 1e-9):.1f} images/sec)")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--model", type=str, required=True, help="Model verison to use for annotations (i.e. 'v0').")
     parser.add_argument("--dataset", type=str, required=True, help="Dataset version to annotate (i.e. 'v1').")
+    parser.add_argument("--workers", type=int, default=None, help="Threads decoding images (default: number of CPUs).")
+    parser.add_argument("--batch-size", type=int, default=64, help="Images per model forward pass.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only annotate new, changed or stale images and merge into the existing annotations.json.")
+    parser.add_argument("--gate", action="store_true",
+                        help="Detect the screen with the screen gate first and only run that screen's key models.")
+    parser.add_argument("--multi-head", action="store_true", help="Use the single multi-head model instead of one model per key.")
+    parser.add_argument("--backend", choices=BACKENDS, default="keras",
+                        help="Run the key models with TensorFlow ('keras') or with plain NumPy ('numpy').")
+    add_profiling_args(parser)
     args = parser.parse_args()
 
     model_path = os.path.join("./models/", args.model) # Version of models we will use
     dataset_path = os.path.join("./dataset/", args.dataset) # Version of dataset we will auto-nnotate
 
-    auto = AutoAnnotator(
-        keys=KEYS,
-        model_path=model_path
-    )
-    auto.auto_annotate(dataset_path)
\ No newline at end of file
+    with ProfileSession.from_args("auto_annotator", args):
+        with timed("load_models"):
+            auto = AutoAnnotator(
+                keys=KEYS,
+                model_path=model_path,
+                multi_head=args.multi_head,
+                gate=args.gate,
+                backend=args.backend
+            )
+        auto.auto_annotate(dataset_path, workers=args.workers, batch_size=args.batch_size, incremental=args.incremental)
\ No newline at end of file
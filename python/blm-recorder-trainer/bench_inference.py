@@ -0,0 +1,209 @@
+# bench_inference.py
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import numpy as np
+import cv2
+import argparse
+
+from golden_set import GOLDEN_DIR, git_commit
+from key_inference import KeyInference, BACKENDS, crop_image, normalize_crop, resize_crop
+from auto_annotator import AutoAnnotator, KEYS
+
+BENCH_DIR = "./bench"
+PHASES = ("crop", "normalize", "resize", "preprocess")
+PERCENTILES = (50, 95, 99)
+
+
+def latency_stats(seconds):
+    """
+    { "p50", "p95", "p99", "mean" } in milliseconds of a list of timings in seconds.
+    """
+    ms = np.asarray(seconds, dtype=np.float64) * 1000.0
+    stats = {f"p{p}": float(np.percentile(ms, p)) for p in PERCENTILES}
+    stats["mean"] = float(ms.mean())
+    return stats
+
+
+def import_seconds(module):
+    """
+    Seconds a fresh interpreter takes to import module, measured in a subprocess so
+    nothing this process already imported is reused.
+    """
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        print(f"[WARN] Couldn't import {module}: {result.stderr.strip().splitlines()[-1:]}")
+        return None
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def load_images(images_dir):
+    """
+    Decodes every PNG in images_dir once, as BGR arrays in file name order.
+    """
+    filenames = sorted(f for f in os.listdir(images_dir) if f.lower().endswith(".png"))
+    return filenames, [cv2.imread(os.path.join(images_dir, filename)) for filename in filenames]
+
+
+def bench_key(classifier, images, repetitions, batch_sizes):
+    """
+    Times the preprocessing phases of every image (crop, normalize, resize and the three
+    together) repetitions times, then the forward pass for each batch size, with batches
+    cycled from the preprocessed images. Returns { phase: latency stats }.
+    """
+    timings = {phase: [] for phase in PHASES}
+    inputs = []
+    for _ in range(repetitions):
+        for img in images:
+            start = time.perf_counter()
+            cropped = crop_image(img, classifier.roi)
+            cropped_at = time.perf_counter()
+            normalized = normalize_crop(cropped)
+            normalized_at = time.perf_counter()
+            arr = resize_crop(normalized, classifier.image_size, classifier.channels)
+            end = time.perf_counter()
+            timings["crop"].append(cropped_at - start)
+            timings["normalize"].append(normalized_at - cropped_at)
+            timings["resize"].append(end - normalized_at)
+            timings["preprocess"].append(end - start)
+            if len(inputs) < len(images):
+                inputs.append(arr)
+    inputs = np.stack(inputs)
+
+    result = {phase: latency_stats(samples) for phase, samples in timings.items()}
+    for batch_size in batch_sizes:
+        batch = inputs[np.arange(batch_size) % len(inputs)]
+        classifier.predict_arrays(batch, chunk_size=batch_size)  # warm-up (graph tracing, allocations)
+        samples = []
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            classifier.predict_arrays(batch, chunk_size=batch_size)
+            samples.append(time.perf_counter() - start)
+        stats = latency_stats(samples)
+        stats["per_image_ms"] = stats["p50"] / batch_size
+        result[f"predict_b{batch_size}"] = stats
+    return result
+
+
+def bench_annotator(annotator, images_dir, filenames, repetitions, batch_sizes, workers):
+    """
+    End-to-end AutoAnnotator throughput (decode, preprocess, predict) over the images,
+    repeated repetitions times, for each batch size. Nothing is written to images_dir.
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            annotator.annotate_files(images_dir, filenames, workers=workers, batch_size=batch_size)
+        seconds = time.perf_counter() - start
+        results[f"b{batch_size}"] = {
+            "images": len(filenames) * repetitions,
+            "seconds": seconds,
+            "images_per_sec": len(filenames) * repetitions / max(seconds, 1e-9)
+        }
+    return results
+
+
+def main(model_version, backend="keras", keys=None, repetitions=20, batch_sizes=(1, 8, 32), images_dir=GOLDEN_DIR,
+         workers=None, annotator=True, output=None):
+    model_dir = os.path.join("./models", model_version)
+    keys = sorted(keys or [key_name for key_name in KEYS if os.path.isfile(os.path.join(model_dir, f"{key_name}.h5"))])
+    if not keys:
+        raise FileNotFoundError(f"No key models in {model_dir}")
+    filenames, images = load_images(images_dir)
+    if not images:
+        raise FileNotFoundError(f"No PNGs in {images_dir}")
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "model": model_version,
+            "backend": backend,
+            "keys": keys,
+            "images": len(images),
+            "repetitions": repetitions,
+            "batch_sizes": list(batch_sizes)
+        },
+        "import_seconds": {"key_inference": import_seconds("key_inference")},
+        "load_seconds": {},
+        "keys": {}
+    }
+    if backend == "keras":
+        results["import_seconds"]["tensorflow"] = import_seconds("tensorflow")
+
+    # Cold loads: the first keras model also pays for importing TensorFlow
+    classifiers = {}
+    for key_name in keys:
+        start = time.perf_counter()
+        classifiers[key_name] = KeyInference(os.path.join(model_dir, f"{key_name}.h5"), backend=backend)
+        results["load_seconds"][key_name] = time.perf_counter() - start
+
+    for key_name in keys:
+        print(f"[INFO] Benchmarking '{key_name}' ({backend})")
+        results["keys"][key_name] = bench_key(classifiers[key_name], images, repetitions, batch_sizes)
+
+    if annotator and set(keys) != KEYS:
+        print("[WARN] Skipping the AutoAnnotator measurement, it needs a model for every key")
+    elif annotator:
+        print(f"[INFO] Benchmarking AutoAnnotator over {len(filenames)} images")
+        results["annotator"] = bench_annotator(
+            AutoAnnotator(keys, model_dir, backend=backend), images_dir, filenames, repetitions, batch_sizes, workers
+        )
+
+    output = output or os.path.join(BENCH_DIR, f"inference-{results['commit'] or 'unknown'}-{model_version}-{backend}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    columns = list(PHASES) + [f"predict_b{batch_size}" for batch_size in batch_sizes]
+    print(f"[INFO] Inference benchmark, p50 / p95 / p99 ms ({backend}, {model_version}):")
+    print(f"  {'key':<22} {'load (s)':>9} " + " ".join(f"{column:>20}" for column in columns))
+    for key_name, phases in sorted(results["keys"].items()):
+        cells = [f"{phases[c]['p50']:.2f}/{phases[c]['p95']:.2f}/{phases[c]['p99']:.2f}" for c in columns]
+        print(f"  {key_name:<22} {results['load_seconds'][key_name]:>9.2f} " + " ".join(f"{cell:>20}" for cell in cells))
+    print("  import " + ", ".join(
+        f"{module} {seconds:.2f}s" for module, seconds in results["import_seconds"].items() if seconds is not None
+    ))
+    for name, run in results.get("annotator", {}).items():
+        print(f"  AutoAnnotator {name}: {run['images_per_sec']:.1f} images/sec")
+    print(f"[INFO] Results saved to {output}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, required=True, help="Model version to benchmark (i.e. 'v3').")
+    parser.add_argument("--backend", choices=BACKENDS, default="keras", help="Inference backend.")
+    parser.add_argument("--keys", type=str, nargs="+", default=None, help="Keys to benchmark (default: every key model found).")
+    parser.add_argument("--repetitions", type=int, default=20, help="Passes over the images per measurement.")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32], help="Batch sizes of the forward pass.")
+    parser.add_argument("--images-dir", type=str, default=GOLDEN_DIR, help="Folder of PNGs to run on (default: the test images).")
+    parser.add_argument("--workers", type=int, default=None, help="AutoAnnotator decode threads (default: CPU count).")
+    parser.add_argument("--no-annotator", action="store_true", help="Skip the end-to-end AutoAnnotator measurement.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Results JSON (default: bench/inference-<commit>-<model>-<backend>.json).")
+    args = parser.parse_args()
+
+    main(
+        args.model,
+        backend=args.backend,
+        keys=args.keys,
+        repetitions=args.repetitions,
+        batch_sizes=args.batch_sizes,
+        images_dir=args.images_dir,
+        workers=args.workers,
+        annotator=not args.no_annotator,
+        output=args.output
+    )
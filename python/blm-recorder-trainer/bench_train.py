@@ -0,0 +1,240 @@
+# bench_train.py
+
+import os
+import sys
+import json
+import time
+import platform
+import numpy as np
+import cv2
+import argparse
+
+from golden_set import GOLDEN_DIR, load_golden_set, git_commit
+from train_classifier import KeyClassifier
+from dataset_stage import DatasetStage
+from train_all import (
+    KEYS, ball_roi_json, club_roi_json, screen_roi_json, load_rois_from_file
+)
+from profiling import peak_rss_mb, RssSampler
+from tensorflow.keras import backend
+
+BENCH_DIR = "./bench"
+STAGES = ("gather_data", "build_model", "train", "export_coreml")
+
+# Units aren't in the golden set's ground truth; any fixed label will do for timing
+SYNTHETIC_UNITS = {"ball-speed-units": "MPH", "carry-units": "YDS", "club-speed-units": "MPH"}
+
+
+def jitter(img, rng):
+    """
+    A slightly different capture of the same screen: brightness / contrast change,
+    a shift of up to 2 pixels and sensor noise.
+    """
+    alpha = rng.uniform(0.85, 1.15)
+    beta = rng.uniform(-15, 15)
+    shift = np.float32([[1, 0, rng.integers(-2, 3)], [0, 1, rng.integers(-2, 3)]])
+    out = cv2.warpAffine(img, shift, (img.shape[1], img.shape[0]), borderMode=cv2.BORDER_REPLICATE)
+    out = out.astype(np.float32) * alpha + beta + 3.0 * rng.standard_normal(out.shape, dtype=np.float32)
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+
+def make_synthetic_dataset(dataset_dir, num_images, seed=0, source_dir=GOLDEN_DIR):
+    """
+    Writes dataset_dir/v0 with num_images jittered copies of the golden set PNGs and an
+    annotations.json built from their ground truth. An existing dataset of the same size
+    is reused. Returns the seconds spent generating it.
+    """
+    version_dir = os.path.join(dataset_dir, "v0")
+    annotation_file = os.path.join(version_dir, "annotations.json")
+    if os.path.isfile(annotation_file):
+        with open(annotation_file, "r", encoding="utf-8") as f:
+            if len(json.load(f)) == num_images:
+                print(f"[INFO] Reusing synthetic dataset {version_dir}")
+                return 0.0
+
+    start = time.perf_counter()
+    os.makedirs(version_dir, exist_ok=True)
+    golden = load_golden_set(source_dir)
+    sources = [cv2.imread(os.path.join(source_dir, filename)) for filename, _ in golden]
+    rng = np.random.default_rng(seed)
+
+    annotations = []
+    for i in range(num_images):
+        source_idx = i % len(golden)
+        filename = f"synthetic-{i:06d}.png"
+        cv2.imwrite(os.path.join(version_dir, filename), jitter(sources[source_idx], rng), [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        record = dict(golden[source_idx][1], filename=filename)
+        if record["screen"] == "Ball":
+            record.update({key: SYNTHETIC_UNITS[key] for key in ("ball-speed-units", "carry-units")})
+        else:
+            record["club-speed-units"] = SYNTHETIC_UNITS["club-speed-units"]
+        annotations.append(record)
+
+    with open(annotation_file, "w", encoding="utf-8") as f:
+        json.dump(annotations, f, indent=2)
+    seconds = time.perf_counter() - start
+    print(f"[INFO] Wrote {num_images} synthetic images to {version_dir} in {seconds:.1f}s")
+    return seconds
+
+
+def bench_key(key_name, roi, stage, dataset_dir, image_size, epochs, aug_per_sample, streaming, channels, export):
+    """
+    Times each KeyClassifier stage for one key. Returns { stage: seconds, "<stage>_peak_rss_mb": MB },
+    where the peak RSS is sampled while the stage runs. Where the RSS can't be sampled (see
+    profiling.current_rss_mb), "<stage>_process_peak_rss_mb" holds the process' peak so far instead.
+    """
+    classifier = KeyClassifier(
+        dataset_dir=dataset_dir,
+        dataset_version="v0",
+        key_name=key_name,
+        roi=roi,
+        output_model_path=os.path.join(BENCH_DIR, "models"),
+        image_size=image_size,
+        aug_per_sample=aug_per_sample,
+        dataset_stage=stage,
+        seed=0,
+        streaming=streaming,
+        channels=channels
+    )
+    steps = {
+        "gather_data": classifier.gather_data,
+        "build_model": classifier.build_model,
+        "train": lambda: classifier.train(epochs=epochs, batch_size=32),
+        "export_coreml": classifier.export_coreml
+    }
+
+    result = {}
+    for name in STAGES:
+        if name == "export_coreml" and not export:
+            continue
+        with RssSampler() as rss:
+            start = time.perf_counter()
+            steps[name]()
+            result[name] = time.perf_counter() - start
+        if rss.peak_mb is not None:
+            result[f"{name}_peak_rss_mb"] = rss.peak_mb
+        else:
+            result[f"{name}_process_peak_rss_mb"] = peak_rss_mb()
+    backend.clear_session()
+    return result
+
+
+def compare(results, baseline_path):
+    """
+    Prints each stage's time against a previous results JSON.
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"[INFO] Compared to {baseline_path} (commit {baseline.get('commit')}):")
+    print(f"  {'key':<22} {'stage':<14} {'base (s)':>9} {'now (s)':>9} {'change':>8}")
+    for key_name, stages in sorted(results["keys"].items()):
+        for name in STAGES:
+            before = baseline.get("keys", {}).get(key_name, {}).get(name)
+            if name not in stages or before is None:
+                continue
+            change = 100.0 * (stages[name] / max(before, 1e-9) - 1)
+            print(f"  {key_name:<22} {name:<14} {before:>9.2f} {stages[name]:>9.2f} {change:>+7.0f}%")
+    before = baseline.get("peak_rss_mb")
+    if before:
+        print(f"  {'peak RSS (MB)':<37} {before:>9.0f} {results['peak_rss_mb']:>9.0f} "
+              f"{100.0 * (results['peak_rss_mb'] / before - 1):>+7.0f}%")
+
+
+def main(num_images=500, keys=None, epochs=1, aug_per_sample=100, streaming=False, channels=3, export=True,
+         output=None, baseline=None):
+    wall_start = time.perf_counter()
+    dataset_dir = os.path.join(BENCH_DIR, f"dataset-{num_images}")
+    generate_seconds = make_synthetic_dataset(dataset_dir, num_images)
+
+    all_rois = {
+        **load_rois_from_file(ball_roi_json),
+        **load_rois_from_file(club_roi_json),
+        **load_rois_from_file(screen_roi_json)
+    }
+    keys = sorted(keys or KEYS)
+    image_size = (64, 32)
+
+    # Decoding + cropping is shared by all keys, so it's timed once (without the crop cache)
+    start = time.perf_counter()
+    stage = DatasetStage(
+        dataset_dir=dataset_dir,
+        dataset_version="v0",
+        rois={key_name: all_rois.get(key_name) for key_name in keys},
+        image_size=image_size,
+        channels=channels
+    ).load()
+    stage_seconds = time.perf_counter() - start
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "images": num_images,
+            "keys": keys,
+            "epochs": epochs,
+            "aug_per_sample": aug_per_sample,
+            "streaming": streaming,
+            "channels": channels,
+            "image_size": list(image_size),
+            "export": export
+        },
+        "generate_seconds": generate_seconds,
+        "stage_load_seconds": stage_seconds,
+        "keys": {}
+    }
+    for key_name in keys:
+        print(f"[INFO] Benchmarking '{key_name}'")
+        results["keys"][key_name] = bench_key(
+            key_name, all_rois.get(key_name), stage, dataset_dir, image_size,
+            epochs, aug_per_sample, streaming, channels, export
+        )
+    results["total_seconds"] = time.perf_counter() - wall_start
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    output = output or os.path.join(BENCH_DIR, f"train-{results['commit'] or 'unknown'}-{num_images}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    print("[INFO] Training benchmark:")
+    print(f"  {'key':<22} " + " ".join(f"{name:>14}" for name in STAGES))
+    for key_name, stages in sorted(results["keys"].items()):
+        print(f"  {key_name:<22} " + " ".join(
+            f"{stages[name]:>14.2f}" if name in stages else f"{'-':>14}" for name in STAGES
+        ))
+    print(f"  stage load {stage_seconds:.2f}s, total {results['total_seconds']:.1f}s, peak RSS {results['peak_rss_mb']:.0f} MB")
+    print(f"[INFO] Results saved to {output}")
+
+    if baseline:
+        compare(results, baseline)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=500, help="Number of synthetic images to train on.")
+    parser.add_argument("--keys", type=str, nargs="+", default=None, help="Keys to benchmark (default: all).")
+    parser.add_argument("--epochs", type=int, default=1, help="Epochs per key.")
+    parser.add_argument("--aug-per-sample", type=int, default=100, help="Augmented copies per image.")
+    parser.add_argument("--streaming", action="store_true", help="Benchmark the streaming (on the fly augmentation) path.")
+    parser.add_argument("--channels", type=int, choices=(1, 3), default=3, help="Input channels of the models.")
+    parser.add_argument("--no-export", action="store_true", help="Skip the Core ML export stage.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Results JSON (default: bench/train-<commit>-<images>.json).")
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier results JSON to compare against.")
+    args = parser.parse_args()
+
+    main(
+        num_images=args.images,
+        keys=args.keys,
+        epochs=args.epochs,
+        aug_per_sample=args.aug_per_sample,
+        streaming=args.streaming,
+        channels=args.channels,
+        export=not args.no_export,
+        output=args.output,
+        baseline=args.baseline
+    )
@@ -0,0 +1,332 @@
+# coreml_compression.py
+
+import os
+import sys
+import json
+import numpy as np
+import argparse
+
+from numpy_backend import NumpyModel
+from dataset_stage import DatasetStage
+
+# "float32" and "float16" set the precision of the conversion itself (mlprogram
+# defaults to float16); "int8" and "palettize" compress the weights of the converted model.
+COMPRESSIONS = ("float32", "float16", "int8", "palettize")
+DEFAULT_PALETTE_BITS = 6
+
+# coremltools only compresses weights with more elements than this (not biases, BN params, ...)
+WEIGHT_THRESHOLD = 2048
+
+
+def path_size_mb(path):
+    """
+    Size of a file, or of everything in a folder (e.g. an .mlpackage), in MB. None if missing.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path) / (1024 * 1024)
+    if not os.path.isdir(path):
+        return None
+    total = 0
+    for root, _, filenames in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, filename)) for filename in filenames)
+    return total / (1024 * 1024)
+
+
+def compute_precision(compression):
+    """
+    Precision to pass to ct.convert for a compression mode.
+    """
+    import coremltools as ct
+
+    return ct.precision.FLOAT32 if compression == "float32" else ct.precision.FLOAT16
+
+
+def compress_coreml(mlmodel, compression, nbits=DEFAULT_PALETTE_BITS):
+    """
+    Compresses the weights of a converted mlprogram with coremltools' optimize utilities:
+    "int8" is per-channel symmetric linear quantization, "palettize" a k-means lookup
+    table of 2**nbits values per weight. float32 / float16 models are returned as is.
+    """
+    if compression in ("float32", "float16"):
+        return mlmodel
+    import coremltools.optimize.coreml as cto
+
+    if compression == "int8":
+        config = cto.OptimizationConfig(global_config=cto.OpLinearQuantizerConfig(
+            mode="linear_symmetric", weight_threshold=WEIGHT_THRESHOLD
+        ))
+        return cto.linear_quantize_weights(mlmodel, config=config)
+    if compression == "palettize":
+        config = cto.OptimizationConfig(global_config=cto.OpPalettizerConfig(
+            mode="kmeans", nbits=nbits, weight_threshold=WEIGHT_THRESHOLD
+        ))
+        return cto.palettize_weights(mlmodel, config=config)
+    raise ValueError(f"Unknown compression '{compression}', expected one of {COMPRESSIONS}")
+
+
+def _channel_axes(class_name, weight_index, weight):
+    """
+    Axes to reduce over for per-output-channel statistics of a Keras weight. Core ML
+    quantizes per output channel, which for depthwise kernels is every (channel, multiplier).
+    """
+    if class_name in ("DepthwiseConv2D", "SeparableConv2D") and weight_index == 0:
+        return (0, 1)
+    return tuple(range(weight.ndim - 1))
+
+
+def _nearest(values, centroids):
+    """
+    Index of the nearest of the sorted centroids for every value.
+    """
+    return np.searchsorted((centroids[1:] + centroids[:-1]) / 2, values)
+
+
+def _kmeans_1d(values, num_clusters, iterations=20):
+    """
+    Lloyd's k-means on scalars, initialized at the quantiles. Returns the sorted centroids.
+    """
+    centroids = np.unique(np.quantile(values, np.linspace(0, 1, num_clusters)))
+    for _ in range(iterations):
+        assignment = _nearest(values, centroids)
+        sums = np.bincount(assignment, weights=values, minlength=len(centroids))
+        counts = np.bincount(assignment, minlength=len(centroids))
+        updated = np.where(counts > 0, sums / np.maximum(counts, 1), centroids)
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+    return centroids
+
+
+def simulate_weight(weight, compression, nbits=DEFAULT_PALETTE_BITS, class_name="Dense", weight_index=0):
+    """
+    Returns a float32 weight as the compressed model stores it, quantized and dequantized
+    again, so a NumpyModel can run what the device would run.
+    """
+    weight = np.asarray(weight, dtype=np.float32)
+    if compression == "float32":
+        return weight
+    if compression == "float16" or weight.size <= WEIGHT_THRESHOLD:
+        return weight.astype(np.float16).astype(np.float32)  # uncompressed weights are still float16
+
+    if compression == "int8":
+        axes = _channel_axes(class_name, weight_index, weight)
+        scale = np.abs(weight).max(axis=axes, keepdims=True) / 127.0
+        scale[scale == 0] = 1.0
+        return np.clip(np.round(weight / scale), -127, 127) * scale
+
+    if compression == "palettize":
+        values = weight.ravel()
+        centroids = _kmeans_1d(values, 2 ** nbits)
+        return centroids[_nearest(values, centroids)].astype(np.float32).reshape(weight.shape)
+
+    raise ValueError(f"Unknown compression '{compression}', expected one of {COMPRESSIONS}")
+
+
+def weight_bytes(layers, compression, nbits=DEFAULT_PALETTE_BITS):
+    """
+    Bytes the weights of [(class_name, config, [weights...]), ...] take in a model
+    compressed with compression (lookup tables and scales included).
+    """
+    total = 0
+    for class_name, _, weights in layers:
+        for j, weight in enumerate(weights):
+            weight = np.asarray(weight)
+            if compression == "float32":
+                total += weight.size * 4
+            elif compression == "float16" or weight.size <= WEIGHT_THRESHOLD:
+                total += weight.size * 2
+            elif compression == "int8":
+                axes = _channel_axes(class_name, j, weight)
+                num_channels = weight.size // int(np.prod([weight.shape[axis] for axis in axes]))
+                total += weight.size + num_channels * 2
+            else:
+                total += int(np.ceil(weight.size * nbits / 8)) + (2 ** nbits) * 2
+    return total
+
+
+def simulated_model(numpy_model, compression, nbits=DEFAULT_PALETTE_BITS):
+    """
+    Returns a NumpyModel whose weights are those of numpy_model after compression.
+    """
+    layers = [
+        (class_name, config, [simulate_weight(weight, compression, nbits, class_name, j) for j, weight in enumerate(weights)])
+        for class_name, config, weights in numpy_model.layers
+    ]
+    return NumpyModel(layers, name=f"{numpy_model.name}_{compression}")
+
+
+def coreml_runtime_available():
+    """
+    True if Core ML models can be run here (macOS with coremltools installed), so a
+    compression can be verified on the real compressed model rather than simulated.
+    """
+    if sys.platform != "darwin":
+        return False
+    try:
+        import coremltools  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def coreml_probabilities(mlmodel, crops, class_labels):
+    """
+    Runs uint8 crops (n, h, w, channels) through a Core ML key classifier and returns its
+    probabilities, shape (n, len(class_labels)) in class_labels order. macOS only.
+    """
+    from PIL import Image
+
+    description = mlmodel.get_spec().description
+    input_name = description.input[0].name
+    output_name = description.predictedProbabilitiesName
+    probs = np.zeros((len(crops), len(class_labels)), dtype=np.float32)
+    for i, crop in enumerate(crops):
+        crop = np.asarray(crop, dtype=np.uint8)
+        # The crops are gray (copied into 3 channels), so BGR vs RGB doesn't matter
+        image = Image.fromarray(crop[..., 0] if crop.shape[-1] == 1 else crop)
+        by_label = mlmodel.predict({input_name: image})[output_name]
+        probs[i] = [by_label[label] for label in class_labels]
+    return probs
+
+
+def verify_compression(numpy_model, crops, compression, nbits=DEFAULT_PALETTE_BITS, batch_size=256,
+                       reference_mlmodel=None, compressed_mlmodel=None, class_labels=None):
+    """
+    Compares the labels of the uncompressed and the compressed model on uint8 crops and
+    returns a report with their agreement and the weight size savings.
+
+    Given the uncompressed and compressed Core ML models (and their class_labels) on a
+    machine that can run them, both are run as they are ("method": "coreml"). Otherwise
+    the compression is simulated in NumPy on numpy_model's weights (per-channel int8,
+    per-tensor k-means palettes), which only estimates what coremltools produces
+    ("method": "simulated"). The weight sizes are always computed, not measured.
+    """
+    if reference_mlmodel is not None and compressed_mlmodel is not None and coreml_runtime_available():
+        method = "coreml"
+        run_reference = lambda batch: coreml_probabilities(reference_mlmodel, batch, class_labels)
+        run_compressed = lambda batch: coreml_probabilities(compressed_mlmodel, batch, class_labels)
+    else:
+        method = "simulated"
+        compressed = simulated_model(numpy_model, compression, nbits)
+        run_reference = lambda batch: numpy_model(np.asarray(batch, dtype=np.float32) / 255.0)
+        run_compressed = lambda batch: compressed(np.asarray(batch, dtype=np.float32) / 255.0)
+
+    agree = 0
+    max_prob_diff = 0.0
+    for start in range(0, len(crops), batch_size):
+        batch = crops[start:start + batch_size]
+        reference = run_reference(batch)
+        probs = run_compressed(batch)
+        agree += int(np.sum(reference.argmax(axis=1) == probs.argmax(axis=1)))
+        max_prob_diff = max(max_prob_diff, float(np.abs(reference - probs).max()))
+
+    float32_bytes = weight_bytes(numpy_model.layers, "float32")
+    compressed_bytes = weight_bytes(numpy_model.layers, compression, nbits)
+    return {
+        "compression": compression,
+        "nbits": nbits if compression == "palettize" else None,
+        "method": method,
+        "samples": int(len(crops)),
+        "label_agreement": agree / len(crops) if len(crops) else None,
+        "max_probability_diff": max_prob_diff,
+        "float32_weights_mb": float32_bytes / (1024 * 1024),
+        "compressed_weights_mb": compressed_bytes / (1024 * 1024),
+        "weight_size_ratio": compressed_bytes / max(float32_bytes, 1)
+    }
+
+
+def describe(report):
+    """
+    One line summary of a verify_compression report.
+    """
+    estimated = " (estimated, simulated weights)" if report["method"] == "simulated" else ""
+    return (f"{100 * (report['label_agreement'] or 0):.2f}% label agreement{estimated} on {report['samples']} crops, "
+            f"weights {report['float32_weights_mb']:.2f} -> {report['compressed_weights_mb']:.2f} MB")
+
+
+def compress_version(model_dir, dataset_dir, dataset_version, compression, nbits=DEFAULT_PALETTE_BITS,
+                     cache_dir=None, save=False):
+    """
+    Verifies compression for every key model in model_dir on the crops of dataset_version
+    and writes the reports to <model_dir>/compression-<compression>.json. With save, the
+    existing <key>.mlpackage files are compressed into <model_dir>/<compression>/ as well.
+    On macOS the compressed .mlpackage is what's verified, elsewhere it's simulated.
+    """
+    sidecars = {}
+    for filename in sorted(os.listdir(model_dir)):
+        if filename.endswith(".json") and os.path.isfile(os.path.join(model_dir, os.path.splitext(filename)[0] + ".h5")):
+            with open(os.path.join(model_dir, filename), "r", encoding="utf-8") as f:
+                sidecar = json.load(f)
+            if "key_name" in sidecar:
+                sidecars[os.path.splitext(filename)[0]] = sidecar
+
+    # One stage per input shape, so every image is decoded once
+    groups = {}
+    for name, sidecar in sidecars.items():
+        groups.setdefault((tuple(sidecar["image_size"]), sidecar.get("channels", 3)), []).append(name)
+
+    reports = {}
+    for (image_size, channels), names in groups.items():
+        stage = DatasetStage(
+            dataset_dir,
+            dataset_version,
+            rois={sidecars[name]["key_name"]: sidecars[name]["roi"] for name in names},
+            image_size=image_size,
+            cache_dir=cache_dir,
+            channels=channels
+        ).load()
+        for name in names:
+            key_name = sidecars[name]["key_name"]
+            crops, _ = stage.samples(key_name)
+
+            # The real compressed model, when it's needed for --save or can be run to verify it
+            coreml_path = os.path.join(model_dir, name + ".mlpackage")
+            reference_mlmodel = compressed_mlmodel = None
+            if os.path.exists(coreml_path) and (save or coreml_runtime_available()):
+                import coremltools as ct
+
+                reference_mlmodel = ct.models.MLModel(coreml_path)
+                compressed_mlmodel = compress_coreml(reference_mlmodel, compression, nbits)
+
+            report = verify_compression(
+                NumpyModel.load(os.path.join(model_dir, name + ".h5")), crops, compression, nbits,
+                reference_mlmodel=reference_mlmodel, compressed_mlmodel=compressed_mlmodel,
+                class_labels=sidecars[name]["class_labels"]
+            )
+            report["mlpackage_mb"] = path_size_mb(coreml_path)
+            if save and compressed_mlmodel is not None:
+                compressed_path = os.path.join(model_dir, compression, name + ".mlpackage")
+                os.makedirs(os.path.dirname(compressed_path), exist_ok=True)
+                compressed_mlmodel.save(compressed_path)
+                report["compressed_mlpackage_mb"] = path_size_mb(compressed_path)
+
+            print(f"[INFO] {key_name} {compression}: {describe(report)}")
+            reports[key_name] = report
+
+    report_path = os.path.join(model_dir, f"compression-{compression}.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(reports, f, indent=2)
+    print(f"[INFO] Compression report saved to {report_path}")
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, required=True, help="Model version to check (i.e. 'v3').")
+    parser.add_argument("--dataset", type=str, required=True, help="Dataset version to verify on (i.e. 'v3').")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default="int8", help="Weight compression to verify.")
+    parser.add_argument("--nbits", type=int, default=DEFAULT_PALETTE_BITS, help="Bits per weight for 'palettize'.")
+    parser.add_argument("--cache-dir", type=str, default="./cache", help="Folder of the preprocessed crop cache.")
+    parser.add_argument("--save", action="store_true",
+                        help="Also write compressed copies of the .mlpackage files to models/vX/<compression>/.")
+    args = parser.parse_args()
+
+    compress_version(
+        os.path.join("./models", args.model),
+        "./dataset",
+        args.dataset,
+        args.compression,
+        nbits=args.nbits,
+        cache_dir=args.cache_dir,
+        save=args.save
+    )
@@ -0,0 +1,213 @@
+# dataset_pack.py
+
+import os
+import json
+import struct
+import numpy as np
+import cv2
+import argparse
+
+from annotation_manifest import file_sha1
+
+# Lives next to annotations.json in a dataset/vX folder
+PACK_FILENAME = "frames.blmpack"
+
+# File layout:
+#   [0:8]    MAGIC
+#   [8:16]   header offset (little-endian uint64)
+#   [16:24]  header length in bytes (little-endian uint64)
+#   [DATA_OFFSET:header offset]  N * H * W uint8 grayscale frames, fixed stride H * W
+#   [header offset:]  UTF-8 JSON header (shape, filenames, fingerprints, annotations)
+MAGIC = b"BLMPACK1"
+DATA_OFFSET = 4096  # page aligned, so the frames can be memory-mapped directly
+
+
+def to_gray(img):
+    """
+    Returns the grayscale version of a BGR image (or the image itself if it already is),
+    exactly as the crop preprocessing computes it.
+    """
+    if img.ndim == 2:
+        return img
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def pack_version(version_dir, pack_path=None):
+    """
+    Decodes every PNG/JPG in a dataset/vX folder once and writes them as grayscale frames
+    into a single memory-mappable archive, together with annotations.json. All frames must
+    share the resolution of the first one; others are skipped with a warning.
+    Returns the path of the pack.
+    """
+    pack_path = pack_path or os.path.join(version_dir, PACK_FILENAME)
+    filenames = sorted(
+        f for f in os.listdir(version_dir)
+        if (f.lower().endswith(".png") or f.lower().endswith(".jpg"))
+        and os.path.isfile(os.path.join(version_dir, f))
+    )
+
+    annotations = []
+    annotations_sha1 = None
+    annotation_file = os.path.join(version_dir, "annotations.json")
+    if os.path.isfile(annotation_file):
+        with open(annotation_file, "r", encoding="utf-8") as f:
+            annotations = json.load(f)
+        annotations_sha1 = file_sha1(annotation_file)
+
+    packed = []
+    fingerprints = {}
+    shape = None
+    tmp_path = pack_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(b"\0" * DATA_OFFSET)
+        for filename in filenames:
+            filepath = os.path.join(version_dir, filename)
+            img = cv2.imread(filepath)
+            if img is None:
+                print(f"[WARN] Skipping unreadable image {filepath}")
+                continue
+            gray = to_gray(img)
+            if shape is None:
+                shape = gray.shape
+            elif gray.shape != shape:
+                print(f"[WARN] Skipping {filename}: {gray.shape[1]}x{gray.shape[0]} doesn't match {shape[1]}x{shape[0]}")
+                continue
+            f.write(np.ascontiguousarray(gray).tobytes())
+            stat = os.stat(filepath)
+            fingerprints[filename] = [stat.st_size, stat.st_mtime]
+            packed.append(filename)
+
+        header = json.dumps({
+            "format": 1,
+            "shape": [len(packed), *(shape or (0, 0))],
+            "offset": DATA_OFFSET,
+            "filenames": packed,
+            "fingerprints": fingerprints,
+            "annotations": annotations,
+            "annotations_sha1": annotations_sha1
+        }).encode("utf-8")
+        header_offset = f.tell()
+        f.write(header)
+        f.seek(0)
+        f.write(MAGIC + struct.pack("<QQ", header_offset, len(header)))
+    os.replace(tmp_path, pack_path)
+
+    size_mb = os.path.getsize(pack_path) / (1024 * 1024)
+    print(f"[INFO] Packed {len(packed)} frames from {version_dir} into {pack_path} ({size_mb:.1f} MB)")
+    return pack_path
+
+
+class DatasetPack:
+    """
+    Read-only view of a pack written by pack_version. The frames are a single np.memmap
+    of shape (N, H, W), so frame(filename) is a zero-copy slice of the file and opening
+    a pack costs one header read instead of N PNG decodes.
+
+    Args:
+        pack_path (str): Path to the .blmpack file.
+    """
+
+    def __init__(self, pack_path):
+        self.pack_path = pack_path
+        with open(pack_path, "rb") as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f"{pack_path} is not a dataset pack")
+            header_offset, header_length = struct.unpack("<QQ", f.read(16))
+            f.seek(header_offset)
+            header = json.loads(f.read(header_length).decode("utf-8"))
+
+        self.shape = tuple(header["shape"])
+        self.filenames = header["filenames"]
+        self.fingerprints = header["fingerprints"]
+        self.annotations = header["annotations"]
+        self.annotations_sha1 = header.get("annotations_sha1")
+        self.index = {filename: i for i, filename in enumerate(self.filenames)}
+        if self.shape[0] > 0:
+            self.frames = np.memmap(pack_path, dtype=np.uint8, mode="r", offset=header["offset"], shape=self.shape)
+        else:
+            self.frames = np.zeros(self.shape, dtype=np.uint8)
+
+    @classmethod
+    def open(cls, version_dir):
+        """
+        Returns the pack of a dataset/vX folder, or None if it has none.
+        """
+        pack_path = os.path.join(version_dir, PACK_FILENAME)
+        if os.path.isfile(pack_path):
+            return cls(pack_path)
+        return None
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def is_current(self, filename, version_dir):
+        """
+        True if the packed frame of filename can stand in for the file on disk: the file
+        was packed and is either gone or still has the packed size and mtime.
+        """
+        if filename not in self.index:
+            return False
+        filepath = os.path.join(version_dir, filename)
+        if not os.path.isfile(filepath):
+            return True
+        stat = os.stat(filepath)
+        return [stat.st_size, stat.st_mtime] == self.fingerprints[filename]
+
+    def frame(self, filename):
+        """
+        Returns the (H, W) uint8 grayscale frame of filename, a view into the memory map.
+        """
+        return self.frames[self.index[filename]]
+
+
+def load_version_annotations(version_dir, pack=None):
+    """
+    Returns (records, SHA-1 of annotations.json) of a dataset/vX folder. The labels packed
+    with the frames are used when annotations.json is missing or still the file that was
+    packed; after re-annotating, the file wins. Raises FileNotFoundError if neither has labels.
+    """
+    annotation_file = os.path.join(version_dir, "annotations.json")
+    if os.path.isfile(annotation_file):
+        annotations_sha1 = file_sha1(annotation_file)
+        if pack is not None and pack.annotations_sha1 == annotations_sha1:
+            return pack.annotations, annotations_sha1
+        with open(annotation_file, "r", encoding="utf-8") as f:
+            return json.load(f), annotations_sha1
+    if pack is not None and pack.annotations_sha1 is not None:
+        return pack.annotations, pack.annotations_sha1
+    raise FileNotFoundError(f"No annotations.json in {version_dir}")
+
+
+def unpack_version(pack_path, output_dir):
+    """
+    Writes the frames of a pack back out as grayscale images plus its annotations.json.
+    The original colors are not kept in the pack; everything downstream works on gray.
+    """
+    pack = DatasetPack(pack_path)
+    os.makedirs(output_dir, exist_ok=True)
+    for filename in pack.filenames:
+        cv2.imwrite(os.path.join(output_dir, filename), np.asarray(pack.frame(filename)))
+    with open(os.path.join(output_dir, "annotations.json"), "w", encoding="utf-8") as f:
+        json.dump(pack.annotations, f, indent=2)
+    print(f"[INFO] Unpacked {len(pack)} frames from {pack_path} into {output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="Pack dataset/vX into dataset/vX/" + PACK_FILENAME)
+    pack_parser.add_argument("--dataset", type=str, required=True, help="Dataset version to pack (i.e. 'v1').")
+    unpack_parser = subparsers.add_parser("unpack", help="Write a pack back out as PNGs + annotations.json")
+    unpack_parser.add_argument("--dataset", type=str, required=True, help="Dataset version to unpack (i.e. 'v1').")
+    unpack_parser.add_argument("--output", type=str, required=True, help="Folder to write the PNGs to.")
+    args = parser.parse_args()
+
+    version_dir = os.path.join("./dataset/", args.dataset)
+    if args.command == "pack":
+        pack_version(version_dir)
+    else:
+        unpack_version(os.path.join(version_dir, PACK_FILENAME), args.output)
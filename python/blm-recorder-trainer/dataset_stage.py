@@ -0,0 +1,318 @@
+# dataset_stage.py
+
+import os
+import json
+import re
+import hashlib
+import numpy as np
+import cv2
+
+from dataset_pack import DatasetPack, to_gray, load_version_annotations
+from profiling import timed
+
+
+def generate_version_list(version_str):
+    """
+    Returns all dataset versions from this one back to v0, e.g. 'v2' -> ['v2', 'v1', 'v0'].
+    """
+    match = re.match(r'v(\d+)', version_str)
+    if match:
+        num = int(match.group(1))
+        return [f'v{i}' for i in range(num, -1, -1)]
+    return []
+
+
+def crop_roi(img, roi):
+    """
+    Crops img to roi = (x, y, w, h) in [0..1]. None or (0, 0, 1, 1) keeps the full image.
+    """
+    if roi is None or tuple(roi) == (0, 0, 1, 1):
+        return img
+    img_h, img_w = img.shape[:2]
+    x_abs = int(roi[0] * img_w)
+    y_abs = int(roi[1] * img_h)
+    w_abs = int(roi[2] * img_w)
+    h_abs = int(roi[3] * img_h)
+    return img[y_abs:y_abs + h_abs, x_abs:x_abs + w_abs]
+
+
+def preprocess_crop(img, image_size, channels=3):
+    """
+    Grayscale -> min/max normalize -> back to 3-channel BGR -> resize to image_size (width, height).
+    Returns a uint8 array of shape (height, width, channels). With channels=1 the gray crop
+    is resized directly, which gives the same values as any channel of the 3-channel crop.
+    img may be BGR or already grayscale (e.g. a frame from a DatasetPack).
+    """
+    # Convert to grayscale
+    gray = to_gray(img)
+
+    # Normalize the grayscale image to range [0, 255]
+    normalized_gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+    if channels == 1:
+        resized = cv2.resize(normalized_gray, (image_size[0], image_size[1]), interpolation=cv2.INTER_CUBIC)
+        return resized[:, :, np.newaxis]
+
+    # Convert the normalized grayscale image back to a 3-channel color image
+    color_image = cv2.cvtColor(normalized_gray, cv2.COLOR_GRAY2BGR)
+
+    # Resize the image
+    return cv2.resize(color_image, (image_size[0], image_size[1]), interpolation=cv2.INTER_CUBIC)
+
+
+class DatasetStage:
+    """
+    Shared dataset stage that decodes every image in dataset/v0..vN exactly once and
+    crops + normalizes every requested ROI in the same pass. Each KeyClassifier then
+    draws its base crops from here instead of re-reading all the PNGs itself.
+
+    Versions that have a DatasetPack (see dataset_pack.py) are read from its memory-mapped
+    grayscale frames instead of decoding their PNGs.
+
+    If cache_dir is set, the preprocessed crops of each version are also saved there as
+    uint8 .npy files keyed by (version, roi, image_size, annotations hash). Later runs
+    memory-map those instead of decoding again, so only new or re-annotated versions
+    are preprocessed. The versions of each key are joined in one more cache file, so the
+    crops of a whole dataset are memory-mapped rather than read into RAM.
+
+    Args:
+        dataset_dir (str): Root folder holding the v0..vN dataset versions.
+        dataset_version (str): Newest version to load, e.g. 'v3' loads v3, v2, v1, v0.
+        rois (dict): { key_name: (x, y, w, h) } in [0..1] for every key to crop.
+        image_size (tuple[int, int]): (width, height) each crop is resized to.
+        cache_dir (str): Optional folder for the on-disk crop cache. None disables it.
+        channels (int): 3 for the gray-replicated BGR crops, 1 for single-channel crops.
+    """
+
+    def __init__(self, dataset_dir, dataset_version, rois, image_size=(64, 32), cache_dir=None, channels=3):
+        if channels not in (1, 3):
+            raise ValueError(f"channels must be 1 or 3, got {channels}")
+        self.dataset_dir = dataset_dir
+        self.dataset_version = dataset_version
+        self.rois = dict(rois)
+        self.image_size = image_size
+        self.cache_dir = cache_dir
+        self.channels = channels
+
+        self.records = []  # annotation records, aligned with the rows of each crop array
+        self.record_versions = []  # dataset version ('v3', ...) of each record
+        self.crops = {}    # key_name -> uint8 array of shape (N, height, width, channels)
+        self.rows = {}     # key_name -> row indices samples() returns (e.g. after dedup.dedup_stage)
+
+    def _cache_path(self, version, key_name, annotations_hash):
+        """
+        Cache file for one key of one version. The digest covers everything that changes
+        the crops, so a stale entry is simply never looked up again.
+        """
+        roi = self.rois[key_name]
+        cache_key = json.dumps({
+            "version": version,
+            "roi": list(roi) if roi is not None else None,
+            "image_size": list(self.image_size),
+            "channels": self.channels,
+            "annotations": annotations_hash
+        }, sort_keys=True)
+        digest = hashlib.sha1(cache_key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, version, f"{key_name}-{digest}.npy")
+
+    def _index_path(self, version, annotations_hash):
+        """
+        Cache file listing which annotation records made it into the cached crops.
+        """
+        return os.path.join(self.cache_dir, version, f"index-{annotations_hash[:16]}.json")
+
+    def _combined_path(self, key_name, part_paths):
+        """
+        Cache file holding the crops of several cached versions back to back. It's keyed by
+        the per-version cache files, which are themselves keyed by everything that changes
+        the crops.
+        """
+        digest = hashlib.sha1("\n".join(part_paths).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, "combined", f"{key_name}-{digest}.npy")
+
+    def _combine(self, key_name, parts):
+        """
+        Joins the per-version crops of one key. Cached versions are memory-mapped, and
+        np.concatenate would read them all into RAM, so they are copied into one combined
+        cache file instead, which is memory-mapped in turn (and reused by later runs).
+        """
+        if len(parts) == 1:
+            return parts[0]
+        part_paths = [getattr(part, "filename", None) for part in parts]
+        if self.cache_dir is None or None in part_paths:
+            return np.concatenate(parts)
+
+        combined_path = self._combined_path(key_name, [os.path.basename(path) for path in part_paths])
+        if not os.path.isfile(combined_path):
+            os.makedirs(os.path.dirname(combined_path), exist_ok=True)
+            tmp_path = combined_path + ".tmp.npy"
+            shape = (sum(len(part) for part in parts),) + parts[0].shape[1:]
+            combined = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=shape)
+            start = 0
+            for part in parts:
+                combined[start:start + len(part)] = part
+                start += len(part)
+            combined.flush()
+            del combined
+            os.replace(tmp_path, combined_path)
+        return np.load(combined_path, mmap_mode="r")
+
+    def _decode_version(self, image_dir, annotations, key_names, pack=None):
+        """
+        Decodes every image of one version once (taking current frames from its pack) and
+        crops each of key_names from it.
+        Returns (record indices kept, { key_name: uint8 crops }).
+        """
+        height, width = self.image_size[1], self.image_size[0]
+        crop_lists = {key_name: [] for key_name in key_names}
+        kept = []
+
+        for record_idx, record in enumerate(annotations):
+            filename = record.get("filename")
+            if not filename:
+                continue  # skip if no filename
+            if pack is not None and pack.is_current(filename, image_dir):
+                img = pack.frame(filename)  # zero-copy view of the packed gray frame
+            else:
+                filepath = os.path.join(image_dir, filename)
+                if not os.path.isfile(filepath):
+                    continue  # skip if file doesn't exist
+
+                with timed("decode"):
+                    img = cv2.imread(filepath)
+                if img is None:
+                    continue  # skip unreadable images
+
+            with timed("crop"):
+                for key_name in key_names:
+                    crop_lists[key_name].append(preprocess_crop(crop_roi(img, self.rois[key_name]), self.image_size, self.channels))
+            kept.append(record_idx)
+
+        crops = {
+            key_name: np.array(crop_list, dtype=np.uint8).reshape(-1, height, width, self.channels)
+            for key_name, crop_list in crop_lists.items()
+        }
+        return kept, crops
+
+    def _load_version(self, version):
+        """
+        Returns (records, { key_name: crops }) for one version, reading the crops from the
+        on-disk cache where possible and only decoding the images for what is missing.
+        """
+        image_dir = os.path.join(self.dataset_dir, version)
+
+        # Load data labels, from the pack if annotations.json is unchanged since packing
+        pack = DatasetPack.open(image_dir)
+        annotations, annotations_hash = load_version_annotations(image_dir, pack)
+
+        if self.cache_dir is None:
+            kept, crops = self._decode_version(image_dir, annotations, list(self.rois), pack)
+            return [annotations[i] for i in kept], crops
+
+        index_path = self._index_path(version, annotations_hash)
+        crops = {}
+        kept = None
+        if os.path.isfile(index_path):
+            with open(index_path, "r", encoding="utf-8") as f:
+                kept = json.load(f)
+            for key_name in self.rois:
+                cache_path = self._cache_path(version, key_name, annotations_hash)
+                if os.path.isfile(cache_path):
+                    crops[key_name] = np.load(cache_path, mmap_mode="r")
+
+        missing = [key_name for key_name in self.rois if key_name not in crops]
+        if missing:
+            kept, decoded = self._decode_version(image_dir, annotations, missing, pack)
+            os.makedirs(os.path.join(self.cache_dir, version), exist_ok=True)
+            for key_name, key_crops in decoded.items():
+                cache_path = self._cache_path(version, key_name, annotations_hash)
+                tmp_path = cache_path + ".tmp.npy"
+                np.save(tmp_path, key_crops)
+                os.replace(tmp_path, cache_path)
+                crops[key_name] = np.load(cache_path, mmap_mode="r")
+            with open(index_path, "w", encoding="utf-8") as f:
+                json.dump(kept, f)
+            print(f"[INFO] Preprocessed {version} ({len(kept)} images) for {len(missing)} keys, cached in {self.cache_dir}")
+        else:
+            print(f"[INFO] Memory-mapped cached crops for {version} ({len(kept)} images)")
+
+        return [annotations[i] for i in kept], crops
+
+    def load(self):
+        """
+        Walks vN..v0 in the same order KeyClassifier always has, decoding each image once
+        (or memory-mapping its cached crops) for every ROI in self.rois.
+        """
+        height, width = self.image_size[1], self.image_size[0]
+        crop_parts = {key_name: [] for key_name in self.rois}
+        self.records = []
+        self.record_versions = []
+
+        for version in generate_version_list(self.dataset_version):
+            records, crops = self._load_version(version)
+            self.records.extend(records)
+            self.record_versions.extend([version] * len(records))
+            for key_name in self.rois:
+                crop_parts[key_name].append(crops[key_name])
+
+        self.crops = {
+            key_name: self._combine(key_name, parts) if parts else np.zeros((0, height, width, self.channels), dtype=np.uint8)
+            for key_name, parts in crop_parts.items()
+        }
+        print(f"[INFO] Loaded {len(self.records)} images for {len(self.rois)} keys")
+        return self
+
+    def subset(self, key_names):
+        """
+        Returns a loaded DatasetStage holding only key_names, e.g. to send a single key's
+        crops to a worker process without pickling every other key's crops.
+        """
+        stage = DatasetStage(
+            self.dataset_dir,
+            self.dataset_version,
+            {key_name: self.rois[key_name] for key_name in key_names},
+            image_size=self.image_size,
+            cache_dir=self.cache_dir,
+            channels=self.channels
+        )
+        stage.records = self.records
+        stage.record_versions = self.record_versions
+        stage.crops = {key_name: self.crops[key_name] for key_name in key_names}
+        stage.rows = {key_name: self.rows[key_name] for key_name in key_names if key_name in self.rows}
+        return stage
+
+    def samples(self, key_name):
+        """
+        Returns (crops, labels) for key_name, where labels[i] is the record's label
+        for that key (or "None" if the record has no such key). If rows were selected for
+        the key (see dedup.py), only those rows are returned.
+        """
+        if key_name not in self.crops:
+            raise KeyError(f"Key '{key_name}' was not loaded by this DatasetStage")
+        crops = self.crops[key_name]
+        records = self.records
+        if key_name in self.rows:
+            rows = self.rows[key_name]
+            crops = crops[rows]
+            records = [records[i] for i in rows]
+        labels = [record[key_name] if key_name in record else "None" for record in records]
+        return crops, labels
+
+    def sample_versions(self, key_name):
+        """
+        Returns the dataset version of each sample samples(key_name) returns.
+        """
+        versions = np.array(self.record_versions)
+        if key_name in self.rows:
+            versions = versions[self.rows[key_name]]
+        return versions
+
+    def sample_ids(self, key_name):
+        """
+        Returns '<version>/<filename>' of each sample samples(key_name) returns, which
+        names a frame across runs (e.g. to record which frames a model was validated on).
+        """
+        ids = np.array([f"{version}/{record['filename']}" for version, record in zip(self.record_versions, self.records)])
+        if key_name in self.rows:
+            ids = ids[self.rows[key_name]]
+        return ids
@@ -0,0 +1,133 @@
+# dedup.py
+
+import numpy as np
+import cv2
+
+# Number of set bits of every byte value, for vectorized Hamming distances on packed hashes
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1).astype(np.uint16)
+
+
+def _gray(crops):
+    crops = np.asarray(crops)
+    if crops.ndim == 4:
+        crops = crops[..., 0]  # the crops are gray, replicated or single channel
+    return crops
+
+
+def dhash(crops, hash_size=16):
+    """
+    Difference hash of each (N, h, w[, c]) uint8 crop: the crop is shrunk to
+    (hash_size + 1) x hash_size and each bit says whether a pixel is brighter than its
+    right neighbour. Returns packed bits, shape (N, hash_size * hash_size / 8).
+    """
+    small = np.array([
+        cv2.resize(crop, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+        for crop in _gray(crops)
+    ]).reshape(-1, hash_size, hash_size + 1)
+    bits = small[:, :, 1:] > small[:, :, :-1]
+    return np.packbits(bits.reshape(len(bits), -1), axis=1)
+
+
+def ahash(crops, hash_size=16):
+    """
+    Average hash: each bit says whether a pixel of the hash_size x hash_size thumbnail is
+    brighter than the thumbnail's mean. Same output layout as dhash.
+    """
+    small = np.array([
+        cv2.resize(crop, (hash_size, hash_size), interpolation=cv2.INTER_AREA)
+        for crop in _gray(crops)
+    ]).reshape(-1, hash_size * hash_size).astype(np.float32)
+    bits = small > small.mean(axis=1, keepdims=True)
+    return np.packbits(bits, axis=1)
+
+
+HASHES = {"dhash": dhash, "ahash": ahash}
+
+
+def hamming_distances(hashes, others, segments=1):
+    """
+    (N, B) x (M, B) packed hashes -> (N, M) Hamming distances in bits. With segments > 1
+    the hashes are split into that many equal parts (e.g. one per key of a joint hash)
+    and the distance is the largest distance of any part.
+    """
+    xor = np.bitwise_xor(hashes[:, np.newaxis, :], others[np.newaxis, :, :])
+    bits = POPCOUNT[xor]
+    return bits.reshape(bits.shape[:2] + (segments, -1)).sum(axis=-1).max(axis=-1)
+
+
+def cluster(hashes, max_distance, segments=1):
+    """
+    Greedy leader clustering in input order: each hash joins the cluster of its nearest
+    leader if that is within max_distance bits (in every segment, see hamming_distances),
+    or becomes the leader of a new cluster. Returns a cluster id per hash.
+    """
+    cluster_ids = np.empty(len(hashes), dtype=np.int64)
+    leaders = np.empty_like(hashes)
+    num_leaders = 0
+    for i, h in enumerate(hashes):
+        if num_leaders:
+            distances = hamming_distances(h[np.newaxis], leaders[:num_leaders], segments)[0]
+            nearest = int(np.argmin(distances))
+            if distances[nearest] <= max_distance:
+                cluster_ids[i] = nearest
+                continue
+        cluster_ids[i] = num_leaders
+        leaders[num_leaders] = h
+        num_leaders += 1
+    return cluster_ids
+
+
+def dedup_indices(hashes, labels, max_distance=10, keep_per_cluster=1, segments=1):
+    """
+    Clusters near-duplicate samples that share the same label and returns the sorted row
+    indices to keep: up to keep_per_cluster members per cluster, spread over the cluster
+    (the first member is always kept). Samples with different labels are never merged.
+    segments splits joint hashes per key, see hamming_distances.
+    """
+    labels = np.asarray([str(label) for label in labels])
+    kept = []
+    for label in np.unique(labels):
+        rows = np.flatnonzero(labels == label)
+        cluster_ids = cluster(hashes[rows], max_distance, segments)
+        for cluster_id in np.unique(cluster_ids):
+            members = rows[cluster_ids == cluster_id]
+            picks = np.unique(np.linspace(0, len(members) - 1, min(keep_per_cluster, len(members))).round().astype(int))
+            kept.extend(members[picks])
+    return np.sort(np.array(kept, dtype=np.int64))
+
+
+def dedup_stage(stage, key_names, max_distance=10, keep_per_cluster=1, method="dhash", hash_size=16, joint=False):
+    """
+    Drops near-duplicate frames from a loaded DatasetStage, so each one isn't augmented
+    100x for nothing. Sets stage.rows[key] to the rows DatasetStage.samples(key) returns.
+
+    By default each key is deduplicated on its own ROI crop: frames that only differ
+    outside a key's ROI are duplicates for that key. With joint=True (needed when all keys
+    are trained together, e.g. the multi-head model) the hashes of every key's crop are
+    concatenated and frames are only merged if every key's crops are within max_distance
+    and all of their labels match, so the same rows are kept for every key.
+
+    Returns { key_name: (rows before, rows kept) }.
+    """
+    hash_fn = HASHES[method]
+    report = {}
+    for key_name in key_names:
+        stage.rows.pop(key_name, None)  # hash every frame, not an earlier selection
+    if joint:
+        hashes = np.concatenate([hash_fn(stage.crops[key_name], hash_size) for key_name in key_names], axis=1)
+        labels = ["|".join(str(label) for label in per_key) for per_key in zip(*(stage.samples(key_name)[1] for key_name in key_names))]
+        rows = dedup_indices(hashes, labels, max_distance, keep_per_cluster, segments=len(key_names))
+        for key_name in key_names:
+            stage.rows[key_name] = rows
+            report[key_name] = (len(labels), len(rows))
+    else:
+        for key_name in key_names:
+            crops, labels = stage.samples(key_name)
+            rows = dedup_indices(hash_fn(crops, hash_size), labels, max_distance, keep_per_cluster)
+            stage.rows[key_name] = rows
+            report[key_name] = (len(labels), len(rows))
+
+    for key_name, (before, after) in sorted(report.items()):
+        reduction = 100.0 * (1 - after / max(before, 1))
+        print(f"[INFO] Dedup '{key_name}': {before} -> {after} frames ({reduction:.0f}% fewer)")
+    return report
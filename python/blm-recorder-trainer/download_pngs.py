@@ -2,6 +2,9 @@ import os
 import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin
+import argparse
+
+from profiling import timed, ProfileSession, add_profiling_args
 
 # Set the base URL of your web server
 BASE_URL = "http://192.168.5.159:8080/"  # Change this to your actual server URL
@@ -47,7 +50,8 @@ def download_file(url, folder):
         print(f"Failed to download: {url}")
 
 def main():
-    all_files = get_all_files()
+    with timed("list"):
+        all_files = get_all_files()
 
     if not all_files:
         print("No files found.")
@@ -56,9 +60,15 @@ def main():
     print(f"Found {len(all_files)} files. Downloading...")
 
     for url in all_files:
-        download_file(url, DOWNLOAD_FOLDER)
+        with timed("download"):
+            download_file(url, DOWNLOAD_FOLDER)
 
     print("All downloads complete!")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    add_profiling_args(parser)
+    args = parser.parse_args()
+
+    with ProfileSession.from_args("download_pngs", args):
+        main()
@@ -0,0 +1,173 @@
+# golden_eval.py
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+
+from golden_set import GOLDEN_DIR, load_golden_set, git_commit
+from key_inference import BACKENDS
+from auto_annotator import AutoAnnotator, KEYS
+from screen_gate import SCREEN_GATE_NAME
+
+BENCH_DIR = "./bench"
+
+# Default regression thresholds against a baseline run
+MAX_ACCURACY_DROP = 0.0
+MAX_THROUGHPUT_DROP = 0.2
+
+
+def score(golden, predicted):
+    """
+    Compares predicted records to the golden set's expected ones. Every field of an
+    expected record (the screen and each direction key) is one label; a key missing from
+    the prediction (e.g. because the screen was misread) counts as wrong.
+    Returns { field: {"correct", "total", "accuracy"} }, "overall" and the mismatches.
+    """
+    fields = {}
+    mismatches = []
+    for filename, expected in golden:
+        record = predicted.get(filename, {})
+        for field, label in expected.items():
+            if field == "filename":
+                continue
+            counts = fields.setdefault(field, {"correct": 0, "total": 0})
+            counts["total"] += 1
+            if record.get(field) == label:
+                counts["correct"] += 1
+            else:
+                mismatches.append({"filename": filename, "field": field, "expected": label, "predicted": record.get(field)})
+
+    correct = sum(counts["correct"] for counts in fields.values())
+    total = sum(counts["total"] for counts in fields.values())
+    fields["overall"] = {"correct": correct, "total": total}
+    for counts in fields.values():
+        counts["accuracy"] = counts["correct"] / counts["total"] if counts["total"] else None
+    return fields, mismatches
+
+
+def regressions(results, baseline, max_accuracy_drop=MAX_ACCURACY_DROP, max_throughput_drop=MAX_THROUGHPUT_DROP):
+    """
+    Returns a message for every field whose accuracy dropped more than max_accuracy_drop
+    below the baseline's, and for images/sec more than max_throughput_drop (a fraction) below it.
+    """
+    failures = []
+    for field, counts in results["accuracy"].items():
+        before = baseline.get("accuracy", {}).get(field, {}).get("accuracy")
+        if before is not None and counts["accuracy"] is not None and counts["accuracy"] < before - max_accuracy_drop:
+            failures.append(f"{field} accuracy {counts['accuracy']:.4f} < baseline {before:.4f}")
+
+    before = baseline.get("images_per_sec")
+    if before and results["images_per_sec"] < before * (1.0 - max_throughput_drop):
+        failures.append(f"throughput {results['images_per_sec']:.1f} images/sec is more than "
+                        f"{100 * max_throughput_drop:.0f}% below baseline {before:.1f}")
+    return failures
+
+
+def main(model_version, backend="keras", gate=None, repetitions=5, batch_size=64, workers=None, golden_dir=GOLDEN_DIR,
+         baseline=None, min_accuracy=None, max_accuracy_drop=MAX_ACCURACY_DROP, max_throughput_drop=MAX_THROUGHPUT_DROP,
+         output=None):
+    """
+    Annotates the golden set with the models of model_version, scores the labels against
+    the ground truth and times the pipeline. Returns (results, failures); failures lists
+    every threshold the run broke.
+    """
+    model_dir = os.path.join("./models", model_version)
+    if gate is None:
+        gate = os.path.isfile(os.path.join(model_dir, f"{SCREEN_GATE_NAME}.npz"))
+    golden = load_golden_set(golden_dir)
+    if not golden:
+        raise FileNotFoundError(f"No golden PNG/JSON pairs in {golden_dir}")
+    filenames = [filename for filename, _ in golden]
+
+    annotator = AutoAnnotator(KEYS, model_dir, gate=gate, backend=backend)
+    predicted = annotator.annotate_files(golden_dir, filenames, workers=workers, batch_size=batch_size)  # also warms up
+
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        annotator.annotate_files(golden_dir, filenames, workers=workers, batch_size=batch_size)
+    seconds = time.perf_counter() - start
+    accuracy, mismatches = score(golden, predicted)
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": sys.version.split()[0],
+        "cpu_count": os.cpu_count(),
+        "config": {
+            "model": model_version,
+            "backend": backend,
+            "gate": gate,
+            "images": len(golden),
+            "repetitions": repetitions,
+            "batch_size": batch_size
+        },
+        "accuracy": accuracy,
+        "images_per_sec": len(golden) * repetitions / max(seconds, 1e-9),
+        "mismatches": mismatches
+    }
+
+    failures = []
+    if min_accuracy is not None and accuracy["overall"]["accuracy"] < min_accuracy:
+        failures.append(f"overall accuracy {accuracy['overall']['accuracy']:.4f} < {min_accuracy:.4f}")
+    if baseline:
+        with open(baseline, "r", encoding="utf-8") as f:
+            failures += regressions(results, json.load(f), max_accuracy_drop, max_throughput_drop)
+    results["failures"] = failures
+
+    output = output or os.path.join(BENCH_DIR, f"golden-{results['commit'] or 'unknown'}-{model_version}-{backend}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"[INFO] Golden set ({len(golden)} images, {model_version}, {backend}{', gate' if gate else ''}):")
+    for field, counts in sorted(accuracy.items()):
+        print(f"  {field:<22} {counts['correct']:>4}/{counts['total']:<4} {100 * counts['accuracy']:>6.1f}%")
+    print(f"  {results['images_per_sec']:.1f} images/sec")
+    for mismatch in mismatches:
+        print(f"  {mismatch['filename']}: {mismatch['field']} expected {mismatch['expected']}, got {mismatch['predicted']}")
+    print(f"[INFO] Results saved to {output}")
+    return results, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, required=True, help="Model version to evaluate (i.e. 'v3').")
+    parser.add_argument("--backend", choices=BACKENDS, default="keras", help="Inference backend.")
+    parser.add_argument("--gate", dest="gate", action="store_true", default=None,
+                        help="Use the screen gate (default: if the model version has one).")
+    parser.add_argument("--no-gate", dest="gate", action="store_false", help="Read the screen from the key models.")
+    parser.add_argument("--repetitions", type=int, default=5, help="Timed passes over the golden set.")
+    parser.add_argument("--batch-size", type=int, default=64, help="Images per model forward pass.")
+    parser.add_argument("--workers", type=int, default=None, help="Decode threads (default: CPU count).")
+    parser.add_argument("--golden-dir", type=str, default=GOLDEN_DIR, help="Folder of golden PNG/JSON pairs.")
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier results JSON to check for regressions.")
+    parser.add_argument("--min-accuracy", type=float, default=None, help="Fail if overall accuracy is below this.")
+    parser.add_argument("--max-accuracy-drop", type=float, default=MAX_ACCURACY_DROP,
+                        help="Fail if any accuracy is more than this below the baseline's.")
+    parser.add_argument("--max-throughput-drop", type=float, default=MAX_THROUGHPUT_DROP,
+                        help="Fail if images/sec is more than this fraction below the baseline's.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Results JSON (default: bench/golden-<commit>-<model>-<backend>.json).")
+    args = parser.parse_args()
+
+    _, failures = main(
+        args.model,
+        backend=args.backend,
+        gate=args.gate,
+        repetitions=args.repetitions,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        golden_dir=args.golden_dir,
+        baseline=args.baseline,
+        min_accuracy=args.min_accuracy,
+        max_accuracy_drop=args.max_accuracy_drop,
+        max_throughput_drop=args.max_throughput_drop,
+        output=args.output
+    )
+    for failure in failures:
+        print(f"[ERROR] {failure}")
+    sys.exit(1 if failures else 0)
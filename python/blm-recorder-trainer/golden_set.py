@@ -0,0 +1,72 @@
+# golden_set.py
+
+import os
+import json
+import subprocess
+
+# PNG/JSON pairs the Xcode tests check the app's screen reader against
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "BLM-recorder-tests", "test_images")
+
+# Labels the ground truth implies, as (value field, label if negative, label if positive).
+# A value of 0 is shown without a direction ("None"). Same sign convention as the Xcode
+# tests' translateDirection.
+BALL_DIRECTIONS = {
+    "hla-direction": ("HLA", "L", "R"),
+    "spin-axis-direction": ("SpinAxis", "L", "R"),
+}
+CLUB_DIRECTIONS = {
+    "path-direction": ("Path", "OUT-IN", "IN-OUT"),
+    "aoa-direction": ("AngleOfAttack", "DOWN", "UP"),
+}
+
+
+def direction_label(value, negative, positive):
+    if value < 0:
+        return negative
+    if value > 0:
+        return positive
+    return "None"
+
+
+def load_golden_set(golden_dir=GOLDEN_DIR):
+    """
+    Returns [(png filename, expected record), ...] for every PNG with a JSON next to it.
+    The record has the annotation format ({"filename", "screen", key: label}) with the
+    screen taken from the '-ball' / '-club' file name suffix and every direction key the
+    ground truth determines. Units aren't part of the ground truth, so they're left out.
+    """
+    golden = []
+    for filename in sorted(os.listdir(golden_dir)):
+        base, ext = os.path.splitext(filename)
+        json_path = os.path.join(golden_dir, base + ".json")
+        if ext.lower() != ".png" or not os.path.isfile(json_path):
+            continue
+        with open(json_path, "r", encoding="utf-8") as f:
+            truth = json.load(f)
+
+        if base.endswith("-ball"):
+            screen, directions = "Ball", BALL_DIRECTIONS
+        elif base.endswith("-club"):
+            screen, directions = "Club", CLUB_DIRECTIONS
+        else:
+            print(f"[WARN] Skipping {filename}: name doesn't end in '-ball' or '-club'")
+            continue
+
+        record = {"filename": filename, "screen": screen}
+        for key_name, (field, negative, positive) in directions.items():
+            record[key_name] = direction_label(truth[field], negative, positive)
+        golden.append((filename, record))
+    return golden
+
+
+def git_commit():
+    """
+    Short hash of the checked out commit, to tag benchmark and evaluation results. None outside git.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
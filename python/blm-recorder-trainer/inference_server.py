@@ -0,0 +1,400 @@
+# inference_server.py
+
+import os
+import json
+import time
+import queue
+import threading
+import urllib.parse
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import cv2
+import argparse
+
+from key_inference import KeyInference, BACKENDS
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MODELS_DIR = "./models"
+
+
+def load_version(model_path, backend="keras", collect_stats=False):
+    """
+    Loads a KeyInference for every single-key model (<key>.h5 + sidecar) in a models/vX folder.
+    Returns { key_name: KeyInference }.
+    """
+    classifiers = {}
+    for filename in sorted(os.listdir(model_path)):
+        if not filename.endswith(".h5"):
+            continue
+        sidecar_path = os.path.join(model_path, os.path.splitext(filename)[0] + ".json")
+        if not os.path.isfile(sidecar_path):
+            continue
+        with open(sidecar_path, "r", encoding="utf-8") as f:
+            if "key_name" not in json.load(f):
+                continue  # multi-head or other non-key models
+        classifier = KeyInference(os.path.join(model_path, filename), backend=backend, collect_stats=collect_stats)
+        classifiers[classifier.key_name] = classifier
+    if not classifiers:
+        raise FileNotFoundError(f"No key models found in {model_path}")
+    return classifiers
+
+
+class ModelRegistry:
+    """
+    Keeps one or more model versions loaded and tracks which one serves requests by default.
+
+    Loading a version happens outside the lock and only the final swap is locked, so requests
+    keep being served by the old models while a new version warms up, and requests already
+    in flight finish on the models they started with.
+
+    Args:
+        models_dir (str): Folder holding the vX model folders.
+        backend (str): "keras" or "numpy", see KeyInference.
+        collect_stats (bool): Time every model's calls per phase, see KeyInference.stats().
+    """
+
+    def __init__(self, models_dir=MODELS_DIR, backend="keras", collect_stats=True):
+        self.models_dir = models_dir
+        self.backend = backend
+        self.collect_stats = collect_stats
+        self.versions = {}  # version -> { key_name: KeyInference }
+        self.default_version = None
+        self.lock = threading.Lock()
+
+    def load(self, version, make_default=True, unload_previous=False):
+        start = time.perf_counter()
+        classifiers = load_version(os.path.join(self.models_dir, version), self.backend, self.collect_stats)
+        with self.lock:
+            previous = self.default_version
+            self.versions[version] = classifiers
+            if make_default or self.default_version is None:
+                self.default_version = version
+            if unload_previous and previous not in (None, version):
+                self.versions.pop(previous, None)
+        print(f"[INFO] Loaded model version {version} ({len(classifiers)} keys) in {time.perf_counter() - start:.2f}s")
+        return sorted(classifiers)
+
+    def get(self, version=None):
+        """
+        Returns (version, { key_name: KeyInference }) for version, or for the default version.
+        """
+        with self.lock:
+            version = version or self.default_version
+            if version not in self.versions:
+                raise KeyError(f"Model version '{version}' is not loaded")
+            return version, self.versions[version]
+
+    def describe(self):
+        with self.lock:
+            return {
+                "default": self.default_version,
+                "backend": self.backend,
+                "loaded": {version: sorted(classifiers) for version, classifiers in self.versions.items()}
+            }
+
+    def stats(self, reset=False):
+        """
+        Returns { version: { key_name: KeyInference.stats() } } for every loaded version,
+        then starts counting from zero again if reset.
+        """
+        with self.lock:
+            versions = dict(self.versions)
+        stats = {}
+        for version, classifiers in versions.items():
+            stats[version] = {key_name: classifier.stats() for key_name, classifier in classifiers.items()}
+            if reset:
+                for classifier in classifiers.values():
+                    classifier.reset_stats()
+        return stats
+
+
+class _Request:
+    def __init__(self, classifiers, inputs_list):
+        self.classifiers = classifiers
+        self.inputs_list = inputs_list  # one { key_name: preprocessed crop } per image
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Single worker thread that merges concurrent requests into one forward pass per key.
+
+    The worker waits for a request, then keeps collecting more for up to max_wait_ms (or
+    until max_batch images are queued) before running the models, so many small requests
+    from different clients share a batch instead of each paying for its own forward pass.
+
+    Args:
+        max_batch (int): Max images per forward pass.
+        max_wait_ms (float): How long to wait for more requests once one is queued.
+    """
+
+    def __init__(self, max_batch=64, max_wait_ms=5.0):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, classifiers, inputs_list):
+        """
+        Blocks until inputs_list has been run through classifiers and returns one
+        { key_name: {"label", "confidence"} } dict per image. classifiers is the whole
+        { key_name: KeyInference } dict of a loaded version, so concurrent requests for it
+        are batched together; each image is only run through the keys of its inputs.
+        """
+        request = _Request(classifiers, inputs_list)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            num_images = len(batch[0].inputs_list)
+            deadline = time.perf_counter() + self.max_wait
+            while num_images < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                num_images += len(request.inputs_list)
+
+            # Requests for the same loaded model version are run together, whichever keys
+            # they asked for (see _predict)
+            groups = {}
+            for request in batch:
+                groups.setdefault(id(request.classifiers), []).append(request)
+            for requests in groups.values():
+                try:
+                    self._predict(requests)
+                except Exception as e:
+                    for request in requests:
+                        request.error = e
+                for request in requests:
+                    request.done.set()
+
+    def _predict(self, requests):
+        classifiers = requests[0].classifiers
+        rows = [(request, i) for request in requests for i in range(len(request.inputs_list))]
+        for request in requests:
+            request.results = [{} for _ in request.inputs_list]
+
+        for key_name, classifier in classifiers.items():
+            key_rows = [(request, i) for request, i in rows if key_name in request.inputs_list[i]]
+            if not key_rows:
+                continue
+            labels, probs = classifier.predict_arrays(
+                np.stack([request.inputs_list[i][key_name] for request, i in key_rows])
+            )
+            for (request, i), label, p in zip(key_rows, labels, probs):
+                request.results[i][key_name] = {"label": label, "confidence": float(p.max())}
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """
+    Localhost HTTP server that keeps key models warm and answers prediction requests.
+
+    Endpoints:
+        POST /predict  JSON {"paths": [...], "version": "vX" (optional), "keys": [...] (optional)},
+                       or a raw PNG/JPEG body (Content-Type: image/png) with ?version=vX.
+                       Returns {"version", "results": [{"path", "labels": {key: {"label", "confidence"}}}]}.
+        GET  /models   Loaded versions and the default one.
+        GET  /stats    Per version and key: calls, time per phase and latency histogram
+                       (see KeyInference.stats()); ?reset=1 also zeroes them.
+        POST /load     JSON {"version": "vY", "default": true, "unload_previous": false}:
+                       loads (or reloads) a version and optionally makes it the default.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128  # the default backlog of 5 stalls bursts of concurrent clients
+
+    def __init__(self, address, registry, batcher):
+        super().__init__(address, InferenceRequestHandler)
+        self.registry = registry
+        self.batcher = batcher
+
+    def predict_images(self, images, version=None, keys=None):
+        """
+        Preprocesses decoded BGR images (None for unreadable ones) on the calling thread
+        and runs them through the micro-batcher. Returns (version, results).
+        """
+        version, classifiers = self.registry.get(version)
+        key_names = [key_name for key_name in classifiers if keys is None or key_name in keys]
+
+        inputs_list = []
+        for img in images:
+            if img is None:
+                inputs_list.append({})
+                continue
+            inputs_list.append({
+                key_name: classifiers[key_name].preprocess_image(img)
+                for key_name in key_names
+            })
+        return version, self.batcher.submit(classifiers, inputs_list)
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _route(self):
+        return urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+
+    def _query(self):
+        """
+        The URL's query parameters, decoded, with the last value of repeated ones.
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        return {name: values[-1] for name, values in query.items()}
+
+    def do_GET(self):
+        route = self._route()
+        try:
+            if route == "/models":
+                self._send_json(self.server.registry.describe())
+            elif route == "/stats":
+                reset = self._query().get("reset") in ("1", "true")
+                self._send_json({"backend": self.server.registry.backend, "versions": self.server.registry.stats(reset)})
+            else:
+                self._send_json({"error": f"Unknown endpoint {route}"}, status=404)
+        except Exception as e:
+            self._send_json({"error": f"{type(e).__name__}: {e}"}, status=500)
+
+    def do_POST(self):
+        route = self._route()
+        try:
+            if route == "/predict":
+                self._predict()
+            elif route == "/load":
+                request = json.loads(self._read_body() or b"{}")
+                keys = self.server.registry.load(
+                    request["version"],
+                    make_default=request.get("default", True),
+                    unload_previous=request.get("unload_previous", False)
+                )
+                self._send_json({"version": request["version"], "keys": keys, **self.server.registry.describe()})
+            else:
+                self._send_json({"error": f"Unknown endpoint {route}"}, status=404)
+        except (KeyError, ValueError, FileNotFoundError) as e:
+            self._send_json({"error": str(e)}, status=400)
+        except Exception as e:
+            # Anything else is a server bug or a broken model, still answer in JSON
+            self._send_json({"error": f"{type(e).__name__}: {e}"}, status=500)
+
+    def _predict(self):
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("image/"):
+            buffer = np.frombuffer(self._read_body(), dtype=np.uint8)
+            images = [cv2.imdecode(buffer, cv2.IMREAD_COLOR)]
+            paths = [None]
+            version = self._query().get("version")
+            keys = None
+        else:
+            request = json.loads(self._read_body() or b"{}")
+            paths = request["paths"]
+            images = [cv2.imread(path, cv2.IMREAD_COLOR) for path in paths]
+            version = request.get("version")
+            keys = request.get("keys")
+
+        version, results = self.server.predict_images(images, version, keys)
+        self._send_json({
+            "version": version,
+            "results": [
+                {"path": path, "labels": labels} if img is not None else {"path": path, "error": "Unreadable image"}
+                for path, img, labels in zip(paths, images, results)
+            ]
+        })
+
+    def log_message(self, format, *args):
+        pass  # keep the console for [INFO] lines
+
+
+class InferenceClient:
+    """
+    Small client for a running inference_server.py.
+
+    Args:
+        url (str): Base URL of the server, e.g. "http://127.0.0.1:8765".
+        timeout (float): Seconds to wait for each request.
+    """
+
+    def __init__(self, url=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", timeout=30.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, route, data=None, content_type="application/json"):
+        if data is not None and content_type == "application/json":
+            data = json.dumps(data).encode("utf-8")
+        request = urllib.request.Request(self.url + route, data=data, headers={"Content-Type": content_type})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def predict_files(self, paths, version=None, keys=None):
+        """
+        Returns one { key_name: {"label", "confidence"} } dict per path (None if unreadable).
+        Paths are read by the server, so they must be valid on its side.
+        """
+        request = {"paths": [os.path.abspath(path) for path in paths], "version": version, "keys": keys}
+        response = self._request("/predict", request)
+        return [result.get("labels") for result in response["results"]]
+
+    def predict_png(self, png_bytes, version=None):
+        route = "/predict" + (f"?{urllib.parse.urlencode({'version': version})}" if version else "")
+        response = self._request(route, png_bytes, content_type="image/png")
+        return response["results"][0].get("labels")
+
+    def models(self):
+        return self._request("/models")
+
+    def stats(self, reset=False):
+        return self._request("/stats" + ("?reset=1" if reset else ""))
+
+    def load(self, version, default=True, unload_previous=False):
+        return self._request("/load", {"version": version, "default": default, "unload_previous": unload_previous})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, nargs="+", required=True,
+                        help="Model version(s) to keep loaded (i.e. 'v3'); the last one is the default.")
+    parser.add_argument("--backend", choices=BACKENDS, default="keras",
+                        help="Run the key models with TensorFlow ('keras') or with plain NumPy ('numpy').")
+    parser.add_argument("--host", type=str, default=DEFAULT_HOST, help="Address to bind (localhost by default).")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port to listen on.")
+    parser.add_argument("--max-batch", type=int, default=64, help="Max images per forward pass.")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0,
+                        help="How long to wait for concurrent requests to batch together.")
+    parser.add_argument("--no-stats", action="store_true", help="Don't time model calls for GET /stats.")
+    args = parser.parse_args()
+
+    registry = ModelRegistry(MODELS_DIR, backend=args.backend, collect_stats=not args.no_stats)
+    for version in args.model:
+        registry.load(version)
+
+    server = InferenceServer((args.host, args.port), registry, MicroBatcher(args.max_batch, args.max_wait_ms))
+    print(f"[INFO] Serving {registry.describe()['loaded']} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
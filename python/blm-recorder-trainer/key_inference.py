@@ -1,10 +1,136 @@
 import os
 import json
+import time
+import threading
 import numpy as np
 from PIL import Image
 import cv2 
 
-from tensorflow.keras.models import load_model
+from numpy_backend import NumpyModel
+from dataset_pack import to_gray
+
+# Base file name of the multi-head model in a models/vX folder
+MULTI_HEAD_NAME = "multi-head"
+
+# Images per forward pass in the batched prediction API
+DEFAULT_CHUNK_SIZE = 256
+
+# "keras" runs the .h5 with TensorFlow, "numpy" runs it with numpy_backend.NumpyModel
+BACKENDS = ("keras", "numpy")
+
+# Phases timed by KeyInference(collect_stats=True): PIL RGB -> BGR conversion (which includes
+# the decode of lazily loaded PIL images), the three preprocessing steps and the forward pass
+STATS_PHASES = ("convert", "crop", "normalize", "resize", "model")
+
+# Upper bounds (ms) of the call latency histogram buckets; the last bucket is everything slower
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def load_keras_model(h5_model_path):
+    """
+    Imports TensorFlow only when a Keras model is actually needed, so the NumPy backend
+    (and CLIs that never load a model) start without paying for it.
+    """
+    from tensorflow.keras.models import load_model
+    return load_model(h5_model_path)
+
+def crop_image(img, roi):
+    """
+    Crops a BGR (or grayscale) image to the relative roi = (x, y, w, h) in [0..1].
+    """
+    # Get image dimensions
+    img_h, img_w = img.shape[:2]
+
+    # Calculate absolute pixel coordinates from the relative ROI
+    x_abs = int(roi[0] * img_w)
+    y_abs = int(roi[1] * img_h)
+    w_abs = int(roi[2] * img_w)
+    h_abs = int(roi[3] * img_h)
+
+    return img[y_abs:y_abs + h_abs-1, x_abs:x_abs + w_abs-1]
+
+def normalize_crop(cropped):
+    """
+    Converts a crop to grayscale and stretches it to the full [0, 255] range (uint8).
+    """
+    gray = to_gray(cropped)
+    return cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+def resize_crop(normalized_gray, image_size, channels=3):
+    """
+    Resizes a normalized gray crop to image_size and returns the float32
+    (H, W, channels) model input in [0, 1].
+    """
+    if channels == 1:
+        # Single-channel models take the normalized gray crop as is
+        resized = cv2.resize(normalized_gray, tuple(image_size), interpolation=cv2.INTER_CUBIC)
+        return resized[:, :, np.newaxis].astype(np.float32) / 255.0
+
+    # Convert the normalized grayscale image back to a 3-channel color image
+    cropped_normalized = cv2.cvtColor(normalized_gray, cv2.COLOR_GRAY2BGR)
+
+    # Resize using cubic interpolation
+    resized = cv2.resize(cropped_normalized, tuple(image_size), interpolation=cv2.INTER_CUBIC)
+
+    # Convert to float array and normalize to [0,1] range
+    return resized.astype(np.float32) / 255.0
+
+def preprocess_roi(img, roi, image_size, channels=3):
+    """
+    Crops a BGR (or already grayscale) image to the relative roi, normalizes it the same
+    way the training pipeline does and returns a float32 (H, W, channels) array in [0, 1].
+    """
+    return resize_crop(normalize_crop(crop_image(img, roi)), image_size, channels)
+
+class InferenceStats:
+    """
+    Cumulative call count, seconds per phase and call latency histogram of a KeyInference.
+    Safe to update from several threads; phases of concurrent calls add up.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = 0
+            self.images = 0
+            self.call_seconds = 0.0
+            self.phase_seconds = {phase: 0.0 for phase in STATS_PHASES}
+            self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add_phases(self, **seconds):
+        with self.lock:
+            for phase, value in seconds.items():
+                self.phase_seconds[phase] += value
+
+    def add_call(self, seconds, num_images):
+        with self.lock:
+            self.calls += 1
+            self.images += num_images
+            self.call_seconds += seconds
+            self.histogram[int(np.searchsorted(LATENCY_BUCKETS_MS, seconds * 1000.0))] += 1
+
+    def snapshot(self):
+        with self.lock:
+            phase_total = sum(self.phase_seconds.values())
+            return {
+                "calls": self.calls,
+                "images": self.images,
+                "call_seconds": self.call_seconds,
+                "mean_call_ms": 1000.0 * self.call_seconds / self.calls if self.calls else None,
+                "phase_seconds": dict(self.phase_seconds),
+                "phase_share": {
+                    phase: seconds / phase_total if phase_total else None
+                    for phase, seconds in self.phase_seconds.items()
+                },
+                "latency_histogram_ms": [
+                    {"le": bound, "count": count}
+                    for bound, count in zip(list(LATENCY_BUCKETS_MS) + ["+Inf"], self.histogram)
+                ]
+            }
+
 
 class KeyInference:
     """
@@ -13,10 +139,21 @@ class KeyInference:
 
     We assume:
       - The sidecar file has the same base name as h5_model_path, but with '.json' extension.
-      - The sidecar includes "roi", "key_name", "class_labels", "image_size".
+      - The sidecar includes "roi", "key_name", "class_labels", "image_size" and optionally
+        "channels" (1 for single-channel models, 3 if missing).
+
+    backend="numpy" runs the model with NumpyModel instead of TensorFlow, from the .npz
+    next to the .h5 if there is one (else the .h5 is read with h5py).
+
+    With collect_stats, every predict call is counted and timed per phase (see
+    STATS_PHASES and stats()). Preprocessing is counted per image, whichever entry point
+    it comes from; calls and their latency only for the predict_* methods.
     """
 
-    def __init__(self, h5_model_path):
+    def __init__(self, h5_model_path, backend="keras", collect_stats=False):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+
         # 1) Check that the .h5 exists
         if not os.path.isfile(h5_model_path):
             raise FileNotFoundError(f"Cannot find model at {h5_model_path}")
@@ -35,55 +172,225 @@ class KeyInference:
         self.key_name = sidecar_data.get("key_name", "")
         self.class_labels = sidecar_data.get("class_labels", [])
         self.image_size = tuple(sidecar_data.get("image_size", (64, 32)))
+        self.channels = sidecar_data.get("channels", 3)
 
-        # 5) Load the Keras model
-        self.model = load_model(h5_model_path)
+        # 5) Load the model
+        self.backend = backend
+        self._stats = InferenceStats() if collect_stats else None
+        if backend == "numpy":
+            self.model = NumpyModel.load(h5_model_path)
+        else:
+            self.model = load_keras_model(h5_model_path)
 
     def predict_class_from_image_file(self, image_path):
         pil_image = Image.open(image_path)
         return self.predict_class(pil_image)
 
     def predict_class(self, pil_image):
+        labels, _ = self.predict_batch([pil_image])
+        return labels[0]
+
+    def preprocess(self, pil_image):
+        """
+        Converts one PIL image to the model's (H, W, channels) float32 input.
+        """
+        start = time.perf_counter()
         img = np.array(pil_image)  # Convert PIL to NumPy array
         img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR) 
+        if self._stats is not None:
+            self._stats.add_phases(convert=time.perf_counter() - start)
+        return self.preprocess_image(img)
 
-        # Get image dimensions
-        img_h, img_w = img.shape[:2]
+    def preprocess_image(self, img):
+        """
+        Same as preprocess, for a BGR or grayscale NumPy image (e.g. a DatasetPack frame).
+        """
+        if self._stats is None:
+            return preprocess_roi(img, self.roi, self.image_size, self.channels)
 
-        # 1) Calculate absolute pixel coordinates from the relative ROI
-        x_abs = int(self.roi[0] * img_w)
-        y_abs = int(self.roi[1] * img_h)
-        w_abs = int(self.roi[2] * img_w)
-        h_abs = int(self.roi[3] * img_h)
+        start = time.perf_counter()
+        cropped = crop_image(img, self.roi)
+        cropped_at = time.perf_counter()
+        normalized = normalize_crop(cropped)
+        normalized_at = time.perf_counter()
+        arr = resize_crop(normalized, self.image_size, self.channels)
+        self._stats.add_phases(
+            crop=cropped_at - start,
+            normalize=normalized_at - cropped_at,
+            resize=time.perf_counter() - normalized_at
+        )
+        return arr
 
-        # 2) Crop
-        cropped = img[y_abs:y_abs + h_abs-1, x_abs:x_abs + w_abs-1]
+    def predict_batch(self, images, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Predicts many PIL images at once: all of them are preprocessed into one contiguous
+        array, which is then run through the model chunk_size images per forward pass.
 
-        gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY)
+        Returns:
+            labels (list[str]): Predicted label per image ("Unknown" if out of range).
+            probabilities (np.ndarray): (N, num_classes) softmax output.
+        """
+        start = time.perf_counter()
+        width, height = self.image_size
+        arr = np.empty((len(images), height, width, self.channels), dtype=np.float32)
+        for i, pil_image in enumerate(images):
+            arr[i] = self.preprocess(pil_image)
+        result = self._run_model(arr, chunk_size)
+        self._record_call(start, len(images))
+        return result
 
-        # Normalize the grayscale image to range [0, 255]
-        normalized_gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX)
+    def predict_files(self, image_paths, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Same as predict_batch, but loads the images from disk one at a time while
+        preprocessing, so only the small model inputs are held in memory.
+        """
+        start = time.perf_counter()
+        width, height = self.image_size
+        arr = np.empty((len(image_paths), height, width, self.channels), dtype=np.float32)
+        for i, image_path in enumerate(image_paths):
+            with Image.open(image_path) as pil_image:
+                arr[i] = self.preprocess(pil_image)
+        result = self._run_model(arr, chunk_size)
+        self._record_call(start, len(image_paths))
+        return result
 
-        # Convert the normalized grayscale image back to a 3-channel color image
-        cropped_normalized = cv2.cvtColor(normalized_gray.astype(np.uint8), cv2.COLOR_GRAY2BGR)
+    def predict_arrays(self, arr, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Runs already preprocessed (N, H, W, channels) inputs through the model. The compiled model
+        is called directly per chunk, which skips the per-call setup of model.predict().
+        """
+        start = time.perf_counter()
+        result = self._run_model(arr, chunk_size)
+        self._record_call(start, len(arr))
+        return result
 
-        # 3) Resize using cubic interpolation
-        resized = cv2.resize(cropped_normalized, self.image_size, interpolation=cv2.INTER_CUBIC)
+    def _run_model(self, arr, chunk_size):
+        if len(arr) == 0:
+            return [], np.zeros((0, len(self.class_labels)), dtype=np.float32)
 
-        # 4) Convert to float array and normalize to [0,1] range
-        arr = resized.astype(np.float32) / 255.0
+        model_start = time.perf_counter()
+        probabilities = np.concatenate([
+            np.asarray(self.model(arr[start:start + chunk_size], training=False))
+            for start in range(0, len(arr), chunk_size)
+        ])
+        if self._stats is not None:
+            self._stats.add_phases(model=time.perf_counter() - model_start)
 
-        # 5) Expand dimensions to make it (1, H, W, C) for model input
-        arr = np.expand_dims(arr, axis=0)
+        # Map index to label
+        labels = [
+            self.class_labels[idx] if idx < len(self.class_labels) else "Unknown"
+            for idx in np.argmax(probabilities, axis=1)
+        ]
+        return labels, probabilities
 
-        # 5) Run inference
-        preds = self.model.predict(arr)
-        idx = np.argmax(preds[0])
-        # 6) Map index to label
-        if idx < len(self.class_labels):
-            return self.class_labels[idx]
-        else:
-            return "Unknown"
+    def _record_call(self, start, num_images):
+        if self._stats is not None:
+            self._stats.add_call(time.perf_counter() - start, num_images)
+
+    def stats(self):
+        """
+        Returns the cumulative stats since loading (or the last reset_stats()): "calls",
+        "images", "call_seconds", "mean_call_ms", seconds and share of time per phase
+        ("phase_seconds", "phase_share") and "latency_histogram_ms" as
+        [{"le": upper bound in ms, "count": calls}, ...]. None without collect_stats.
+        """
+        return self._stats.snapshot() if self._stats is not None else None
+
+    def reset_stats(self):
+        if self._stats is not None:
+            self._stats.reset()
 
     def __repr__(self):
         return f"<KeyInference key='{self.key_name}', roi={self.roi}, model={self.model.name}>"
+
+
+class MultiKeyInference:
+    """
+    Loads a multi-head Keras .h5 model (see MultiKeyClassifier) and its sidecar JSON, and
+    returns the labels of every key it covers from a single forward pass.
+
+    The sidecar has "multi_head": true, "image_size", and per key in "keys" its
+    "roi", "class_labels", "input" and "output" names.
+    """
+
+    def __init__(self, h5_model_path):
+        if not os.path.isfile(h5_model_path):
+            raise FileNotFoundError(f"Cannot find model at {h5_model_path}")
+
+        sidecar_path = os.path.splitext(h5_model_path)[0] + ".json"
+        if not os.path.isfile(sidecar_path):
+            raise FileNotFoundError(f"Cannot find sidecar JSON at {sidecar_path}")
+
+        with open(sidecar_path, "r", encoding="utf-8") as f:
+            sidecar_data = json.load(f)
+        if not sidecar_data.get("multi_head"):
+            raise ValueError(f"{sidecar_path} does not describe a multi-head model")
+
+        self.image_size = tuple(sidecar_data.get("image_size", (64, 32)))
+        self.channels = sidecar_data.get("channels", 3)
+        self.keys = sidecar_data["keys"]
+        for key_info in self.keys.values():
+            key_info["roi"] = tuple(key_info.get("roi") or (0, 0, 1, 1))
+
+        self.model = load_keras_model(h5_model_path)
+        self.output_names = list(self.model.output_names)
+
+    def predict_all_from_image_file(self, image_path):
+        pil_image = Image.open(image_path)
+        return self.predict_all(pil_image)
+
+    def predict_all(self, pil_image):
+        """
+        Returns { key_name: label } for every key of the model.
+        """
+        inputs = self.preprocess(pil_image)
+        labels = self.predict_arrays({key_name: np.expand_dims(arr, axis=0) for key_name, arr in inputs.items()})
+        return {key_name: key_labels[0] for key_name, key_labels in labels.items()}
+
+    def preprocess(self, pil_image):
+        """
+        Returns { key_name: (H, W, channels) float32 model input } for one PIL image.
+        """
+        img = np.array(pil_image)
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        return self.preprocess_image(img)
+
+    def preprocess_image(self, img):
+        """
+        Same as preprocess, for a BGR or grayscale NumPy image (e.g. a DatasetPack frame).
+        """
+        return {
+            key_name: preprocess_roi(img, key_info["roi"], self.image_size, self.channels)
+            for key_name, key_info in self.keys.items()
+        }
+
+    def predict_arrays(self, inputs, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Runs { key_name: (N, H, W, channels) } preprocessed inputs through the model, each key's
+        crop fed to its own named input, and returns { key_name: [label per image] }.
+        """
+        num_images = len(next(iter(inputs.values())))
+        probabilities = {key_name: [] for key_name in self.keys}
+        for start in range(0, num_images, chunk_size):
+            chunk = {
+                self.keys[key_name]["input"]: arr[start:start + chunk_size]
+                for key_name, arr in inputs.items()
+            }
+            preds = self.model(chunk, training=False)
+            if not isinstance(preds, (list, tuple)):
+                preds = [preds]
+            preds_by_output = dict(zip(self.output_names, preds))
+            for key_name, key_info in self.keys.items():
+                probabilities[key_name].append(np.asarray(preds_by_output[key_info["output"]]))
+
+        labels = {}
+        for key_name, key_info in self.keys.items():
+            class_labels = key_info["class_labels"]
+            labels[key_name] = [
+                class_labels[idx] if idx < len(class_labels) else "Unknown"
+                for idx in np.argmax(np.concatenate(probabilities[key_name]), axis=1)
+            ]
+        return labels
+
+    def __repr__(self):
+        return f"<MultiKeyInference keys={sorted(self.keys)}, model={self.model.name}>"
@@ -0,0 +1,228 @@
+# numpy_backend.py
+
+import os
+import sys
+import json
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def _activation(x, name):
+    if name in (None, "linear"):
+        return x
+    if name == "relu":
+        return np.maximum(x, 0, out=x)
+    if name == "softmax":
+        x = x - x.max(axis=-1, keepdims=True)
+        np.exp(x, out=x)
+        x /= x.sum(axis=-1, keepdims=True)
+        return x
+    if name == "sigmoid":
+        return 1.0 / (1.0 + np.exp(-x))
+    if name == "tanh":
+        return np.tanh(x)
+    raise ValueError(f"Unsupported activation '{name}'")
+
+
+def _pad_same(x, kernel_size, strides, value=0.0):
+    """
+    Pads (N, H, W, C) the way Keras does for padding='same' (half of the padding before,
+    the rest after), with zeros or value (-inf for max pooling).
+    """
+    pads = []
+    for size, k, s in zip(x.shape[1:3], kernel_size, strides):
+        out = -(-size // s)
+        total = max((out - 1) * s + k - size, 0)
+        pads.append((total // 2, total - total // 2))
+    return np.pad(x, ((0, 0), pads[0], pads[1], (0, 0)), constant_values=value)
+
+
+def _windows(x, window, strides, padding, pad_value=0.0):
+    """
+    (N, H, W, C) -> (N, H', W', C, kh, kw) strided view of every window.
+    """
+    if padding == "same":
+        x = _pad_same(x, window, strides, pad_value)
+    view = sliding_window_view(x, window, axis=(1, 2))
+    return view[:, ::strides[0], ::strides[1]]
+
+
+def _conv2d(x, config, weights):
+    kernel = weights[0]  # (kh, kw, in_channels, out_channels)
+    windows = _windows(x, kernel.shape[:2], tuple(config.get("strides", (1, 1))), config.get("padding", "valid"))
+    out = np.tensordot(windows, kernel, axes=([4, 5, 3], [0, 1, 2]))
+    if config.get("use_bias", True):
+        out += weights[1]
+    return _activation(out, config.get("activation"))
+
+
+def _depthwise_conv2d(x, config, weights):
+    kernel = weights[0]  # (kh, kw, in_channels, depth_multiplier)
+    windows = _windows(x, kernel.shape[:2], tuple(config.get("strides", (1, 1))), config.get("padding", "valid"))
+    out = np.einsum("nhwcij,ijcm->nhwcm", windows, kernel, optimize=True)
+    out = out.reshape(out.shape[:3] + (-1,))
+    if config.get("use_bias", True):
+        out += weights[1]
+    return _activation(out, config.get("activation"))
+
+
+def _separable_conv2d(x, config, weights):
+    depthwise_kernel, pointwise_kernel = weights[0], weights[1]  # (kh, kw, in, mult), (1, 1, in * mult, out)
+    windows = _windows(x, depthwise_kernel.shape[:2], tuple(config.get("strides", (1, 1))), config.get("padding", "valid"))
+    out = np.einsum("nhwcij,ijcm->nhwcm", windows, depthwise_kernel, optimize=True)
+    out = out.reshape(out.shape[:3] + (-1,)) @ pointwise_kernel[0, 0]
+    if config.get("use_bias", True):
+        out += weights[2]
+    return _activation(out, config.get("activation"))
+
+
+def _max_pooling2d(x, config, weights):
+    pool_size = tuple(config.get("pool_size", (2, 2)))
+    strides = tuple(config.get("strides") or pool_size)
+    padding = config.get("padding", "valid")
+    if padding == "valid" and strides == pool_size:
+        # Non-overlapping pools: a reshape + max is much cheaper than windows
+        n, h, w, c = x.shape
+        ho, wo = h // pool_size[0], w // pool_size[1]
+        x = x[:, :ho * pool_size[0], :wo * pool_size[1]]
+        return x.reshape(n, ho, pool_size[0], wo, pool_size[1], c).max(axis=(2, 4))
+    return _windows(x, pool_size, strides, padding, pad_value=-np.inf).max(axis=(4, 5))
+
+
+def _dense(x, config, weights):
+    out = x @ weights[0]
+    if config.get("use_bias", True):
+        out += weights[1]
+    return _activation(out, config.get("activation"))
+
+
+def _batch_normalization(x, config, weights):
+    weights = list(weights)
+    gamma = weights.pop(0) if config.get("scale", True) else 1.0
+    beta = weights.pop(0) if config.get("center", True) else 0.0
+    mean, variance = weights
+    return (x - mean) / np.sqrt(variance + config.get("epsilon", 1e-3)) * gamma + beta
+
+
+LAYERS = {
+    "InputLayer": lambda x, config, weights: x,
+    "Dropout": lambda x, config, weights: x,
+    "Flatten": lambda x, config, weights: x.reshape(len(x), -1),
+    "Activation": lambda x, config, weights: _activation(x, config.get("activation")),
+    "Rescaling": lambda x, config, weights: x * config["scale"] + config.get("offset", 0.0),
+    "GlobalAveragePooling2D": lambda x, config, weights: x.mean(axis=(1, 2)),
+    "Conv2D": _conv2d,
+    "DepthwiseConv2D": _depthwise_conv2d,
+    "SeparableConv2D": _separable_conv2d,
+    "MaxPooling2D": _max_pooling2d,
+    "Dense": _dense,
+    "BatchNormalization": _batch_normalization,
+}
+
+
+class NumpyModel:
+    """
+    TensorFlow-free forward pass for the small Sequential key classifiers, in vectorized
+    NumPy. It reads the layer configs and weights either from a compact .npz (written by
+    export_npz next to the .h5) or straight from the Keras .h5 file via h5py, and is
+    called like a Keras model: model(batch) -> softmax probabilities.
+
+    Supports InputLayer, Conv2D, DepthwiseConv2D, SeparableConv2D, MaxPooling2D, GlobalAveragePooling2D,
+    BatchNormalization, Flatten, Dense, Dropout, Activation and Rescaling.
+    """
+
+    def __init__(self, layers, name="numpy_model"):
+        for class_name, _, _ in layers:
+            if class_name not in LAYERS:
+                raise ValueError(f"NumpyModel does not support layer type '{class_name}'")
+        self.layers = layers  # [(class_name, config, [weights...]), ...]
+        self.name = name
+
+    @classmethod
+    def load(cls, model_path):
+        """
+        Loads '<name>.npz' if it exists next to model_path, else reads the .h5 itself.
+        """
+        npz_path = os.path.splitext(model_path)[0] + ".npz"
+        if os.path.isfile(npz_path):
+            return cls.from_npz(npz_path)
+        return cls.from_h5(model_path)
+
+    @classmethod
+    def from_npz(cls, npz_path):
+        with np.load(npz_path) as data:
+            meta = json.loads(str(data["meta"]))
+            layers = [
+                (layer["class_name"], layer["config"],
+                 [data[f"layer{i}_weight{j}"] for j in range(layer["num_weights"])])
+                for i, layer in enumerate(meta["layers"])
+            ]
+        return cls(layers, name=meta.get("name", "numpy_model"))
+
+    @classmethod
+    def from_h5(cls, h5_path):
+        """
+        Reads a Keras (TF 2.x) Sequential .h5 file with h5py, without TensorFlow.
+        """
+        import h5py
+
+        with h5py.File(h5_path, "r") as f:
+            model_config = f.attrs["model_config"]
+            if isinstance(model_config, bytes):
+                model_config = model_config.decode("utf-8")
+            model_config = json.loads(model_config)
+            if model_config["class_name"] != "Sequential":
+                raise ValueError(f"NumpyModel only supports Sequential models, got {model_config['class_name']}")
+
+            weights_group = f["model_weights"]
+            layers = []
+            for layer in model_config["config"]["layers"]:
+                config = layer["config"]
+                weights = []
+                if config["name"] in weights_group:
+                    layer_group = weights_group[config["name"]]
+                    for weight_name in layer_group.attrs.get("weight_names", []):
+                        if isinstance(weight_name, bytes):
+                            weight_name = weight_name.decode("utf-8")
+                        weights.append(np.asarray(layer_group[weight_name]))
+                layers.append((layer["class_name"], config, weights))
+        return cls(layers, name=model_config["config"].get("name", "numpy_model"))
+
+    def __call__(self, x, training=False):
+        x = np.asarray(x, dtype=np.float32)
+        for class_name, config, weights in self.layers:
+            x = LAYERS[class_name](x, config, weights)
+        return x
+
+    def predict(self, x, verbose=0):
+        return self(x)
+
+
+def save_npz(npz_path, layers, name="numpy_model"):
+    """
+    Writes [(class_name, config, [weights...]), ...] to a compact .npz that NumpyModel
+    can load without TensorFlow or h5py.
+    """
+    meta = {"name": name, "layers": []}
+    arrays = {}
+    for i, (class_name, config, weights) in enumerate(layers):
+        meta["layers"].append({"class_name": class_name, "config": config, "num_weights": len(weights)})
+        for j, weight in enumerate(weights):
+            arrays[f"layer{i}_weight{j}"] = np.asarray(weight)
+    np.savez(npz_path, meta=np.array(json.dumps(meta, default=str)), **arrays)
+    print(f"[INFO] Saved NumPy weights to {npz_path}")
+
+
+def export_npz(model, npz_path):
+    """
+    Exports a trained Keras Sequential model for the NumPy backend.
+    """
+    layers = [(layer.__class__.__name__, layer.get_config(), layer.get_weights()) for layer in model.layers]
+    save_npz(npz_path, layers, name=model.name)
+
+
+if __name__ == "__main__":
+    # Convert existing .h5 models to .npz, e.g. python numpy_backend.py models/v3/*.h5
+    for h5_path in sys.argv[1:]:
+        numpy_model = NumpyModel.from_h5(h5_path)
+        save_npz(os.path.splitext(h5_path)[0] + ".npz", numpy_model.layers, name=numpy_model.name)
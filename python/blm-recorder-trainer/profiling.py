@@ -0,0 +1,343 @@
+# profiling.py
+
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import threading
+import tracemalloc
+from contextlib import nullcontext
+
+PROFILE_DIR = "./profile"
+
+# The profiler of this process, if profiling is on (see ProfileSession / enable)
+_profiler = None
+_NOT_PROFILING = nullcontext()
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB (ru_maxrss is KB on Linux, bytes on macOS).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def current_rss_mb():
+    """
+    Current resident set size of this process in MB, or None where it can't be read
+    cheaply (only Linux' /proc/self/statm is supported).
+    """
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler:
+    """
+    Context manager that samples the current RSS in a background thread, to find the peak
+    RSS of one part of a run (ru_maxrss, see peak_rss_mb, is the peak of the whole process
+    so far). peak_mb is None where the current RSS can't be read (see current_rss_mb).
+
+    Args:
+        interval (float): Seconds between samples.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss_mb()
+        if rss is not None:
+            self.peak_mb = rss if self.peak_mb is None else max(self.peak_mb, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        if self.peak_mb is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+        return False
+
+
+class Profiler:
+    """
+    Records the wall time, process CPU time and memory of named stages. Stages with the
+    same name are totalled; with keep_events every single stage is also kept as a Chrome
+    trace event.
+
+    The memory of a stage is how much the current RSS grew from its start to its end (the
+    largest growth of any call; only on Linux, see current_rss_mb) and the peak RSS of the
+    whole process so far when it ended. Stages running at the same time in other threads
+    add to each other's growth.
+
+    Args:
+        keep_events (bool): Keep one event per stage for the Chrome trace.
+        trace_memory (bool): Also record the peak Python heap of every stage with
+          tracemalloc (slow, and approximate when stages overlap in several threads).
+    """
+
+    def __init__(self, keep_events=False, trace_memory=False):
+        self.keep_events = keep_events
+        self.trace_memory = trace_memory
+        self.totals = {}
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def stage(self, name, **args):
+        return _Stage(self, name, args)
+
+    def record(self, name, wall_start, wall_seconds, cpu_seconds, heap_peak_mb=None, args=None, rss_growth_mb=None):
+        process_peak = peak_rss_mb()
+        with self._lock:
+            totals = self.totals.setdefault(name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "process_peak_rss_mb": 0.0})
+            totals["calls"] += 1
+            totals["wall_seconds"] += wall_seconds
+            totals["cpu_seconds"] += cpu_seconds
+            totals["process_peak_rss_mb"] = max(totals["process_peak_rss_mb"], process_peak)
+            if rss_growth_mb is not None:
+                totals["rss_growth_mb"] = max(totals.get("rss_growth_mb", rss_growth_mb), rss_growth_mb)
+            if heap_peak_mb is not None:
+                totals["heap_peak_mb"] = max(totals.get("heap_peak_mb", 0.0), heap_peak_mb)
+            if self.keep_events:
+                event_args = dict(args or {}, cpu_ms=cpu_seconds * 1000.0, process_peak_rss_mb=process_peak)
+                if rss_growth_mb is not None:
+                    event_args["rss_growth_mb"] = rss_growth_mb
+                if heap_peak_mb is not None:
+                    event_args["heap_peak_mb"] = heap_peak_mb
+                self.events.append({
+                    "name": name, "ph": "X", "ts": wall_start * 1e6, "dur": wall_seconds * 1e6,
+                    "pid": os.getpid(), "tid": threading.get_ident(), "args": event_args
+                })
+
+    def drain(self):
+        """
+        Returns and forgets everything recorded so far, e.g. to send it from a worker process.
+        """
+        with self._lock:
+            recorded = {"totals": self.totals, "events": self.events}
+            self.totals, self.events = {}, []
+        return recorded
+
+    def merge(self, recorded):
+        """
+        Adds what another profiler drained (e.g. a worker's) to this one.
+        """
+        with self._lock:
+            for name, other in recorded["totals"].items():
+                totals = self.totals.setdefault(name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "process_peak_rss_mb": 0.0})
+                for field in ("calls", "wall_seconds", "cpu_seconds"):
+                    totals[field] += other[field]
+                for field in ("process_peak_rss_mb", "rss_growth_mb", "heap_peak_mb"):
+                    if field in other:
+                        totals[field] = max(totals.get(field, other[field]), other[field])
+            self.events.extend(recorded["events"])
+
+    def print_summary(self):
+        print("[INFO] Profile by stage (CPU is the whole process' CPU time during the stage, RSS growth the largest "
+              "growth of one call, process peak the process' peak RSS so far when the stage ended):")
+        print(f"  {'stage':<22} {'calls':>8} {'wall (s)':>10} {'CPU (s)':>10} {'RSS growth (MB)':>16} "
+              f"{'process peak (MB)':>18} {'heap (MB)':>10}")
+        for name, totals in sorted(self.totals.items(), key=lambda item: -item[1]["wall_seconds"]):
+            growth = f"{totals['rss_growth_mb']:>16.0f}" if "rss_growth_mb" in totals else f"{'-':>16}"
+            heap = f"{totals['heap_peak_mb']:>10.0f}" if "heap_peak_mb" in totals else f"{'-':>10}"
+            print(f"  {name:<22} {totals['calls']:>8} {totals['wall_seconds']:>10.2f} {totals['cpu_seconds']:>10.2f} "
+                  f"{growth} {totals['process_peak_rss_mb']:>18.0f} {heap}")
+
+
+class _Stage:
+    """
+    Context manager timing one stage of a Profiler.
+    """
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if self.profiler.trace_memory:
+            # Heap peaks of nested stages are passed up to the stages around them. reset_peak()
+            # also forgets the peak the outer stage reached so far, so save it first
+            local = self.profiler._local
+            if not hasattr(local, "heap_stack"):
+                local.heap_stack = []
+            if local.heap_stack:
+                local.heap_stack[-1] = max(local.heap_stack[-1], tracemalloc.get_traced_memory()[1])
+            local.heap_stack.append(0)
+            tracemalloc.reset_peak()
+        self.rss_start = current_rss_mb()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_seconds = time.perf_counter() - self.wall_start
+        cpu_seconds = time.process_time() - self.cpu_start
+        heap_peak_mb = None
+        if self.profiler.trace_memory:
+            stack = self.profiler._local.heap_stack
+            heap_peak = max(tracemalloc.get_traced_memory()[1], stack.pop())
+            if stack:
+                stack[-1] = max(stack[-1], heap_peak)
+            heap_peak_mb = heap_peak / (1024 * 1024)
+        rss_growth_mb = None
+        if self.rss_start is not None:
+            rss_growth_mb = current_rss_mb() - self.rss_start
+        self.profiler.record(self.name, self.wall_start, wall_seconds, cpu_seconds, heap_peak_mb, self.args, rss_growth_mb)
+        return False
+
+
+def timed(name, **args):
+    """
+    `with timed("decode"):` records the block as a stage of this process' profiler.
+    Does nothing unless profiling is on. Keyword args are added to the trace event.
+    """
+    if _profiler is None:
+        return _NOT_PROFILING
+    return _profiler.stage(name, **args)
+
+
+def enable(keep_events=False, trace_memory=False):
+    """
+    Starts recording timed() stages in this process. Returns the profiler.
+    """
+    global _profiler
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _profiler = Profiler(keep_events=keep_events, trace_memory=trace_memory)
+    return _profiler
+
+
+def disable():
+    global _profiler
+    if _profiler is not None and _profiler.trace_memory:
+        tracemalloc.stop()
+    _profiler = None
+
+
+def worker_options():
+    """
+    Options for enable() in worker processes, so their stages are recorded the same way.
+    None if profiling is off.
+    """
+    if _profiler is None:
+        return None
+    return {"keep_events": _profiler.keep_events, "trace_memory": _profiler.trace_memory}
+
+
+def run_profiled(fn, *args, **kwargs):
+    """
+    Calls fn in a worker process and returns (its result, the stages the worker recorded
+    meanwhile) for merge() in the parent.
+    """
+    result = fn(*args, **kwargs)
+    return result, _profiler.drain() if _profiler is not None else None
+
+
+def merge(recorded):
+    if _profiler is not None and recorded is not None:
+        _profiler.merge(recorded)
+
+
+def add_profiling_args(parser):
+    parser.add_argument("--profile", action="store_true",
+                        help=f"Print wall/CPU time and RSS growth per stage and save them to {PROFILE_DIR}/.")
+    parser.add_argument("--trace", action="store_true",
+                        help="Also write every stage to a Chrome trace JSON (chrome://tracing, Perfetto). Implies --profile.")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Also record the peak Python heap per stage with tracemalloc (slow). Implies --profile.")
+    parser.add_argument("--cprofile", action="store_true",
+                        help="Also run cProfile (main thread only) and save its stats (.prof) next to the profile. Implies --profile.")
+
+
+class ProfileSession:
+    """
+    Profiles one run of a CLI as requested by the add_profiling_args flags: timed() stages
+    are recorded until stop(), which prints the summary and writes
+    PROFILE_DIR/<name>-<timestamp>.json (plus .trace.json and .prof if asked for).
+    Nothing is recorded if no flag is set. Also usable as a context manager.
+
+    Args:
+        name (str): Name of the run, e.g. "train_all". The whole run is recorded as a stage of this name.
+        trace (bool): Write a Chrome trace of every stage.
+        trace_memory (bool): Record the peak Python heap per stage with tracemalloc.
+        cprofile (bool): Run cProfile over the whole run.
+    """
+
+    def __init__(self, name, profile=False, trace=False, trace_memory=False, cprofile=False, output_dir=PROFILE_DIR):
+        self.name = name
+        self.enabled = profile or trace or trace_memory or cprofile
+        self.trace = trace
+        self.trace_memory = trace_memory
+        self.cprofile = cprofile
+        self.output_dir = output_dir
+        self.profiler = None
+        self._cprofile = None
+
+    @classmethod
+    def from_args(cls, name, args):
+        return cls(name, profile=args.profile, trace=args.trace, trace_memory=args.trace_memory, cprofile=args.cprofile)
+
+    def start(self):
+        if not self.enabled:
+            return self
+        self.profiler = enable(keep_events=self.trace, trace_memory=self.trace_memory)
+        self._run = self.profiler.stage(self.name).__enter__()
+        if self.cprofile:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        return self
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        self._run.__exit__(None, None, None)
+        disable()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        base_path = os.path.join(self.output_dir, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S')}")
+        self.profiler.print_summary()
+        with open(base_path + ".json", "w", encoding="utf-8") as f:
+            json.dump({"name": self.name, "argv": sys.argv, "stages": self.profiler.totals}, f, indent=2)
+        print(f"[INFO] Profile saved to {base_path}.json")
+
+        if self.trace:
+            with open(base_path + ".trace.json", "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": self.profiler.events, "displayTimeUnit": "ms"}, f)
+            print(f"[INFO] Chrome trace saved to {base_path}.trace.json")
+        if self._cprofile is not None:
+            self._cprofile.dump_stats(base_path + ".prof")
+            print(f"[INFO] cProfile stats saved to {base_path}.prof, top 20 by cumulative time:")
+            pstats.Stats(self._cprofile).sort_stats("cumulative").print_stats(20)
+        self.profiler = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
@@ -0,0 +1,136 @@
+# screen_gate.py
+
+import json
+import numpy as np
+
+from dataset_stage import crop_roi, preprocess_crop
+
+# Base file name of the screen gate in a models/vX folder
+SCREEN_GATE_NAME = "screen-gate"
+
+# Screen-pattern ROI (from annotations-screen.json) -> screens on which that pattern is shown
+PATTERN_SCREENS = {
+    "ball-screen-pattern": ("Ball", "Both"),
+    "club-screen-pattern": ("Club", "Both"),
+}
+
+
+def _unit_vectors(crops):
+    """
+    Flattens (N, h, w[, c]) uint8 crops to zero-mean, unit-norm float32 vectors, so a dot
+    product between two of them is their normalized cross-correlation.
+    """
+    crops = np.asarray(crops)
+    if crops.ndim == 4:
+        crops = crops[..., 0]  # the crops are gray replicated to 3 channels
+    vectors = crops.reshape(len(crops), -1).astype(np.float32)
+    vectors -= vectors.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-6)
+
+
+def _mean_template(vectors):
+    """
+    Unit-norm mean of unit vectors, or None if there are none.
+    """
+    if len(vectors) == 0:
+        return None
+    template = vectors.mean(axis=0)
+    return template / max(float(np.linalg.norm(template)), 1e-6)
+
+
+class ScreenGate:
+    """
+    Cheap first-stage screen classifier that template-matches the 'ball-screen-pattern'
+    and 'club-screen-pattern' ROIs instead of running every key model.
+
+    For each pattern it keeps the mean normalized crop of the training frames where the
+    pattern is shown ("present") and of those where it isn't ("absent"). A frame shows the
+    pattern if its crop correlates better with the present template than with the absent
+    one (or, without absent examples, if the correlation is at least min_correlation).
+
+    Args:
+        rois (dict): { pattern_name: (x, y, w, h) } in [0..1] for the screen-pattern ROIs.
+        image_size (tuple[int, int]): (width, height) each pattern crop is resized to.
+        min_correlation (float): Threshold used when a pattern has no absent template.
+    """
+
+    def __init__(self, rois, image_size=(64, 32), min_correlation=0.5):
+        self.rois = {name: tuple(rois[name]) for name in PATTERN_SCREENS}
+        self.image_size = tuple(image_size)
+        self.min_correlation = min_correlation
+        self.templates = {}  # pattern_name -> { "present": vector, "absent": vector or None }
+
+    def fit(self, stage):
+        """
+        Builds the templates from a loaded DatasetStage that includes the pattern ROIs,
+        using each record's annotated "screen" as ground truth.
+        """
+        screens = np.array([record.get("screen", "None") for record in stage.records])
+        for pattern_name, shown_on in PATTERN_SCREENS.items():
+            crops, _ = stage.samples(pattern_name)
+            vectors = _unit_vectors(crops)
+            shown = np.isin(screens, shown_on)
+            self.templates[pattern_name] = {
+                "present": _mean_template(vectors[shown]),
+                "absent": _mean_template(vectors[~shown]),
+            }
+        return self
+
+    def save(self, path):
+        """
+        Saves the templates and settings to an .npz file.
+        """
+        arrays = {}
+        for pattern_name, templates in self.templates.items():
+            for kind, template in templates.items():
+                if template is not None:
+                    arrays[f"{pattern_name}__{kind}"] = template
+        meta = {"rois": self.rois, "image_size": self.image_size, "min_correlation": self.min_correlation}
+        np.savez(path, meta=np.array(json.dumps(meta)), **arrays)
+        print(f"[INFO] Saved screen gate to {path}")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            gate = cls(meta["rois"], meta["image_size"], meta["min_correlation"])
+            for pattern_name in PATTERN_SCREENS:
+                gate.templates[pattern_name] = {
+                    kind: data[f"{pattern_name}__{kind}"] if f"{pattern_name}__{kind}" in data.files else None
+                    for kind in ("present", "absent")
+                }
+        return gate
+
+    def patterns_shown(self, img):
+        """
+        Returns { pattern_name: bool } for one BGR image.
+        """
+        shown = {}
+        for pattern_name, roi in self.rois.items():
+            crop = preprocess_crop(crop_roi(img, roi), self.image_size)
+            vector = _unit_vectors(crop[np.newaxis])[0]
+            present = self.templates[pattern_name]["present"]
+            absent = self.templates[pattern_name]["absent"]
+            if present is None:
+                shown[pattern_name] = False
+            elif absent is None:
+                shown[pattern_name] = float(vector @ present) >= self.min_correlation
+            else:
+                shown[pattern_name] = float(vector @ present) > float(vector @ absent)
+        return shown
+
+    def predict(self, img):
+        """
+        Returns the screen shown in a BGR image: "Ball", "Club", "Both" or "None".
+        """
+        shown = self.patterns_shown(img)
+        ball = shown["ball-screen-pattern"]
+        club = shown["club-screen-pattern"]
+        if ball and club:
+            return "Both"
+        elif ball:
+            return "Ball"
+        elif club:
+            return "Club"
+        return "None"
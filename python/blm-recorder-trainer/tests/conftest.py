@@ -0,0 +1,7 @@
+# conftest.py
+
+import os
+import sys
+
+# The trainer is a folder of scripts, make them importable from the tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
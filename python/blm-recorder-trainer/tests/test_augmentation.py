@@ -0,0 +1,86 @@
+# test_augmentation.py
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from augmentation import BatchAugmenter, affine_matrices
+
+
+def keras_apply_affine_transform(x, tx=0, ty=0, shear=0, zx=1, zy=1):
+    """
+    apply_affine_transform of Keras 2.12 (keras/preprocessing/image.py) for a channels_last
+    image with theta=0, fill_mode="nearest" and order=1, reduced to plain NumPy/SciPy.
+    """
+    row_axis, col_axis, channel_axis = 0, 1, 2
+    shift_matrix = np.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]])
+    shear = np.deg2rad(shear)
+    shear_matrix = np.array([[1, -np.sin(shear), 0], [0, np.cos(shear), 0], [0, 0, 1]])
+    zoom_matrix = np.array([[zx, 0, 0], [0, zy, 0], [0, 0, 1]])
+    transform_matrix = shift_matrix @ shear_matrix @ zoom_matrix
+
+    # transform_matrix_offset_center(transform_matrix, h, w)
+    h, w = x.shape[row_axis], x.shape[col_axis]
+    o_x = float(h) / 2 + 0.5
+    o_y = float(w) / 2 + 0.5
+    offset_matrix = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]])
+    reset_matrix = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]])
+    transform_matrix = offset_matrix @ transform_matrix @ reset_matrix
+
+    x = np.rollaxis(x, channel_axis, 0)
+    # Keras swaps x and y: M' = PMP
+    transform_matrix[:, [0, 1]] = transform_matrix[:, [1, 0]]
+    transform_matrix[[0, 1]] = transform_matrix[[1, 0]]
+    final_affine_matrix = transform_matrix[:2, :2]
+    final_offset = transform_matrix[:2, 2]
+    channel_images = [
+        ndimage.affine_transform(x_channel, final_affine_matrix, final_offset, order=1, mode="nearest", cval=0.0)
+        for x_channel in x
+    ]
+    x = np.stack(channel_images, axis=0)
+    return np.rollaxis(x, 0, channel_axis + 1)
+
+
+def smooth_image(height, width):
+    """
+    A uint8 image without hard edges, so bilinear sampling differences stay small.
+    """
+    rows, cols = np.mgrid[0:height, 0:width].astype(np.float64)
+    image = np.stack([
+        127.5 + 100 * np.sin(rows / 7.0) * np.cos(cols / 11.0),
+        255.0 * rows / (height - 1),
+        255.0 * cols / (width - 1),
+    ], axis=-1)
+    return np.rint(image).astype(np.uint8)
+
+
+@pytest.mark.parametrize("tx, ty, shear, zx, zy", [
+    (6.0, 0.0, 0.0, 1.0, 1.0),
+    (0.0, -9.0, 0.0, 1.0, 1.0),
+    (0.0, 0.0, 5.7, 1.0, 1.0),
+    (0.0, 0.0, 0.0, 0.92, 1.07),
+    (-4.3, 7.1, -3.2, 1.05, 0.95),
+])
+def test_matches_keras_apply_affine_transform(tx, ty, shear, zx, zy):
+    # Not square, so a swapped row/column convention can't pass by accident
+    image = smooth_image(40, 64)
+    augmenter = BatchAugmenter(fill_mode="nearest")
+    matrices = affine_matrices(np.array([tx]), np.array([ty]), np.array([shear]),
+                               np.array([zx]), np.array([zy]), 40, 64)
+
+    result = augmenter.apply(image[None], matrices)[0].astype(np.float64)
+    expected = keras_apply_affine_transform(image.astype(np.float64), tx, ty, shear, zx, zy)
+
+    # OpenCV rounds to uint8, scipy returns float64
+    assert np.abs(result - expected).max() <= 1.0
+    assert np.abs(result - expected).mean() <= 0.5
+
+
+def test_random_transforms_shift_ranges():
+    # Keras draws tx from height_shift_range * height and applies it to columns
+    augmenter = BatchAugmenter(width_shift_range=0.0, height_shift_range=0.2, seed=0)
+    matrices, brightness = augmenter.random_transforms(1000, 40, 64)
+    assert brightness is None
+    assert np.allclose(matrices[:, 1, 2], 0.0)
+    assert np.abs(matrices[:, 0, 2]).max() <= 0.2 * 40
+    assert np.abs(matrices[:, 0, 2]).max() > 0.15 * 40
@@ -0,0 +1,38 @@
+# test_auto_annotator.py
+
+import pytest
+
+from auto_annotator import build_record, BALL_KEYS, CLUB_KEYS, KEYS
+
+PREDICTIONS = {
+    "hla-direction": "L",
+    "spin-axis-direction": "R",
+    "ball-speed-units": "mph",
+    "carry-units": "yds",
+    "path-direction": "R",
+    "aoa-direction": "D",
+    "club-speed-units": "mph",
+}
+
+
+@pytest.mark.parametrize("screen, keys", [
+    ("Ball", BALL_KEYS),
+    ("Club", CLUB_KEYS),
+    ("Both", KEYS),
+    ("None", set()),
+])
+def test_build_record_keeps_the_keys_of_the_screen(screen, keys):
+    record = build_record("frame.png", PREDICTIONS, screen)
+    assert record["filename"] == "frame.png"
+    assert record["screen"] == screen
+    assert {key for key in record if key not in ("filename", "screen")} == keys
+    assert all(record[key] == PREDICTIONS[key] for key in keys)
+
+
+def test_build_record_both_frame_from_predictions():
+    # Without a screen gate the screen is read from the key predictions
+    record = build_record("frame.png", PREDICTIONS)
+    assert record["screen"] == "Both"
+    assert record["path-direction"] == "R"
+    assert record["aoa-direction"] == "D"
+    assert record["club-speed-units"] == "mph"
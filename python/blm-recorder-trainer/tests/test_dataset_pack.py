@@ -0,0 +1,57 @@
+# test_dataset_pack.py
+
+import os
+import json
+
+import numpy as np
+import cv2
+import pytest
+
+from dataset_pack import DatasetPack, pack_version, load_version_annotations
+from dataset_stage import DatasetStage
+
+RECORDS = [{"filename": f"{i}.png", "key": str(i % 2)} for i in range(3)]
+
+
+@pytest.fixture
+def version_dir(tmp_path):
+    version_dir = tmp_path / "v0"
+    version_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for record in RECORDS:
+        cv2.imwrite(str(version_dir / record["filename"]), rng.integers(0, 255, (40, 80, 3), dtype=np.uint8))
+    with open(version_dir / "annotations.json", "w", encoding="utf-8") as f:
+        json.dump(RECORDS, f)
+    pack_version(str(version_dir))
+    return str(version_dir)
+
+
+def test_packed_labels_are_used_while_annotations_json_is_unchanged(version_dir):
+    pack = DatasetPack.open(version_dir)
+    annotations, _ = load_version_annotations(version_dir, pack)
+    assert annotations is pack.annotations
+    assert annotations == RECORDS
+
+
+def test_reannotated_file_wins_over_packed_labels(version_dir):
+    relabeled = [dict(record, key="x") for record in RECORDS]
+    with open(os.path.join(version_dir, "annotations.json"), "w", encoding="utf-8") as f:
+        json.dump(relabeled, f)
+    annotations, _ = load_version_annotations(version_dir, DatasetPack.open(version_dir))
+    assert annotations == relabeled
+
+
+def test_pack_alone_is_a_loadable_version(version_dir):
+    expected = DatasetStage(os.path.dirname(version_dir), "v0", {"key": None}).load()
+    for filename in os.listdir(version_dir):
+        if filename != "frames.blmpack":
+            os.remove(os.path.join(version_dir, filename))
+
+    stage = DatasetStage(os.path.dirname(version_dir), "v0", {"key": None}).load()
+    assert stage.records == RECORDS
+    assert np.array_equal(stage.crops["key"], expected.crops["key"])
+
+
+def test_missing_labels_raise(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_version_annotations(str(tmp_path))
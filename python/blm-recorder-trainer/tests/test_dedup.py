@@ -0,0 +1,39 @@
+# test_dedup.py
+
+import numpy as np
+
+from dedup import hamming_distances, dedup_indices
+
+
+def _hash(bits):
+    return np.packbits(np.array(bits, dtype=bool))[np.newaxis]
+
+
+def test_hamming_distance_counts_differing_bits():
+    a = _hash([0] * 16)
+    b = _hash([1] * 3 + [0] * 13)
+    assert hamming_distances(a, b)[0, 0] == 3
+
+
+def test_segmented_distance_is_the_largest_segment():
+    # Two 8-bit segments: 6 bits differ in the first, none in the second
+    a = _hash([0] * 16)
+    b = _hash([1] * 6 + [0] * 10)
+    assert hamming_distances(a, b)[0, 0] == 6
+    assert hamming_distances(a, b, segments=2)[0, 0] == 6
+    c = _hash([1] * 3 + [0] * 5 + [1] * 3 + [0] * 5)
+    assert hamming_distances(a, c, segments=2)[0, 0] == 3
+
+
+def test_joint_dedup_requires_every_key_within_max_distance():
+    # One key's crop changed by 6 bits, the other not at all: within 2 * 4 bits in total,
+    # but the changed key is no duplicate at max_distance=4
+    hashes = np.concatenate([_hash([0] * 16), _hash([1] * 6 + [0] * 10)])
+    labels = ["a|b", "a|b"]
+    assert list(dedup_indices(hashes, labels, max_distance=4, segments=2)) == [0, 1]
+    assert list(dedup_indices(hashes, labels, max_distance=6, segments=2)) == [0]
+
+
+def test_different_labels_are_never_merged():
+    hashes = np.concatenate([_hash([0] * 16), _hash([0] * 16)])
+    assert list(dedup_indices(hashes, ["L", "R"], max_distance=4)) == [0, 1]
@@ -0,0 +1,194 @@
+# test_numpy_backend.py
+
+import numpy as np
+import pytest
+
+from numpy_backend import LAYERS, NumpyModel
+
+
+def same_padding(size, k, s):
+    """
+    Output size and padding before, as TensorFlow defines padding='same'.
+    """
+    out = -(-size // s)
+    total = max((out - 1) * s + k - size, 0)
+    return out, total // 2
+
+
+def window_origins(size, k, s, padding):
+    if padding == "valid":
+        return [i * s for i in range((size - k) // s + 1)]
+    out, before = same_padding(size, k, s)
+    return [i * s - before for i in range(out)]
+
+
+def reference_windows(x, kh, kw, sh, sw, padding):
+    """
+    { (i, j): (top, left) } of the window of every output position. Windows may start
+    before or reach past x, those positions are padding.
+    """
+    _, h, w, _ = x.shape
+    windows = {}
+    for i, top in enumerate(window_origins(h, kh, sh, padding)):
+        for j, left in enumerate(window_origins(w, kw, sw, padding)):
+            windows[(i, j)] = (top, left)
+    return windows
+
+
+def reference_conv2d(x, kernel, bias, strides, padding):
+    kh, kw, _, out_channels = kernel.shape
+    windows = reference_windows(x, kh, kw, *strides, padding)
+    ho = max(i for i, _ in windows) + 1
+    wo = max(j for _, j in windows) + 1
+    out = np.zeros((len(x), ho, wo, out_channels))
+    for (i, j), (top, left) in windows.items():
+        for a in range(kh):
+            for b in range(kw):
+                r, c = top + a, left + b
+                if 0 <= r < x.shape[1] and 0 <= c < x.shape[2]:
+                    out[:, i, j] += x[:, r, c] @ kernel[a, b]
+    return out + bias
+
+
+def reference_depthwise(x, kernel, strides, padding):
+    kh, kw, channels, multiplier = kernel.shape
+    windows = reference_windows(x, kh, kw, *strides, padding)
+    ho = max(i for i, _ in windows) + 1
+    wo = max(j for _, j in windows) + 1
+    out = np.zeros((len(x), ho, wo, channels * multiplier))
+    for (i, j), (top, left) in windows.items():
+        for a in range(kh):
+            for b in range(kw):
+                r, c = top + a, left + b
+                if 0 <= r < x.shape[1] and 0 <= c < x.shape[2]:
+                    for ch in range(channels):
+                        for m in range(multiplier):
+                            out[:, i, j, ch * multiplier + m] += x[:, r, c, ch] * kernel[a, b, ch, m]
+    return out
+
+
+def reference_max_pool(x, pool_size, strides, padding):
+    windows = reference_windows(x, *pool_size, *strides, padding)
+    ho = max(i for i, _ in windows) + 1
+    wo = max(j for _, j in windows) + 1
+    out = np.full((len(x), ho, wo, x.shape[3]), -np.inf)
+    for (i, j), (top, left) in windows.items():
+        for a in range(pool_size[0]):
+            for b in range(pool_size[1]):
+                r, c = top + a, left + b
+                if 0 <= r < x.shape[1] and 0 <= c < x.shape[2]:
+                    out[:, i, j] = np.maximum(out[:, i, j], x[:, r, c])
+    return out
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+def test_max_pooling_same_pads_like_keras():
+    # 5x5 input, pool 3, stride 1: Keras pads one row/column on every side
+    x = np.arange(25, dtype=np.float32).reshape(1, 5, 5, 1)
+    out = LAYERS["MaxPooling2D"](x, {"pool_size": (3, 3), "strides": (1, 1), "padding": "same"}, [])
+    assert out.shape == (1, 5, 5, 1)
+    assert out[0, 0, 0, 0] == 6
+    assert out[0, 4, 4, 0] == 24
+
+
+@pytest.mark.parametrize("pool_size, strides, padding", [
+    ((2, 2), None, "valid"),
+    ((2, 2), (1, 1), "valid"),
+    ((3, 3), (1, 1), "same"),
+    ((3, 3), (2, 2), "same"),
+    ((2, 2), (2, 2), "same"),
+    ((3, 2), (2, 1), "same"),
+])
+def test_max_pooling2d(rng, pool_size, strides, padding):
+    x = rng.normal(size=(2, 7, 6, 3)).astype(np.float32)
+    config = {"pool_size": pool_size, "strides": strides, "padding": padding}
+    expected = reference_max_pool(x, pool_size, strides or pool_size, padding)
+    np.testing.assert_allclose(LAYERS["MaxPooling2D"](x, config, []), expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize("strides, padding", [((1, 1), "valid"), ((2, 2), "valid"), ((1, 1), "same"), ((2, 2), "same")])
+def test_conv2d(rng, strides, padding):
+    x = rng.normal(size=(2, 7, 6, 3)).astype(np.float32)
+    kernel = rng.normal(size=(3, 3, 3, 4)).astype(np.float32)
+    bias = rng.normal(size=4).astype(np.float32)
+    config = {"strides": strides, "padding": padding, "activation": "linear"}
+    expected = reference_conv2d(x, kernel, bias, strides, padding)
+    np.testing.assert_allclose(LAYERS["Conv2D"](x, config, [kernel, bias]), expected, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("strides, padding", [((1, 1), "valid"), ((2, 2), "same")])
+def test_depthwise_conv2d(rng, strides, padding):
+    x = rng.normal(size=(2, 7, 6, 3)).astype(np.float32)
+    kernel = rng.normal(size=(3, 3, 3, 2)).astype(np.float32)
+    bias = rng.normal(size=6).astype(np.float32)
+    config = {"strides": strides, "padding": padding, "activation": "linear"}
+    expected = reference_depthwise(x, kernel, strides, padding) + bias
+    np.testing.assert_allclose(LAYERS["DepthwiseConv2D"](x, config, [kernel, bias]), expected, rtol=1e-4, atol=1e-4)
+
+
+def test_separable_conv2d(rng):
+    x = rng.normal(size=(2, 7, 6, 3)).astype(np.float32)
+    depthwise = rng.normal(size=(3, 3, 3, 2)).astype(np.float32)
+    pointwise = rng.normal(size=(1, 1, 6, 5)).astype(np.float32)
+    bias = rng.normal(size=5).astype(np.float32)
+    config = {"strides": (1, 1), "padding": "same", "activation": "linear"}
+    expected = reference_depthwise(x, depthwise, (1, 1), "same") @ pointwise[0, 0] + bias
+    np.testing.assert_allclose(
+        LAYERS["SeparableConv2D"](x, config, [depthwise, pointwise, bias]), expected, rtol=1e-4, atol=1e-4
+    )
+
+
+def test_dense_and_activations(rng):
+    x = rng.normal(size=(4, 5)).astype(np.float32)
+    kernel = rng.normal(size=(5, 3)).astype(np.float32)
+    bias = rng.normal(size=3).astype(np.float32)
+    logits = x.astype(np.float64) @ kernel + bias
+
+    relu = LAYERS["Dense"](x, {"activation": "relu"}, [kernel, bias])
+    np.testing.assert_allclose(relu, np.maximum(logits, 0), rtol=1e-5, atol=1e-5)
+
+    softmax = LAYERS["Dense"](x, {"activation": "softmax"}, [kernel, bias])
+    expected = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    np.testing.assert_allclose(softmax, expected, rtol=1e-5, atol=1e-6)
+
+    np.testing.assert_allclose(LAYERS["Activation"](logits.copy(), {"activation": "sigmoid"}, []), 1 / (1 + np.exp(-logits)))
+    np.testing.assert_allclose(LAYERS["Activation"](logits.copy(), {"activation": "tanh"}, []), np.tanh(logits))
+
+
+def test_batch_normalization(rng):
+    x = rng.normal(size=(2, 3, 3, 4)).astype(np.float32)
+    gamma, beta, mean = (rng.normal(size=4).astype(np.float32) for _ in range(3))
+    variance = rng.uniform(0.5, 2.0, size=4).astype(np.float32)
+    expected = gamma * (x - mean) / np.sqrt(variance + 1e-3) + beta
+    out = LAYERS["BatchNormalization"](x, {"epsilon": 1e-3}, [gamma, beta, mean, variance])
+    np.testing.assert_allclose(out, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_shape_layers(rng):
+    x = rng.normal(size=(2, 3, 4, 5)).astype(np.float32)
+    np.testing.assert_allclose(LAYERS["Flatten"](x, {}, []), x.reshape(2, 60))
+    np.testing.assert_allclose(LAYERS["GlobalAveragePooling2D"](x, {}, []), x.mean(axis=(1, 2)), rtol=1e-6)
+    np.testing.assert_allclose(LAYERS["Rescaling"](x, {"scale": 1 / 255.0, "offset": 0.5}, []), x / 255.0 + 0.5, rtol=1e-6)
+    np.testing.assert_array_equal(LAYERS["Dropout"](x, {}, []), x)
+
+
+def test_numpy_model_runs_a_key_classifier_stack(rng):
+    # Conv2D -> MaxPooling2D -> Flatten -> Dense(softmax), like KeyClassifier.build_model
+    kernel = rng.normal(size=(3, 3, 1, 2)).astype(np.float32)
+    dense = rng.normal(size=(3 * 3 * 2, 4)).astype(np.float32)
+    model = NumpyModel([
+        ("Conv2D", {"padding": "valid", "activation": "relu"}, [kernel, np.zeros(2, np.float32)]),
+        ("MaxPooling2D", {"pool_size": (2, 2)}, []),
+        ("Flatten", {}, []),
+        ("Dense", {"activation": "softmax"}, [dense, np.zeros(4, np.float32)]),
+    ])
+    x = rng.uniform(size=(3, 8, 8, 1)).astype(np.float32)
+
+    features = reference_max_pool(np.maximum(reference_conv2d(x, kernel, 0.0, (1, 1), "valid"), 0), (2, 2), (2, 2), "valid")
+    logits = features.reshape(3, -1) @ dense
+    expected = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    np.testing.assert_allclose(model(x), expected, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,41 @@
+# test_profiling.py
+
+import profiling
+from profiling import timed
+
+
+def test_outer_stage_keeps_its_heap_peak_from_before_a_nested_stage():
+    profiler = profiling.enable(trace_memory=True)
+    try:
+        with timed("outer"):
+            big = bytearray(32 * 1024 * 1024)
+            del big
+            with timed("inner"):
+                small = bytearray(1024 * 1024)
+                del small
+    finally:
+        profiling.disable()
+
+    assert profiler.totals["inner"]["heap_peak_mb"] < 8
+    assert profiler.totals["outer"]["heap_peak_mb"] >= 32
+
+
+def test_rss_growth_is_measured_per_stage():
+    profiler = profiling.enable()
+    try:
+        with timed("grow"):
+            big = bytearray(64 * 1024 * 1024)
+            big[::4096] = b"x" * len(big[::4096])  # touch every page so it's resident
+        with timed("idle"):
+            pass
+        del big
+    finally:
+        profiling.disable()
+
+    if profiling.current_rss_mb() is None:
+        assert "rss_growth_mb" not in profiler.totals["idle"]
+        return
+    assert profiler.totals["grow"]["rss_growth_mb"] >= 48
+    assert profiler.totals["idle"]["rss_growth_mb"] < 16
+    # The process peak still includes the earlier stage's memory
+    assert profiler.totals["idle"]["process_peak_rss_mb"] >= profiler.totals["grow"]["rss_growth_mb"]
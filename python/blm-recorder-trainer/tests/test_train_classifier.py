@@ -0,0 +1,68 @@
+# test_train_classifier.py
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("coremltools")
+
+from train_classifier import ArraySequence, AugmentedSequence, KeyClassifier
+
+
+def epoch_batches(sequence, epochs):
+    batches = []
+    for _ in range(epochs):
+        batches.append([sequence[idx] for idx in range(len(sequence))])
+        sequence.on_epoch_end()
+    return batches
+
+
+def assert_same_batches(expected, actual):
+    assert len(expected) == len(actual)
+    for (expected_X, expected_y), (X, y) in zip(expected, actual):
+        np.testing.assert_array_equal(expected_X, X)
+        np.testing.assert_array_equal(expected_y, y)
+
+
+def test_array_sequence_resumes_with_the_same_batches():
+    X = np.arange(40 * 2 * 2 * 1, dtype=np.uint8).reshape(40, 2, 2, 1)
+    y = np.arange(40)
+    uninterrupted = epoch_batches(ArraySequence(X, y, np.arange(40), 8, shuffle=True, seed=3), 4)
+    resumed = epoch_batches(ArraySequence(X, y, np.arange(40), 8, shuffle=True, seed=3, initial_epoch=2), 2)
+
+    assert_same_batches(uninterrupted[2], resumed[0])
+    assert_same_batches(uninterrupted[3], resumed[1])
+    assert not np.array_equal(uninterrupted[0][0][1], uninterrupted[1][0][1])
+
+
+def test_augmented_sequence_resumes_with_the_same_batches():
+    rng = np.random.default_rng(0)
+    base_X = rng.integers(0, 256, (6, 16, 32, 3), dtype=np.uint8)
+    base_y = np.arange(6)
+    uninterrupted = epoch_batches(AugmentedSequence(base_X, base_y, 4, 5, seed=7), 3)
+    resumed = epoch_batches(AugmentedSequence(base_X, base_y, 4, 5, seed=7, initial_epoch=1), 2)
+
+    assert_same_batches(uninterrupted[1], resumed[0])
+    assert_same_batches(uninterrupted[2], resumed[1])
+
+
+def test_fixed_augmented_sequence_repeats_every_epoch():
+    rng = np.random.default_rng(0)
+    base_X = rng.integers(0, 256, (6, 16, 32, 3), dtype=np.uint8)
+    batches = epoch_batches(AugmentedSequence(base_X, np.arange(6), 2, 4, seed=7, fixed=True), 2)
+    assert_same_batches(batches[0], batches[1])
+
+
+@pytest.mark.parametrize("num_base", [2, 3, 10])
+def test_base_image_split_keeps_an_image_on_each_side(tmp_path, num_base):
+    classifier = KeyClassifier("dataset", "v0", "hla-direction", None, str(tmp_path))
+    train_rows, val_rows = classifier._split_base_images(num_base, np.random.default_rng(0))
+    assert len(train_rows) >= 1 and len(val_rows) >= 1
+    assert sorted(np.concatenate([train_rows, val_rows])) == list(range(num_base))
+
+
+@pytest.mark.parametrize("num_base", [0, 1])
+def test_base_image_split_needs_two_images(tmp_path, num_base):
+    classifier = KeyClassifier("dataset", "v0", "hla-direction", None, str(tmp_path))
+    with pytest.raises(ValueError, match="at least 2"):
+        classifier._split_base_images(num_base, np.random.default_rng(0))
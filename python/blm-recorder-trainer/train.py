@@ -1,11 +1,12 @@
 import os
 import numpy as np
 import tensorflow as tf
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras import layers, models
 import coremltools as ct
 import cv2
 
+from augmentation import BatchAugmenter
+
 # Configuration
 IMG_SIZE = (50, 50)
 NUM_AUGMENTED_IMAGES = 1000
@@ -13,7 +14,7 @@ DATASET_PATH = "direction-dataset"
 BATCH_SIZE = 32
 
 # Data Augmentation
-datagen = ImageDataGenerator(
+augmenter = BatchAugmenter(
     width_shift_range=0.2,
     height_shift_range=0.2,
     brightness_range=[0.5, 1.5],
@@ -33,12 +34,7 @@ def load_and_augment_images(class_name):
     img = np.expand_dims(img, axis=-1)
     img = np.expand_dims(img, axis=0)
     
-    augmented_images = []
-    for _ in range(NUM_AUGMENTED_IMAGES):
-        augmented = next(datagen.flow(img, batch_size=1))[0].astype(np.uint8)
-        augmented_images.append(augmented)
-    
-    return np.array(augmented_images)
+    return augmenter.augment(img, NUM_AUGMENTED_IMAGES)
 
 # Load Data
 classes = [f.split(".")[0] for f in os.listdir(DATASET_PATH) if f.endswith(".png")]
@@ -2,7 +2,20 @@
 
 import json
 import os
-from train_classifier import KeyClassifier
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+import tensorflow as tf
+from tensorflow.keras import backend
+from train_classifier import KeyClassifier, MultiKeyClassifier, StudentKeyClassifier, STUDENT_DIR
+from dataset_stage import DatasetStage
+from screen_gate import ScreenGate, SCREEN_GATE_NAME, PATTERN_SCREENS
+from dedup import dedup_stage
+from numpy_backend import NumpyModel
+from coreml_compression import verify_compression, describe, path_size_mb, COMPRESSIONS, DEFAULT_PALETTE_BITS
+import profiling
+from profiling import timed, peak_rss_mb, RssSampler, ProfileSession, add_profiling_args
 import argparse
 
 KEYS = {
@@ -22,6 +35,16 @@ club_roi_json = os.path.join(ROI_ANNOTATION_DIR, "annotations-club.json")
 screen_roi_json = os.path.join(ROI_ANNOTATION_DIR, "annotations-screen.json")
 
 MODEL_PATH="./models"
+CACHE_DIR="./cache"
+
+# Fine-tuning (--from-model) runs until the held-out loss stops improving, up to this many epochs
+FINE_TUNE_EPOCHS = 20
+FINE_TUNE_PATIENCE = 3
+
+# Training from scratch runs EPOCHS epochs. Early stopping and the learning rate schedule
+# are opt-in (--early-stopping-patience / --reduce-lr-patience), so the default run trains
+# like it always has
+EPOCHS = 10
 
 # We'll show an example for how you might load the ROI from your attached JSON files.
 # For instance, in "annotations-ball.json", we see something like:
@@ -42,7 +65,288 @@ def load_rois_from_file(json_path):
         rois_dict[kname] = tuple(rect)  # convert to a tuple
     return rois_dict
 
-def main(dataset_version):
+def thread_budget(jobs):
+    """
+    Splits the machine's cores across `jobs` workers so they don't oversubscribe the CPU.
+    Returns (intra_op_threads, inter_op_threads) for each worker.
+    """
+    cores = os.cpu_count() or 1
+    intra_op_threads = max(1, cores // jobs)
+    inter_op_threads = max(1, min(2, intra_op_threads))
+    return intra_op_threads, inter_op_threads
+
+def init_worker(intra_op_threads, inter_op_threads, profile_options=None):
+    """
+    Runs once in each worker process, before it creates any TensorFlow ops.
+    profile_options (see profiling.worker_options) turns on profiling in the worker.
+    """
+    if profile_options is not None:
+        profiling.enable(**profile_options)
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    cv2.setNumThreads(intra_op_threads)
+
+def key_finished(dataset_version, key_name):
+    """
+    True if a key's model for dataset_version was fully trained and exported: the Core ML
+    package is at least as new as the .h5 and no interrupted training state is left.
+    """
+    base_path = os.path.join(MODEL_PATH, dataset_version, key_name)
+    h5_path, coreml_path = base_path + ".h5", base_path + ".mlpackage"
+    return (
+        os.path.isfile(h5_path)
+        and os.path.isfile(base_path + ".json")
+        and os.path.exists(coreml_path)
+        and os.path.getmtime(coreml_path) >= os.path.getmtime(h5_path)
+        and not os.path.isdir(base_path + ".resume")
+    )
+
+def train_key(key_name, roi, dataset_version, stage, image_size, streaming=False, channels=3,
+              from_model=None, replay_fraction=0.2, epochs=EPOCHS,
+              early_stopping_patience=None, reduce_lr_patience=None, resume=False,
+              compression="float16", nbits=DEFAULT_PALETTE_BITS, holdout_base_images=False):
+    """
+    Runs gather_data -> build_model -> train -> export_coreml for one key and
+    returns a summary dict with its timing and the peak memory of the process.
+    With from_model (e.g. 'v2'), that version's model for the key is fine-tuned instead.
+    With holdout_base_images, whole base images are held out (and listed in the sidecar),
+    so a distilled student can be compared with the model on images neither trained on.
+    With resume, an interrupted training of the key continues where it stopped.
+    Compressed exports (int8, palettize) are checked against the uncompressed weights.
+    """
+    start = time.perf_counter()
+
+    from_model_path = None
+    if from_model is not None:
+        from_model_path = os.path.join(MODEL_PATH, from_model, f"{key_name}.h5")
+        if not os.path.isfile(from_model_path):
+            print(f"[WARN] No {from_model} model for '{key_name}' at {from_model_path}, training from scratch")
+            from_model_path = None
+
+    # Create the classifier object
+    classifier = KeyClassifier(
+        dataset_dir=DATASET_DIR,
+        dataset_version=dataset_version,
+        key_name=key_name,
+        roi=roi,
+        output_model_path=MODEL_PATH,
+        image_size=image_size,
+        dataset_stage=stage,
+        streaming=streaming,
+        channels=channels,
+        from_model_path=from_model_path,
+        replay_fraction=replay_fraction,
+        resume=resume,
+        holdout_base_images=holdout_base_images
+    )
+
+    # Gather data
+    with timed("gather_data", key=key_name):
+        classifier.gather_data()
+
+    # Build model
+    with timed("build_model", key=key_name):
+        classifier.build_model()
+
+    # Train. Fine-tuning stops as soon as the held-out loss stops improving
+    with timed("train", key=key_name):
+        if from_model_path is not None:
+            classifier.train(epochs=FINE_TUNE_EPOCHS, batch_size=32, early_stopping_patience=FINE_TUNE_PATIENCE)
+        else:
+            classifier.train(
+                epochs=epochs,
+                batch_size=32,
+                early_stopping_patience=early_stopping_patience,
+                reduce_lr_patience=reduce_lr_patience
+            )
+
+    # Export
+    with timed("export_coreml", key=key_name):
+        coreml_models = classifier.export_coreml(compression, nbits)
+    if compression in ("int8", "palettize"):
+        with timed("check_compression", key=key_name):
+            check_compression(classifier, stage, compression, nbits, *coreml_models)
+
+    # Drop this key's graph so it doesn't accumulate in a process that trains several keys
+    backend.clear_session()
+
+    return {
+        "key": key_name,
+        "seconds": time.perf_counter() - start,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_scope": "process",
+        "pid": os.getpid()
+    }
+
+def check_compression(classifier, stage, compression, nbits, reference_mlmodel=None, compressed_mlmodel=None):
+    """
+    Runs the key's crops through its uncompressed and its compressed model and writes the
+    label agreement and size savings to <key>.compression.json next to the model. The
+    Core ML models are run where possible (macOS), otherwise the compression is simulated
+    on the Keras weights and the report is marked as such ("method": "simulated").
+    """
+    crops, _ = stage.samples(classifier.key_name)
+    report = verify_compression(
+        NumpyModel.load(classifier.output_model_path + ".h5"), crops, compression, nbits,
+        reference_mlmodel=reference_mlmodel, compressed_mlmodel=compressed_mlmodel,
+        class_labels=classifier.class_labels
+    )
+    report["mlpackage_mb"] = path_size_mb(classifier.output_model_path + ".mlpackage")
+    with open(classifier.output_model_path + ".compression.json", "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"[INFO] '{classifier.key_name}' {compression} vs uncompressed: {describe(report)}")
+    return report
+
+def distill_key(key_name, roi, dataset_version, stage, image_size, streaming=False, channels=3,
+                epochs=EPOCHS, early_stopping_patience=None,
+                reduce_lr_patience=None, resume=False, compression="float16", nbits=DEFAULT_PALETTE_BITS):
+    """
+    Distills the key's trained model of dataset_version into a small student model,
+    exports both and writes the student/teacher report. Returns a summary dict.
+    """
+    start = time.perf_counter()
+
+    classifier = StudentKeyClassifier(
+        teacher_model_path=os.path.join(MODEL_PATH, dataset_version, f"{key_name}.h5"),
+        dataset_dir=DATASET_DIR,
+        dataset_version=dataset_version,
+        key_name=key_name,
+        roi=roi,
+        output_model_path=MODEL_PATH,
+        image_size=image_size,
+        dataset_stage=stage,
+        streaming=streaming,
+        channels=channels,
+        resume=resume
+    )
+    classifier.gather_data()
+    classifier.build_model()
+    classifier.train(
+        epochs=epochs,
+        batch_size=32,
+        early_stopping_patience=early_stopping_patience,
+        reduce_lr_patience=reduce_lr_patience
+    )
+    coreml_models = classifier.export_coreml(compression, nbits)
+    if compression in ("int8", "palettize"):
+        check_compression(classifier, stage, compression, nbits, *coreml_models)
+    classifier.report()
+
+    backend.clear_session()
+
+    return {
+        "key": key_name + " (student)",
+        "seconds": time.perf_counter() - start,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_scope": "process",
+        "pid": os.getpid()
+    }
+
+def train_multi_head(key_rois, dataset_version, stage, image_size, channels=3, epochs=EPOCHS,
+                     early_stopping_patience=None, reduce_lr_patience=None):
+    """
+    Trains one multi-head model covering every key and returns its summary dict.
+    """
+    start = time.perf_counter()
+
+    classifier = MultiKeyClassifier(
+        dataset_dir=DATASET_DIR,
+        dataset_version=dataset_version,
+        rois=key_rois,
+        output_model_path=MODEL_PATH,
+        image_size=image_size,
+        dataset_stage=stage,
+        channels=channels
+    )
+    classifier.gather_data()
+    classifier.build_model()
+    classifier.train(
+        epochs=epochs,
+        batch_size=32,
+        early_stopping_patience=early_stopping_patience,
+        reduce_lr_patience=reduce_lr_patience
+    )
+    classifier.export_coreml()
+
+    return {
+        "key": "multi-head",
+        "seconds": time.perf_counter() - start,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_scope": "process",
+        "pid": os.getpid()
+    }
+
+def measure_rss(train_fn, *args, **kwargs):
+    """
+    Calls train_fn in this process and, where the RSS can be sampled (Linux), replaces the
+    process-wide peak RSS in its summary dict with the peak RSS while it ran.
+    """
+    with RssSampler() as rss:
+        result = train_fn(*args, **kwargs)
+    if rss.peak_mb is not None:
+        result["peak_rss_mb"] = rss.peak_mb
+        result["peak_rss_scope"] = "key"
+    return result
+
+def print_summary(results, wall_seconds):
+    """
+    Prints time and peak RSS per key. The peak RSS is the key's own: sampled while it
+    trained ("key"), or that of the fresh worker process that trained only it ("worker").
+    Where neither is possible it's the peak of the whole process so far ("process"),
+    which includes the dataset and every key before it, and is marked with a *.
+    """
+    print("[INFO] Training summary:")
+    print(f"  {'key':<22} {'time (s)':>10} {'peak RSS (MB)':>14} {'pid':>8}")
+    for result in sorted(results, key=lambda r: r["key"]):
+        marker = "*" if result["peak_rss_scope"] == "process" else " "
+        print(f"  {result['key']:<22} {result['seconds']:>10.1f} {result['peak_rss_mb']:>13.0f}{marker} {result['pid']:>8}")
+    print(f"  {'total wall time':<22} {wall_seconds:>10.1f}")
+    if any(result["peak_rss_scope"] == "process" for result in results):
+        print("  * peak RSS of the whole process so far (the current RSS can't be sampled on this platform)")
+
+def run_keys(train_fn, keys, key_rois, dataset_version, stage, image_size, jobs, options):
+    """
+    Calls train_fn for every key, one after the other or in `jobs` worker processes,
+    and returns their summary dicts.
+    """
+    results = []
+    if jobs <= 1:
+        for key_name in keys:
+            results.append(measure_rss(train_fn, key_name, key_rois[key_name], dataset_version, stage, image_size, **options))
+        return results
+
+    # One worker process per key (up to `jobs` at a time), each with its share of the cores.
+    # Workers only receive the crops for their own key, and each worker trains a single key
+    # (max_tasks_per_child), so its peak RSS is that key's.
+    intra_op_threads, inter_op_threads = thread_budget(jobs)
+    print(f"[INFO] Training {len(keys)} keys with {jobs} workers "
+          f"({intra_op_threads} intra-op / {inter_op_threads} inter-op threads each)")
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(intra_op_threads, inter_op_threads, profiling.worker_options()),
+        max_tasks_per_child=1
+    ) as executor:
+        futures = {
+            executor.submit(
+                profiling.run_profiled, train_fn, key_name, key_rois[key_name], dataset_version,
+                stage.subset([key_name]), image_size, **options
+            ): key_name
+            for key_name in keys
+        }
+        for future in as_completed(futures):
+            result, recorded = future.result()
+            result["peak_rss_scope"] = "worker"
+            profiling.merge(recorded)
+            print(f"[INFO] Finished '{result['key']}' in {result['seconds']:.1f}s")
+            results.append(result)
+    return results
+
+def main(dataset_version, cache_dir=CACHE_DIR, streaming=False, jobs=1, multi_head=False, channels=3, dedup_distance=None,
+         from_model=None, replay_fraction=0.2, epochs=EPOCHS, early_stopping_patience=None,
+         reduce_lr_patience=None, resume=False, distill=False, compression="float16",
+         nbits=DEFAULT_PALETTE_BITS):
     # Paths to your ROI JSON files
     # (you mentioned 3 files for ball/club/screen but let's just load them all
     #  and combine them into one dictionary keyed by name).
@@ -54,43 +358,156 @@ def main(dataset_version):
     # Combine them:
     all_rois = {**ball_rois, **club_rois, **screen_rois}
 
+    if multi_head and from_model is not None:
+        raise ValueError("--from-model only fine-tunes per-key models, not the multi-head model")
+    if multi_head and distill:
+        raise ValueError("--distill only distills per-key models, not the multi-head model")
+    if multi_head and resume:
+        raise ValueError("--resume only continues per-key models, the multi-head model always trains from scratch")
+    if multi_head and streaming:
+        raise ValueError("--streaming only applies to per-key models, the multi-head model holds every augmented copy in RAM")
+    if multi_head and jobs > 1:
+        raise ValueError("--jobs trains per-key models in parallel, the multi-head model is a single training run")
+    if multi_head and compression != "float16":
+        raise ValueError("--compression only applies to per-key models, the multi-head model is exported as float16")
+
     # Create an output folder for the .mlmodel files
     os.makedirs("models", exist_ok=True)
 
-    # For each key, we:
-    # 1) Look up the ROI
-    # 2) Create a KeyClassifier
-    # 3) gather_data -> build_model -> train -> export_coreml
-    for key_name in KEYS:
-        # Find the ROI for this key (or default if missing)
-        roi = all_rois.get(key_name)  # fallback is the full image
+    wall_start = time.perf_counter()
 
-        # Create the classifier object
-        classifier = KeyClassifier(
+    # Decode every image once and crop all key ROIs in the same pass,
+    # instead of each KeyClassifier re-reading every PNG. Versions that are
+    # already in the crop cache are memory-mapped instead of decoded.
+    image_size = (64, 32)  # or customize per key if needed
+    key_rois = {key_name: all_rois.get(key_name) for key_name in KEYS}  # fallback is the full image
+    pattern_rois = {pattern_name: screen_rois[pattern_name] for pattern_name in PATTERN_SCREENS}
+    with timed("load_dataset"):
+        stage = DatasetStage(
             dataset_dir=DATASET_DIR,
             dataset_version=dataset_version,
-            key_name=key_name,
-            roi=roi,
-            output_model_path=MODEL_PATH,
-            image_size=(64, 32)  # or customize per key if needed
-        )
+            rois={**key_rois, **pattern_rois},
+            image_size=image_size,
+            cache_dir=cache_dir,
+            channels=channels
+        ).load()
 
-        # Gather data
-        classifier.gather_data()
+    # The screen gate is just a pair of templates per screen pattern, so it's built right here
+    gate_path = os.path.join(MODEL_PATH, dataset_version, SCREEN_GATE_NAME + ".npz")
+    os.makedirs(os.path.dirname(gate_path), exist_ok=True)
+    with timed("screen_gate"):
+        ScreenGate(pattern_rois, image_size).fit(stage).save(gate_path)
 
-        # Build model
-        classifier.build_model()
+    # Drop near-duplicate frames (many captures of the same display) before augmenting.
+    # The multi-head model needs the same frames for every key, so it dedups jointly.
+    if dedup_distance is not None:
+        with timed("dedup"):
+            dedup_stage(stage, sorted(KEYS), max_distance=dedup_distance, joint=multi_head)
 
-        # Train
-        classifier.train(epochs=10, batch_size=32)
+    # For each key, we:
+    # 1) Look up the ROI
+    # 2) Create a KeyClassifier that draws its crops from the shared stage
+    # 3) gather_data -> build_model -> train -> export_coreml
+    # Keys that a previous (interrupted) run already finished are skipped when resuming
+    keys = sorted(KEYS)
+    if resume:
+        finished = [key_name for key_name in keys if key_finished(dataset_version, key_name)]
+        for key_name in finished:
+            print(f"[INFO] Skipping '{key_name}': already trained for {dataset_version} (drop --resume to retrain)")
+        keys = [key_name for key_name in keys if key_name not in finished]
 
-        # Export
-        classifier.export_coreml()
+    options = dict(
+        streaming=streaming,
+        channels=channels,
+        from_model=from_model,
+        replay_fraction=replay_fraction,
+        epochs=epochs,
+        early_stopping_patience=early_stopping_patience,
+        reduce_lr_patience=reduce_lr_patience,
+        resume=resume,
+        compression=compression,
+        nbits=nbits,
+        # Students are compared with their teacher on base images the teacher never saw
+        holdout_base_images=distill
+    )
+    results = []
+    if multi_head:
+        # One shared-backbone network with a head per key instead of one model per key
+        results.append(measure_rss(
+            train_multi_head, key_rois, dataset_version, stage, image_size, channels,
+            epochs=epochs,
+            early_stopping_patience=early_stopping_patience,
+            reduce_lr_patience=reduce_lr_patience
+        ))
+    else:
+        results.extend(run_keys(train_key, keys, key_rois, dataset_version, stage, image_size, jobs, options))
+
+    # Distill every trained key model into a small student (models/vX/student/<key>.*)
+    if distill:
+        student_keys = sorted(KEYS)
+        if resume:
+            student_keys = [
+                key_name for key_name in student_keys
+                if not key_finished(os.path.join(dataset_version, STUDENT_DIR), key_name)
+            ]
+        distill_options = {name: value for name, value in options.items() if name not in ("from_model", "replay_fraction", "holdout_base_images")}
+        results.extend(run_keys(distill_key, student_keys, key_rois, dataset_version, stage, image_size, jobs, distill_options))
+
+    print_summary(results, time.perf_counter() - wall_start)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--dataset", type=str, required=True, help="Dataset version to train (i.e. 'v1').")
+    parser.add_argument("--cache-dir", type=str, default=CACHE_DIR, help="Folder for the preprocessed crop cache.")
+    parser.add_argument("--no-cache", action="store_true", help="Don't read or write the preprocessed crop cache.")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Augment batches on the fly instead of holding every augmented copy in RAM.")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of keys to train in parallel, each in its own worker process.")
+    parser.add_argument("--multi-head", action="store_true",
+                        help="Train a single shared-backbone model with one head per key instead of one model per key.")
+    parser.add_argument("--channels", type=int, choices=(1, 3), default=3,
+                        help="1 trains single-channel (grayscale) models, 3 the gray-replicated BGR input.")
+    parser.add_argument("--from-model", type=str, default=None,
+                        help="Fine-tune each key's model from this model version (i.e. 'v2') on the new data plus a replay sample.")
+    parser.add_argument("--replay-fraction", type=float, default=0.2,
+                        help="Share of the older versions' frames replayed per label when fine-tuning.")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Train on one representative per cluster of near-duplicate frames with the same label.")
+    parser.add_argument("--dedup-distance", type=int, default=10,
+                        help="Max Hamming distance (of 256 dHash bits) between frames that count as duplicates.")
+    parser.add_argument("--epochs", type=int, default=EPOCHS, help="Max epochs per key when training from scratch.")
+    parser.add_argument("--early-stopping-patience", type=int, default=0,
+                        help="Stop after this many epochs without a better val_loss, e.g. 3 (default 0: off).")
+    parser.add_argument("--reduce-lr-patience", type=int, default=0,
+                        help="Halve the learning rate after this many epochs without a better val_loss, e.g. 2 (default 0: off).")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default="float16",
+                        help="Core ML weight precision/compression; int8 and palettize are verified against the uncompressed weights.")
+    parser.add_argument("--nbits", type=int, default=DEFAULT_PALETTE_BITS, help="Bits per weight for --compression palettize.")
+    parser.add_argument("--distill", action="store_true",
+                        help="Also distill each key model into a small student in models/vX/student/ and write a comparison report.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run: skip keys already trained for this version (even if the data "
+                             "changed since) and resume interrupted ones from their last epoch.")
+    add_profiling_args(parser)
     args = parser.parse_args()
-    
-    main(args.dataset)
 
+    with ProfileSession.from_args("train_all", args):
+        main(
+            args.dataset,
+            cache_dir=None if args.no_cache else args.cache_dir,
+            streaming=args.streaming,
+            jobs=args.jobs,
+            multi_head=args.multi_head,
+            channels=args.channels,
+            dedup_distance=args.dedup_distance if args.dedup else None,
+            from_model=args.from_model,
+            replay_fraction=args.replay_fraction,
+            epochs=args.epochs,
+            early_stopping_patience=args.early_stopping_patience or None,
+            reduce_lr_patience=args.reduce_lr_patience or None,
+            resume=args.resume,
+            distill=args.distill,
+            compression=args.compression,
+            nbits=args.nbits
+        )
@@ -2,23 +2,322 @@
 
 import os
 import json
+import time
+import shutil
 import numpy as np
-import re
-from PIL import Image
-import cv2
 
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from tensorflow.keras.callbacks import ModelCheckpoint
+from dataset_stage import DatasetStage
+from augmentation import BatchAugmenter
+from key_inference import MULTI_HEAD_NAME
+from numpy_backend import NumpyModel, export_npz
+from coreml_compression import path_size_mb, compute_precision, compress_coreml, DEFAULT_PALETTE_BITS
+from profiling import timed
+
+from tensorflow.keras.callbacks import Callback, ModelCheckpoint, EarlyStopping, ReduceLROnPlateau
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.utils import Sequence
 from tensorflow.keras import layers, models
 import coremltools as ct
 
+# Augmentation settings used for every key (same as the former ImageDataGenerator setup)
+AUGMENTATION_PARAMS = dict(
+    width_shift_range=0.2,
+    height_shift_range=0.2,
+    brightness_range=[0.8, 1.3],
+    shear_range=0.1,
+    zoom_range=0.1,
+    fill_mode="nearest"
+)
+
+# Smaller steps than adam's default when fine-tuning a previous version's model
+FINE_TUNE_LEARNING_RATE = 1e-4
+
+# Files in a key's '<output_model_path>.resume' folder while its training is in progress
+RESUME_MODEL_FILENAME = "model.h5"
+RESUME_STATE_FILENAME = "state.json"
+
+# Distilled students are saved as <version>/student/<key>.*, next to their teachers
+STUDENT_DIR = "student"
+DISTILL_TEMPERATURE = 4.0
+DISTILL_ALPHA = 0.7
+
+def resolve_seed(seed):
+    """
+    Returns seed, or a fresh random one if it's None, so a sequence can derive the RNG of
+    every epoch from (seed, epoch).
+    """
+    if seed is None:
+        return int(np.random.SeedSequence().entropy % (2 ** 32))
+    return seed
+
+class AugmentedSequence(Sequence):
+    """
+    Streams augmented batches from a small set of uint8 base crops, so only the base
+    crops ever live in memory. Each epoch yields aug_per_sample copies of every base image.
+
+    The order of an epoch and the transforms of each of its batches are drawn from
+    (seed, epoch) and (seed, epoch, batch index), so a run resumed at initial_epoch sees
+    the same batches as an uninterrupted run with the same seed.
+
+    Args:
+        base_X (np.ndarray): uint8 base crops, shape (N, h, w, channels).
+        base_y (np.ndarray): Label index per base crop, shape (N,).
+        aug_per_sample (int): Augmented copies of each base crop per epoch.
+        batch_size (int): Samples per batch.
+        seed (int): Seed for the augmentation and ordering.
+        fixed (bool): If True, every epoch yields the exact same batches (for validation).
+                      Otherwise each epoch is reshuffled and freshly augmented.
+        initial_epoch (int): Epoch the first batches are for (see model.fit).
+    """
+
+    def __init__(self, base_X, base_y, aug_per_sample, batch_size, seed=None, fixed=False, initial_epoch=0):
+        super().__init__()
+        self.base_X = base_X
+        self.base_y = base_y
+        self.batch_size = batch_size
+        self.seed = resolve_seed(seed)
+        self.fixed = fixed
+        self.base_samples = np.repeat(np.arange(len(base_X)), aug_per_sample)
+        self.set_epoch(initial_epoch)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.samples = self.base_samples
+        if not self.fixed:
+            self.samples = np.random.default_rng((self.seed, epoch)).permutation(self.base_samples)
+
+    def __len__(self):
+        return int(np.ceil(len(self.samples) / self.batch_size))
+
+    def __getitem__(self, idx):
+        sample_idx = self.samples[idx * self.batch_size:(idx + 1) * self.batch_size]
+        # Validation batches get the same transforms every epoch
+        batch_seed = (self.seed, idx) if self.fixed else (self.seed, self.epoch, idx)
+        augmenter = BatchAugmenter(seed=batch_seed, **AUGMENTATION_PARAMS)
+        with timed("augment"):
+            X = augmenter.augment(self.base_X[sample_idx]).astype(np.float32)
+        X /= 255.0
+        return X, self.base_y[sample_idx]
+
+    def on_epoch_end(self):
+        self.set_epoch(self.epoch + 1)
+
+class ArraySequence(Sequence):
+    """
+    Feeds already augmented uint8 samples to the model, converting only the requested
+    batch to float32 in [0..1], so the dataset itself is never held as float32.
+
+    Args:
+        X (np.ndarray or dict): uint8 samples of shape (N, h, w, channels), or
+                                { input name: array } for multi-input models.
+        y (np.ndarray or dict): Label index per sample, or { output name: array }.
+        indices (np.ndarray): Rows of X / y that make up this sequence.
+        batch_size (int): Samples per batch.
+        shuffle (bool): Shuffle the rows every epoch, in an order drawn from (seed, epoch),
+                        so a run resumed at initial_epoch sees the same batches.
+        seed (int): Seed for the shuffling.
+        initial_epoch (int): Epoch the first batches are for (see model.fit).
+    """
+
+    def __init__(self, X, y, indices, batch_size, shuffle=False, seed=None, initial_epoch=0):
+        super().__init__()
+        self.X = X
+        self.y = y
+        self.base_indices = np.array(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = resolve_seed(seed)
+        self.set_epoch(initial_epoch)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.indices = self.base_indices
+        if self.shuffle:
+            self.indices = np.random.default_rng((self.seed, epoch)).permutation(self.base_indices)
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    @staticmethod
+    def _take(data, batch_idx, scale=False):
+        if isinstance(data, dict):
+            return {name: ArraySequence._take(arr, batch_idx, scale) for name, arr in data.items()}
+        if not scale:
+            return data[batch_idx]
+        batch = data[batch_idx].astype(np.float32)
+        batch /= 255.0
+        return batch
+
+    def __getitem__(self, idx):
+        batch_idx = self.indices[idx * self.batch_size:(idx + 1) * self.batch_size]
+        return self._take(self.X, batch_idx, scale=True), self._take(self.y, batch_idx)
+
+    def on_epoch_end(self):
+        self.set_epoch(self.epoch + 1)
+
+class ResumeCheckpoint(Callback):
+    """
+    Saves what an interrupted train() needs to continue after every epoch: the full model
+    (weights and optimizer state, so a reduced learning rate carries over), the next epoch,
+    the data seed, the class labels and the best val_loss the best-model checkpoint has seen.
+
+    Args:
+        resume_dir (str): Folder to write model.h5 and state.json to.
+        seed (int): Seed of the data split / augmentation of this run.
+        class_labels (list[str]): Labels of the model's outputs.
+        best_checkpoint (ModelCheckpoint): The best-model checkpoint, for its best val_loss.
+    """
+
+    def __init__(self, resume_dir, seed, class_labels, best_checkpoint):
+        super().__init__()
+        self.resume_dir = resume_dir
+        self.seed = seed
+        self.class_labels = class_labels
+        self.best_checkpoint = best_checkpoint
+
+    def on_epoch_end(self, epoch, logs=None):
+        os.makedirs(self.resume_dir, exist_ok=True)
+        model_path = os.path.join(self.resume_dir, RESUME_MODEL_FILENAME)
+        self.model.save(model_path + ".tmp.h5")
+        os.replace(model_path + ".tmp.h5", model_path)
+
+        state_path = os.path.join(self.resume_dir, RESUME_STATE_FILENAME)
+        with open(state_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({
+                "epoch": epoch + 1,
+                "seed": self.seed,
+                "class_labels": self.class_labels,
+                "best_val_loss": float(self.best_checkpoint.best)
+            }, f, indent=2)
+        os.replace(state_path + ".tmp", state_path)
+
+class DistillationSequence(Sequence):
+    """
+    Wraps a sequence of (batch in [0..1], label index) pairs and turns the labels into
+    distillation targets: alpha * the teacher's probabilities softened by temperature,
+    plus (1 - alpha) * the one-hot label. Without a teacher the targets are just the
+    one-hot labels, so validation measures a student against the real labels.
+
+    Args:
+        sequence (Sequence): ArraySequence or AugmentedSequence to wrap.
+        num_classes (int): Number of outputs of teacher and student.
+        teacher (keras.Model): Trained teacher, or None.
+        temperature (float): Softmax temperature applied to the teacher's probabilities.
+        alpha (float): Weight of the teacher's targets.
+    """
+
+    def __init__(self, sequence, num_classes, teacher=None, temperature=DISTILL_TEMPERATURE, alpha=DISTILL_ALPHA):
+        super().__init__()
+        self.sequence = sequence
+        self.one_hot = np.eye(num_classes, dtype=np.float32)
+        self.teacher = teacher
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getitem__(self, idx):
+        X, y = self.sequence[idx]
+        targets = self.one_hot[y]
+        if self.teacher is None:
+            return X, targets
+
+        # softmax(log(p) / T) == softmax(logits / T), so the teacher keeps its softmax head
+        logits = np.log(np.maximum(np.asarray(self.teacher(X, training=False), dtype=np.float32), 1e-7))
+        logits /= self.temperature
+        soft = np.exp(logits - logits.max(axis=1, keepdims=True))
+        soft /= soft.sum(axis=1, keepdims=True)
+        return X, self.alpha * soft + (1.0 - self.alpha) * targets
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+
+def split_sequences(X, y, batch_size, validation_split, seed=None, initial_epoch=0):
+    """
+    Returns (train, validation) ArraySequences over X / y, holding out the last
+    validation_split of the rows like model.fit(validation_split=...) does.
+    """
+    num_samples = len(next(iter(y.values()))) if isinstance(y, dict) else len(y)
+    split_at = int(num_samples * (1.0 - validation_split))
+    train_seq = ArraySequence(X, y, np.arange(split_at), batch_size, shuffle=True, seed=seed, initial_epoch=initial_epoch)
+    val_seq = ArraySequence(X, y, np.arange(split_at, num_samples), batch_size)
+    return train_seq, val_seq
+
+def plateau_callbacks(early_stopping_patience=None, reduce_lr_patience=None, reduce_lr_factor=0.5, min_learning_rate=1e-6):
+    """
+    The optional val_loss callbacks of train(): EarlyStopping after early_stopping_patience
+    epochs without improvement, ReduceLROnPlateau after reduce_lr_patience epochs.
+    """
+    callbacks = []
+    if early_stopping_patience is not None:
+        callbacks.append(EarlyStopping(monitor="val_loss", mode="min", patience=early_stopping_patience, verbose=1))
+    if reduce_lr_patience is not None:
+        callbacks.append(ReduceLROnPlateau(
+            monitor="val_loss",
+            mode="min",
+            factor=reduce_lr_factor,
+            patience=reduce_lr_patience,
+            min_lr=min_learning_rate,
+            verbose=1
+        ))
+    return callbacks
+
+def measure_latency_ms(predict, x, runs=100, warmup=5):
+    """
+    Calls predict(x) warmup + runs times and returns the p50 / p95 of the timed runs in ms.
+    """
+    for _ in range(warmup):
+        predict(x)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        predict(x)
+        timings.append((time.perf_counter() - start) * 1000.0)
+    return {"p50": float(np.percentile(timings, 50)), "p95": float(np.percentile(timings, 95))}
+
+def save_coreml(model, class_labels, image_size, channels, coreml_model_path, compression="float16",
+                nbits=DEFAULT_PALETTE_BITS):
+    """
+    Converts a Keras key classifier to a Core ML classifier that yields
+    VNClassificationObservation in iOS and saves it as an .mlpackage, with its weights
+    compressed as described in coreml_compression.compress_coreml.
+    Returns the converted model before and after compression.
+    """
+    # Use a classifier config with textual labels => VNClassificationObservation
+    classifier_config = ct.ClassifierConfig(class_labels)
+
+    height = image_size[1]
+    width = image_size[0]
+    # The model expects (batch, height, width, channels) => shape=(1, h, w, channels)
+    color_layout = ct.colorlayout.GRAYSCALE if channels == 1 else ct.colorlayout.RGB
+    ml_input = ct.ImageType(shape=(1, height, width, channels), color_layout=color_layout)
+
+    with timed("export"):
+        coreml_model = ct.convert(
+            model,
+            inputs=[ml_input],
+            classifier_config=classifier_config,
+            source="tensorflow",
+            convert_to="mlprogram",  # or "neuralnetwork"
+            compute_precision=compute_precision(compression),
+            minimum_deployment_target=ct.target.iOS15
+        )
+        compressed_model = compress_coreml(coreml_model, compression, nbits)
+
+        os.makedirs(os.path.dirname(coreml_model_path), exist_ok=True)
+        compressed_model.save(coreml_model_path)
+    print(f"[INFO] Saved {compression} Core ML model to {coreml_model_path} ({path_size_mb(coreml_model_path):.2f} MB)")
+    return coreml_model, compressed_model
+
 class KeyClassifier:
     """
     A KeyClassifier that:
       1) Reads an annotation_file (array of dicts, each with 'filename' + possibly 'key_name').
       2) For each sample, loads the image from 'image_dir', optionally crops ROI, then uses
-         ImageDataGenerator to produce N augmented images.
-      3) Collects all augmented images + labels in self.X, self.y
+         a BatchAugmenter to produce N augmented images.
+      3) Collects all augmented images (uint8) + labels in self.X, self.y
+         (or, in streaming mode, keeps only the base crops and augments per batch)
       4) Builds & trains a CNN, then exports it to Core ML as a classifier with VNClassificationObservation.
 
     Args:
@@ -31,8 +330,35 @@ class KeyClassifier:
         image_size (tuple[int, int]): (width, height) for resizing each cropped image.
         aug_per_sample (int): How many new augmented images to generate per sample.
                               If 10, each original image yields 10 augmented copies.
+        dataset_stage (DatasetStage): Optional shared stage that already decoded and cropped
+                              every image. If None, gather_data() loads one for this key only.
+        seed (int): Seed for augmentation and shuffling, for reproducible datasets.
+        streaming (bool): If True, don't materialize the augmented dataset. Only the uint8
+                              base crops are kept and train() augments them per batch and
+                              per epoch. The validation split is held out by base image.
+        validation_split (float): Fraction of the data used for validation.
+        channels (int): 3 to train on gray-replicated BGR crops, 1 for single-channel crops
+                              (a third of the memory and first-conv work). Must match the stage.
+        from_model_path (str): Optional .h5 of a previous version's model for this key to
+                              fine-tune instead of training from scratch. Only the newest
+                              dataset version plus a replay sample of the older ones is used,
+                              and the validation split is held out by base image.
+        replay_fraction (float): Share of the older versions' frames (per label) replayed
+                              when fine-tuning, so the old data isn't forgotten.
+        resume (bool): Save the training state after every epoch and, if an earlier run of
+                              this key was interrupted, continue it instead of starting over.
+                              The seed is saved too, so the split, the samples and every
+                              epoch's batches are the same as in an uninterrupted run.
+        holdout_base_images (bool): Hold out whole base images for validation, e.g. so a
+                              student distilled from this model can be compared with it on
+                              images neither trained on. Defaults to the class attribute.
     """
 
+    # Subfolder of <output_model_path>/<version> the model is saved to
+    model_subdir = ""
+    # Always hold out whole base images for validation (and keep them in holdout_X / holdout_y)
+    holdout_base_images = False
+
     def __init__(
         self,
         dataset_dir,
@@ -41,150 +367,212 @@ class KeyClassifier:
         roi,
         output_model_path,
         image_size=(64, 32),
-        aug_per_sample=100
+        aug_per_sample=100,
+        dataset_stage=None,
+        seed=None,
+        streaming=False,
+        validation_split=0.2,
+        channels=3,
+        from_model_path=None,
+        replay_fraction=0.2,
+        resume=False,
+        holdout_base_images=None
     ):
         self.dataset_dir = dataset_dir
         self.dataset_version = dataset_version
         self.key_name = key_name
         self.roi = roi  # (x, y, w, h) in [0..1] 
-        self.output_model_path = os.path.join(output_model_path, dataset_version, key_name)
+        self.output_model_path = os.path.join(output_model_path, dataset_version, self.model_subdir, key_name)
         self.image_size = image_size  # (width, height)
         self.aug_per_sample = aug_per_sample
+        self.dataset_stage = dataset_stage
+        self.seed = seed
+        self.streaming = streaming
+        self.validation_split = validation_split
+        self.channels = channels
+        self.from_model_path = from_model_path
+        self.replay_fraction = replay_fraction
+        if holdout_base_images is not None:
+            self.holdout_base_images = holdout_base_images
+
+        # An interrupted run's seed is reused, so gather_data rebuilds the same data
+        self.resume = resume
+        self.resume_dir = self.output_model_path + ".resume"
+        self.resume_state = self._load_resume_state() if resume else None
+        if self.resume_state is not None:
+            self.seed = self.resume_state["seed"]
+        elif resume and self.seed is None:
+            self.seed = int(np.random.SeedSequence().entropy % (2 ** 32))
+
+        # Labels of the model being fine-tuned keep their output index
+        self.previous_class_labels = []
+        if from_model_path is not None:
+            with open(os.path.splitext(from_model_path)[0] + ".json", "r", encoding="utf-8") as f:
+                previous_sidecar = json.load(f)
+            if previous_sidecar.get("channels", 3) != channels or tuple(previous_sidecar["image_size"]) != tuple(image_size):
+                raise ValueError(f"{from_model_path} was trained on a different input shape than this classifier")
+            self.previous_class_labels = previous_sidecar["class_labels"]
 
         self.X = None
         self.y = None
+        self.base_X = None
+        self.base_y = None
+        self.train_idx = None
+        self.val_idx = None
+        self.holdout_X = None
+        self.holdout_y = None
+        self.holdout_ids = None  # '<version>/<filename>' of the held-out base images
+        self.base_ids = None
         self.model = None
 
+    def _load_resume_state(self):
+        """
+        Returns the state saved by ResumeCheckpoint for this key, or None if there is none.
+        """
+        state_path = os.path.join(self.resume_dir, RESUME_STATE_FILENAME)
+        if not os.path.isfile(state_path) or not os.path.isfile(os.path.join(self.resume_dir, RESUME_MODEL_FILENAME)):
+            return None
+        with open(state_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
     def gather_data(self):
         """
-        Reads annotation_file (JSON array). For each record:
-         - Load & optionally crop the image to self.roi.
+        Reads the base crops for self.key_name from the DatasetStage. For each record:
+         - The image was already loaded & cropped to self.roi by the stage.
          - Generate self.aug_per_sample augmented images from that single base image.
          - Label = record[self.key_name] if it exists, else "None".
-        Finally, shuffle & store in self.X and self.y.
-        """
+        Finally, shuffle & store in self.X (still uint8) and self.y.
 
-        # Prepare lists to hold X and y data
-        X_list = []
-        y_list = []
+        In streaming mode the augmentation is skipped here: the base crops are stored in
+        self.base_X / self.base_y and split into self.train_idx / self.val_idx by base image.
+        """
 
-        # Prepare a Keras ImageDataGenerator with your chosen augmentations
+        # Augmentations matching the old ImageDataGenerator settings,
         #    e.g. brightness, shifts, shear, zoom, no flips or rotations.
-        datagen = ImageDataGenerator(
-            width_shift_range=0.2,
-            height_shift_range=0.2,
-            brightness_range=[0.8, 1.3],
-            shear_range=0.1,
-            zoom_range=0.1,
-            fill_mode="nearest"
-        )
-
-        # A dictionary to map textual label -> index
-        label_to_idx = {}
-
-        # Get all image dirs and annotation files
-        def generate_version_list(version_str): # get all versions from this one back to v0
-            match = re.match(r'v(\d+)', version_str)
-            if match:
-                num = int(match.group(1))
-                return [f'v{i}' for i in range(num, -1, -1)]
-
-        versions = generate_version_list(self.dataset_version)
-        image_dirs = [os.path.join(self.dataset_dir, version) for version in versions]
-        
-        for image_dir in image_dirs:
-            # Load data labels
-            annotation_file = os.path.join(image_dir, "annotations.json")
-            with open(annotation_file, "r", encoding="utf-8") as f:
-                annotations = json.load(f)
-
-            for record in annotations:
-                filename = record.get("filename")
-                if not filename:
-                    continue  # skip if no filename
-                filepath = os.path.join(image_dir, filename)
-                if not os.path.isfile(filepath):
-                    continue  # skip if file doesn't exist
-
-                label = record[self.key_name] if self.key_name in record else "None"
-                if label not in label_to_idx:
-                    label_to_idx[label] = len(label_to_idx)
-                label_idx = label_to_idx[label]
-
-                # Load the image as color or grayscale (up to you)
-                # For demonstration, let's do color via PIL -> convert to NumPy
-                # If you prefer cv2, that's fine too.
-                img = cv2.imread(filepath)
+        augmenter = BatchAugmenter(seed=self.seed, **AUGMENTATION_PARAMS)
 
-                # Crop to ROI if desired
-                if self.roi != (0, 0, 1, 1):
-                    img_h, img_w = img.shape[:2]
-                    x_abs = int(self.roi[0] * img_w)
-                    y_abs = int(self.roi[1] * img_h)
-                    w_abs = int(self.roi[2] * img_w)
-                    h_abs = int(self.roi[3] * img_h)
-                    img = img[y_abs:y_abs + h_abs, x_abs:x_abs + w_abs]
+        # Base crops come from a shared DatasetStage so each image is only decoded once
+        # across all keys. Without one, load a stage for just this key.
+        stage = self.dataset_stage
+        if stage is None:
+            stage = DatasetStage(
+                self.dataset_dir,
+                self.dataset_version,
+                rois={self.key_name: self.roi},
+                image_size=self.image_size,
+                channels=self.channels
+            ).load()
+        elif stage.channels != self.channels:
+            raise ValueError(f"DatasetStage has {stage.channels} channels, but the classifier expects {self.channels}")
+        base_crops, labels = stage.samples(self.key_name)
+        self.base_ids = stage.sample_ids(self.key_name)
 
-                # Convert to grayscale
-                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        # A dictionary to map textual label -> index. When fine-tuning, the previous
+        # model's labels come first so its output units keep their meaning.
+        label_to_idx = {label: idx for idx, label in enumerate(self.previous_class_labels)}
+        for label in labels:
+            if label not in label_to_idx:
+                label_to_idx[label] = len(label_to_idx)
+        label_idxs = np.array([label_to_idx[label] for label in labels], dtype=np.int32)
 
-                # Normalize the grayscale image to range [0, 255]
-                normalized_gray = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX)
-
-                # Convert the normalized grayscale image back to a 3-channel color image
-                color_image = cv2.cvtColor(normalized_gray.astype(np.uint8), cv2.COLOR_GRAY2BGR)
+        self.class_labels = list(label_to_idx.keys())
 
-                # Resize the image
-                img_resized = cv2.resize(color_image, (self.image_size[0], self.image_size[1]), interpolation=cv2.INTER_CUBIC)
+        if self.from_model_path is not None:
+            rows = self._fine_tune_rows(stage.sample_versions(self.key_name), label_idxs, augmenter.rng)
+            base_crops = base_crops[rows]
+            label_idxs = label_idxs[rows]
+            self.base_ids = self.base_ids[rows]
 
-                # Convert to NumPy array and expand dimensions to shape (1, h, w, channels)
-                base_img = np.expand_dims(img_resized, axis=0)
+        if self.streaming:
+            # Keep only the base crops; hold out whole base images for validation so no
+            # augmented copy of a validation image is ever trained on
+            self.base_X = np.ascontiguousarray(base_crops, dtype=np.uint8)
+            self.base_y = label_idxs
+            self.train_idx, self.val_idx = self._split_base_images(len(self.base_X), augmenter.rng)
+            self.holdout_X, self.holdout_y = self.base_X[self.val_idx], self.base_y[self.val_idx]
+            self.holdout_ids = self.base_ids[self.val_idx]
+            return
 
-                # 5) Generate self.aug_per_sample augmented images
-                flow_iter = datagen.flow(base_img, batch_size=1)
-                for _ in range(self.aug_per_sample):
-                    aug_img = next(flow_iter)[0]  # shape: (h, w, channels)
-                    X_list.append(aug_img)
-                    y_list.append(label_idx)
+        # Generate self.aug_per_sample augmented images per base image, all in one batch
+        with timed("augment", key=self.key_name):
+            X = augmenter.augment(base_crops, self.aug_per_sample)
+        self.y = np.repeat(label_idxs, self.aug_per_sample)
+        base_rows = np.repeat(np.arange(len(base_crops)), self.aug_per_sample)
 
-        self.class_labels = list(label_to_idx.keys())
+        # Shuffle. The samples stay uint8 and are scaled to [0..1] per batch in train()
+        indices = augmenter.rng.permutation(len(X))
+        self.X = X[indices]
+        self.y = self.y[indices]
 
-        # Convert lists to arrays
-        self.X = np.array(X_list, dtype=np.float32)
-        self.y = np.array(y_list, dtype=np.int32)
+        if self.from_model_path is not None or self.holdout_base_images:
+            # Early stopping decides when fine-tuning is done, so it must see base images
+            # that none of the training samples were augmented from
+            _, val_base = self._split_base_images(len(base_crops), augmenter.rng)
+            is_val = np.isin(base_rows[indices], val_base)
+            self.train_idx = np.flatnonzero(~is_val)
+            self.val_idx = np.flatnonzero(is_val)
+            self.holdout_X, self.holdout_y = base_crops[val_base], label_idxs[val_base]
+            self.holdout_ids = self.base_ids[val_base]
 
-        # Shuffle
-        indices = np.random.permutation(len(self.X))
-        self.X = self.X[indices]
-        self.y = self.y[indices]
+    def _split_base_images(self, num_base, rng):
+        """
+        Randomly splits num_base base images into (train rows, validation rows), keeping
+        at least one of each. With fewer than two images there would be nothing to
+        validate on (and so no best checkpoint to save), which is an error.
+        """
+        if num_base < 2:
+            raise ValueError(
+                f"'{self.key_name}' has {num_base} base image(s), but at least 2 are needed to hold out "
+                f"whole base images for validation (streaming, fine-tuning and distillation do)"
+            )
+        order = rng.permutation(num_base)
+        num_val = min(max(int(round(num_base * self.validation_split)), 1), num_base - 1)
+        return np.sort(order[num_val:]), np.sort(order[:num_val])
 
-        # Scale pixel values to [0..1]
-        self.X /= 255.0
+    def _fine_tune_rows(self, versions, label_idxs, rng):
+        """
+        Rows to fine-tune on: every frame of the newest dataset version, plus
+        replay_fraction of the older frames of each label (at least one per label).
+        """
+        new_rows = np.flatnonzero(versions == self.dataset_version)
+        old_rows = np.flatnonzero(versions != self.dataset_version)
+        replay = []
+        for label_idx in np.unique(label_idxs[old_rows]):
+            label_rows = old_rows[label_idxs[old_rows] == label_idx]
+            num_replay = int(np.ceil(len(label_rows) * self.replay_fraction))
+            replay.append(rng.choice(label_rows, num_replay, replace=False))
+        replay = np.concatenate(replay) if replay else np.zeros(0, dtype=np.int64)
+        print(f"[INFO] Fine-tuning '{self.key_name}' on {len(new_rows)} new + {len(replay)} replayed frames")
+        return np.sort(np.concatenate([new_rows, replay]))
 
-    def build_model(self):
+    def build_model(self, filters=(32, 64), dense_units=128):
         """
-        Builds a small CNN that outputs len(self.class_labels) classes.
+        Builds a small CNN that outputs len(self.class_labels) classes: one
+        Conv2D(3x3) + MaxPooling2D block per entry of filters, then Dense(dense_units).
         We define an explicit Input layer to avoid the
         'do not pass input_shape to a layer' Keras warning.
+        When fine-tuning, the previous model is loaded instead (see _warm_start_model).
         """
         num_classes = len(self.class_labels)
+        if self.from_model_path is not None:
+            self.model = self._warm_start_model()
+            return
 
         # Keras expects (height, width, channels) for input_shape
         height = self.image_size[1]
         width = self.image_size[0]
-        input_shape = (height, width, 3)  # 3 channels for color
+        input_shape = (height, width, self.channels)
 
         # A simple CNN
+        blocks = []
+        for num_filters in filters:
+            blocks += [layers.Conv2D(num_filters, (3, 3), activation='relu'), layers.MaxPooling2D((2, 2))]
         self.model = models.Sequential([
             layers.Input(shape=input_shape),
-            layers.Conv2D(32, (3, 3), activation='relu'),
-            layers.MaxPooling2D((2, 2)),
-
-            layers.Conv2D(64, (3, 3), activation='relu'),
-            layers.MaxPooling2D((2, 2)),
+            *blocks,
 
             layers.Flatten(),
-            layers.Dense(128, activation='relu'),
+            layers.Dense(dense_units, activation='relu'),
             layers.Dense(num_classes, activation='softmax')
         ])
         self.model.compile(
@@ -193,14 +581,59 @@ class KeyClassifier:
             metrics=['accuracy']
         )
 
-    def train(self, epochs=10, batch_size=32):
+    def _warm_start_model(self):
+        """
+        Loads the previous version's model and, if labels were added since, widens its
+        softmax head: the old classes keep their weights, the new ones start from small
+        random weights with the lowest old bias. Compiled with a lower learning rate.
+        """
+        previous = models.load_model(self.from_model_path)
+        kernel, bias = previous.layers[-1].get_weights()
+        num_new = len(self.class_labels) - kernel.shape[1]
+        if num_new > 0:
+            print(f"[INFO] Adding {num_new} new label(s) to '{self.key_name}': {self.class_labels[-num_new:]}")
+            rng = np.random.default_rng(self.seed)
+            kernel = np.concatenate([kernel, rng.normal(0.0, 0.01, (kernel.shape[0], num_new)).astype(kernel.dtype)], axis=1)
+            bias = np.concatenate([bias, np.full(num_new, bias.min(), dtype=bias.dtype)])
+
+        head = layers.Dense(len(self.class_labels), activation='softmax', name="softmax_head")
+        model = models.Sequential([layers.Input(shape=previous.input_shape[1:]), *previous.layers[:-1], head])
+        head.set_weights([kernel, bias])
+        model.compile(
+            optimizer=Adam(learning_rate=FINE_TUNE_LEARNING_RATE),
+            loss='sparse_categorical_crossentropy',
+            metrics=['accuracy']
+        )
+        return model
+
+    def train(
+        self,
+        epochs=10,
+        batch_size=32,
+        early_stopping_patience=None,
+        reduce_lr_patience=None,
+        reduce_lr_factor=0.5,
+        min_learning_rate=1e-6
+    ):
         """
         Trains the model on all augmented data in self.X/self.y.
-        Uses validation_split=0.2 (20% of data).
-        Saves the best checkpoint (by val_loss) to an .h5 file.
-        Also saves a sidecar JSON with class labels, image size, etc.
+        Uses validation_split=0.2 (20% of data), or the base-image split when fine-tuning.
+        In streaming mode, batches are augmented on the fly from the base crops instead.
+        Saves the best checkpoint (by val_loss) to an .h5 file. With early_stopping_patience,
+        training stops once val_loss hasn't improved for that many epochs; with
+        reduce_lr_patience, the learning rate is multiplied by reduce_lr_factor (down to
+        min_learning_rate) whenever val_loss hasn't improved for that many epochs.
+
+        With resume, the state is saved after every epoch and an interrupted run continues
+        from its last finished epoch. Batch order and streaming augmentation are drawn from
+        (seed, epoch), so the resumed epochs get the batches an uninterrupted run would have
+        (only the early-stopping patience starts counting again).
+        The state is deleted once training completes.
+        Also saves a sidecar JSON with class labels, image size, etc., and the weights as
+        an .npz for the TensorFlow-free NumPy inference backend.
         """
-        if self.X is None or self.y is None or self.model is None:
+        has_data = self.base_X is not None if self.streaming else (self.X is not None and self.y is not None)
+        if not has_data or self.model is None:
             raise RuntimeError("Must call gather_data() and build_model() before train().")
         
         # 1) Prepare output paths
@@ -212,68 +645,512 @@ class KeyClassifier:
 
         os.makedirs(os.path.dirname(h5_model_path), exist_ok=True)
 
-        # 2) Define a ModelCheckpoint callback that saves only the best model
+        # Continue an interrupted run of the same model
+        initial_epoch = 0
+        best_val_loss = None
+        state = self.resume_state
+        if state is not None and state["class_labels"] == self.class_labels:
+            self.model = models.load_model(os.path.join(self.resume_dir, RESUME_MODEL_FILENAME))
+            initial_epoch = state["epoch"]
+            best_val_loss = state["best_val_loss"]
+            print(f"[INFO] Resuming '{self.key_name}' after epoch {initial_epoch}/{epochs}")
+        elif state is not None:
+            print(f"[WARN] Ignoring saved state of '{self.key_name}': its class labels don't match")
+
+        # 2) Define a ModelCheckpoint callback that saves only the best model.
+        #    A resumed run only overwrites it with something better than what it had
         checkpoint_cb = ModelCheckpoint(
             filepath=h5_model_path,
             monitor="val_loss",
             mode="min",            # 'val_loss' is best when lower, so we use 'min'
             save_best_only=True,
+            initial_value_threshold=best_val_loss,
             verbose=1
         )
+        callbacks = [checkpoint_cb] + plateau_callbacks(
+            early_stopping_patience, reduce_lr_patience, reduce_lr_factor, min_learning_rate
+        )
+        if self.resume:
+            callbacks.append(ResumeCheckpoint(self.resume_dir, self.seed, self.class_labels, checkpoint_cb))
 
         # 3) Train the model
-        self.model.fit(
-            self.X, self.y,
-            epochs=epochs,
-            batch_size=batch_size,
-            validation_split=0.2,
-            verbose=1,
-            callbacks=[checkpoint_cb]
-        )
+        if self.streaming:
+            train_seq = AugmentedSequence(
+                self.base_X[self.train_idx], self.base_y[self.train_idx],
+                self.aug_per_sample, batch_size, seed=self.seed, initial_epoch=initial_epoch
+            )
+            val_seq = AugmentedSequence(
+                self.base_X[self.val_idx], self.base_y[self.val_idx],
+                self.aug_per_sample, batch_size, seed=self.seed, fixed=True
+            )
+        elif self.train_idx is not None:
+            # Base-image split made by gather_data (fine-tuning, held-out base images)
+            train_seq = ArraySequence(
+                self.X, self.y, self.train_idx, batch_size, shuffle=True, seed=self.seed, initial_epoch=initial_epoch
+            )
+            val_seq = ArraySequence(self.X, self.y, self.val_idx, batch_size)
+        else:
+            train_seq, val_seq = split_sequences(
+                self.X, self.y, batch_size, self.validation_split, seed=self.seed, initial_epoch=initial_epoch
+            )
+        train_seq, val_seq = self._wrap_sequences(train_seq, val_seq)
+        with timed("fit", key=self.key_name):
+            # The sequences shuffle themselves, reproducibly; Keras' own batch shuffling isn't seeded
+            self.model.fit(
+                train_seq,
+                epochs=epochs,
+                initial_epoch=initial_epoch,
+                shuffle=False,
+                validation_data=val_seq,
+                verbose=1,
+                callbacks=callbacks
+            )
 
-        # 4) Load the best model weights
+        # 4) Load the best model weights. Training is complete, so the resume state goes
         self.model = models.load_model(h5_model_path)
+        shutil.rmtree(self.resume_dir, ignore_errors=True)
+        self.resume_state = None
 
         # 5) Write sidecar JSON with relevant metadata for future reference
         #    You can add or remove any fields you deem useful.
         sidecar_data = {
             "class_labels": self.class_labels,
             "image_size": self.image_size,
+            "channels": self.channels,
             "roi": self.roi,                 # If you used an ROI for cropping
-            "key_name": self.key_name        # So you know what this model is for
+            "key_name": self.key_name,       # So you know what this model is for
+            # Epoch an interrupted run continued from (None if it ran in one go)
+            "resumed_from_epoch": initial_epoch or None,
+            # Base images ('<version>/<filename>') held out from training, None if every
+            # base image had augmented copies in the training set
+            "holdout_images": sorted(self.holdout_ids.tolist()) if self.holdout_ids is not None else None
             # Add any other info you'd like
         }
         with open(sidecar_path, "w", encoding="utf-8") as f:
             json.dump(sidecar_data, f, indent=2)
 
+        # 6) Export the weights for the NumPy backend
+        export_npz(self.model, self.output_model_path + ".npz")
+
         print(f"[INFO] Best model saved to {h5_model_path}")
         print(f"[INFO] Sidecar metadata saved to {sidecar_path}")
 
-    def export_coreml(self):
+    def _wrap_sequences(self, train_seq, val_seq):
+        """
+        Hook for subclasses to change what train() feeds the model.
+        """
+        return train_seq, val_seq
+
+    def export_coreml(self, compression="float16", nbits=DEFAULT_PALETTE_BITS):
         """
         Converts the trained Keras model to a Core ML classifier
         that yields VNClassificationObservation in iOS.
+        compression is one of coreml_compression.COMPRESSIONS.
+        Returns the Core ML model before and after compression.
         """
         if self.model is None:
             raise RuntimeError("No trained model to export. Call train() first.")
+        return save_coreml(
+            self.model, self.class_labels, self.image_size, self.channels,
+            self.output_model_path + ".mlpackage", compression, nbits
+        )
+
+class StudentKeyClassifier(KeyClassifier):
+    """
+    Distills a trained key model (the teacher) into a much smaller network: one small
+    conv, two separable convolutions and global average pooling instead of the teacher's
+    Flatten -> Dense(128), which holds most of its parameters and compute. The student
+    learns from the teacher's softened probabilities mixed with the real labels, keeps
+    the teacher's label order and is saved as <version>/student/<key>.*, so it can
+    replace the teacher one to one.
+
+    Whole base images are held out for validation and for report(). If the teacher held
+    out base images too (its sidecar lists them), the student holds out the same ones, so
+    report() compares both on images neither trained on.
+
+    Args:
+        teacher_model_path (str): The teacher's .h5 (with its .json sidecar next to it).
+        temperature (float): Softmax temperature applied to the teacher's probabilities.
+        alpha (float): Weight of the teacher's targets against the one-hot labels.
+        **kwargs: The KeyClassifier arguments (except from_model_path).
+    """
+
+    model_subdir = STUDENT_DIR
+    holdout_base_images = True
+
+    def __init__(self, teacher_model_path, temperature=DISTILL_TEMPERATURE, alpha=DISTILL_ALPHA, **kwargs):
+        super().__init__(**kwargs)
+        with open(os.path.splitext(teacher_model_path)[0] + ".json", "r", encoding="utf-8") as f:
+            teacher_sidecar = json.load(f)
+        if teacher_sidecar.get("channels", 3) != self.channels or tuple(teacher_sidecar["image_size"]) != tuple(self.image_size):
+            raise ValueError(f"{teacher_model_path} was trained on a different input shape than this classifier")
+
+        self.teacher_model_path = teacher_model_path
+        self.teacher = models.load_model(teacher_model_path)
+        self.temperature = temperature
+        self.alpha = alpha
+
+        # The student's outputs line up with the teacher's
+        self.previous_class_labels = list(teacher_sidecar["class_labels"])
+        teacher_holdout = teacher_sidecar.get("holdout_images")
+        self.teacher_holdout = set(teacher_holdout) if teacher_holdout is not None else None
+        self.holdout_is_teacher_holdout = False
+
+    def gather_data(self):
+        super().gather_data()
+        unknown = self.class_labels[len(self.previous_class_labels):]
+        if unknown:
+            raise ValueError(f"Labels {unknown} of '{self.key_name}' are unknown to the teacher {self.teacher_model_path}")
+
+    def _split_base_images(self, num_base, rng):
+        """
+        Holds out the teacher's held-out base images, where they leave images on both
+        sides; otherwise splits like KeyClassifier and report() can't score the teacher.
+        """
+        if self.teacher_holdout is not None:
+            is_val = np.isin(self.base_ids, list(self.teacher_holdout))
+            if 0 < is_val.sum() < num_base:
+                self.holdout_is_teacher_holdout = True
+                return np.flatnonzero(~is_val), np.flatnonzero(is_val)
+            print(f"[WARN] The teacher's held-out images of '{self.key_name}' aren't in this dataset, splitting anew")
+        self.holdout_is_teacher_holdout = False
+        return super()._split_base_images(num_base, rng)
+
+    def build_model(self):
+        """
+        Builds the student CNN: under 1% of the teacher's parameters for 64x32 crops.
+        """
+        num_classes = len(self.class_labels)
+        height = self.image_size[1]
+        width = self.image_size[0]
+        input_shape = (height, width, self.channels)
 
-        # Use a classifier config with textual labels => VNClassificationObservation
-        classifier_config = ct.ClassifierConfig(self.class_labels)
+        self.model = models.Sequential([
+            layers.Input(shape=input_shape),
+            layers.Conv2D(16, (3, 3), activation='relu'),
+            layers.MaxPooling2D((2, 2)),
+
+            layers.SeparableConv2D(32, (3, 3), activation='relu'),
+            layers.MaxPooling2D((2, 2)),
+
+            layers.SeparableConv2D(64, (3, 3), activation='relu'),
+            layers.GlobalAveragePooling2D(),
+            layers.Dense(num_classes, activation='softmax')
+        ])
+        self.model.compile(
+            optimizer='adam',
+            loss='categorical_crossentropy',  # the targets are distributions, not indices
+            metrics=['accuracy']
+        )
+
+    def _wrap_sequences(self, train_seq, val_seq):
+        num_classes = len(self.class_labels)
+        return (
+            DistillationSequence(train_seq, num_classes, self.teacher, self.temperature, self.alpha),
+            DistillationSequence(val_seq, num_classes)
+        )
+
+    def train(self, *args, **kwargs):
+        super().train(*args, **kwargs)
+
+        # Record where the student came from
+        sidecar_path = self.output_model_path + ".json"
+        with open(sidecar_path, "r", encoding="utf-8") as f:
+            sidecar_data = json.load(f)
+        sidecar_data["teacher"] = self.teacher_model_path
+        with open(sidecar_path, "w", encoding="utf-8") as f:
+            json.dump(sidecar_data, f, indent=2)
+
+    def export_coreml(self, compression="float16", nbits=DEFAULT_PALETTE_BITS):
+        """
+        Exports the student, and the teacher too if it has no .mlpackage yet, so report()
+        can compare both.
+        """
+        coreml_models = super().export_coreml(compression, nbits)
+        teacher_coreml_path = os.path.splitext(self.teacher_model_path)[0] + ".mlpackage"
+        if not os.path.exists(teacher_coreml_path):
+            save_coreml(self.teacher, self.class_labels, self.image_size, self.channels, teacher_coreml_path, compression, nbits)
+        return coreml_models
+
+    def report(self, latency_runs=100):
+        """
+        Compares teacher and student: parameter count, .mlpackage size, batch-1 CPU latency
+        with TensorFlow and with the NumPy backend, and accuracy on the held-out base images
+        (unaugmented). The teacher is only scored if those are its own held-out images;
+        a teacher that trained on them would look better than it is. Writes
+        <key>.report.json next to the student.
+        """
+        X = self.holdout_X.astype(np.float32) / 255.0
+        y = self.holdout_y
+        single = np.zeros((1, self.image_size[1], self.image_size[0], self.channels), dtype=np.float32)
 
+        report = {
+            "key_name": self.key_name,
+            "holdout_images": int(len(y)),
+            "teacher_held_out": self.holdout_is_teacher_holdout
+        }
+        predictions = {}
+        for name, model, base_path in (
+            ("teacher", self.teacher, os.path.splitext(self.teacher_model_path)[0]),
+            ("student", self.model, self.output_model_path)
+        ):
+            numpy_model = NumpyModel.load(base_path + ".h5")
+            predictions[name] = model.predict(X, batch_size=256, verbose=0).argmax(axis=1) if len(y) else y
+            report[name] = {
+                "model_path": base_path + ".h5",
+                "params": int(model.count_params()),
+                "mlpackage_mb": path_size_mb(base_path + ".mlpackage"),
+                "keras_latency_ms": measure_latency_ms(lambda x: model(x, training=False), single, latency_runs),
+                "numpy_latency_ms": measure_latency_ms(numpy_model, single, latency_runs),
+                "accuracy": float(np.mean(predictions[name] == y)) if len(y) else None
+            }
+        if not self.holdout_is_teacher_holdout:
+            print(f"[WARN] The teacher of '{self.key_name}' didn't hold out these images, so its accuracy isn't reported "
+                  f"(train it with --distill to compare both on the same held-out images)")
+            report["teacher"]["accuracy"] = None
+        report["agreement"] = float(np.mean(predictions["teacher"] == predictions["student"])) if len(y) else None
+
+        report_path = self.output_model_path + ".report.json"
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+        teacher, student = report["teacher"], report["student"]
+        print(f"[INFO] '{self.key_name}' student vs teacher: {student['params']} vs {teacher['params']} params, "
+              f"{student['keras_latency_ms']['p50']:.2f} vs {teacher['keras_latency_ms']['p50']:.2f} ms, "
+              f"accuracy {student['accuracy']} vs {teacher['accuracy']} ({report_path})")
+        return report
+
+def safe_name(key_name):
+    """
+    Turns a key like 'hla-direction' into a name usable for Keras layers and Core ML features.
+    """
+    return key_name.replace("-", "_")
+
+class MultiKeyClassifier:
+    """
+    Trains a single network covering several keys at once: one crop input per key, a
+    shared conv backbone applied to every crop, and a softmax head per key. It exports
+    as one Core ML model with one probability output per key, so a frame needs a single
+    model load and a single forward pass instead of one per key.
+
+    Args:
+        dataset_dir (str): Root folder holding the v0..vN dataset versions.
+        dataset_version (str): Newest dataset version to train on.
+        rois (dict): { key_name: (x, y, w, h) } in [0..1] for every key.
+        output_model_path (str): Where to save the model (as <version>/multi-head.*).
+        image_size (tuple[int, int]): (width, height) for resizing each cropped image.
+        aug_per_sample (int): How many augmented copies to generate per sample.
+        dataset_stage (DatasetStage): Optional shared stage holding every key's crops.
+        seed (int): Seed for augmentation and shuffling.
+        channels (int): 3 for gray-replicated BGR crops, 1 for single-channel crops.
+    """
+
+    def __init__(
+        self,
+        dataset_dir,
+        dataset_version,
+        rois,
+        output_model_path,
+        image_size=(64, 32),
+        aug_per_sample=100,
+        dataset_stage=None,
+        seed=None,
+        channels=3
+    ):
+        self.dataset_dir = dataset_dir
+        self.dataset_version = dataset_version
+        self.rois = dict(rois)
+        self.key_names = sorted(self.rois)
+        self.output_model_path = os.path.join(output_model_path, dataset_version, MULTI_HEAD_NAME)
+        self.image_size = image_size  # (width, height)
+        self.aug_per_sample = aug_per_sample
+        self.dataset_stage = dataset_stage
+        self.seed = seed
+        self.channels = channels
+
+        self.X = None  # { input name: uint8 array }
+        self.y = None  # { output name: int32 array }
+        self.class_labels = {}  # key_name -> list of labels
+        self.model = None
+
+    def gather_data(self):
+        """
+        Same as KeyClassifier.gather_data, but for every key at once. Sample i of every
+        key comes from the same source image, so the per-key arrays stay aligned.
+        """
+        augmenter = BatchAugmenter(seed=self.seed, **AUGMENTATION_PARAMS)
+
+        stage = self.dataset_stage
+        if stage is None:
+            stage = DatasetStage(
+                self.dataset_dir,
+                self.dataset_version,
+                rois=self.rois,
+                image_size=self.image_size,
+                channels=self.channels
+            ).load()
+        elif stage.channels != self.channels:
+            raise ValueError(f"DatasetStage has {stage.channels} channels, but the classifier expects {self.channels}")
+
+        self.X = {}
+        self.y = {}
+        indices = None
+        for key_name in self.key_names:
+            base_crops, labels = stage.samples(key_name)
+
+            label_to_idx = {}
+            for label in labels:
+                if label not in label_to_idx:
+                    label_to_idx[label] = len(label_to_idx)
+            label_idxs = np.array([label_to_idx[label] for label in labels], dtype=np.int32)
+            self.class_labels[key_name] = list(label_to_idx.keys())
+
+            # Every key's crop gets its own random transforms
+            with timed("augment", key=key_name):
+                X = augmenter.augment(base_crops, self.aug_per_sample)
+            if indices is None:
+                indices = augmenter.rng.permutation(len(X))
+
+            # Shuffle all keys with the same permutation (scaled to [0..1] per batch in train())
+            self.X[safe_name(key_name) + "_input"] = X[indices]
+            self.y[safe_name(key_name)] = np.repeat(label_idxs, self.aug_per_sample)[indices]
+
+    def build_model(self):
+        """
+        Shared backbone (same layers as KeyClassifier's CNN up to Dense(128)) applied to
+        every key's crop, followed by a softmax head per key.
+        """
         height = self.image_size[1]
         width = self.image_size[0]
-        # The model expects (batch, height, width, channels) => shape=(1, h, w, 3)
-        ml_input = ct.ImageType(shape=(1, height, width, 3))
+        input_shape = (height, width, self.channels)
 
-        coreml_model = ct.convert(
-            self.model,
-            inputs=[ml_input],
-            classifier_config=classifier_config,
-            source="tensorflow",
-            convert_to="mlprogram",  # or "neuralnetwork"
-            minimum_deployment_target=ct.target.iOS15
+        backbone = models.Sequential([
+            layers.Input(shape=input_shape),
+            layers.Conv2D(32, (3, 3), activation='relu'),
+            layers.MaxPooling2D((2, 2)),
+
+            layers.Conv2D(64, (3, 3), activation='relu'),
+            layers.MaxPooling2D((2, 2)),
+
+            layers.Flatten(),
+            layers.Dense(128, activation='relu')
+        ], name="backbone")
+
+        inputs = []
+        outputs = []
+        for key_name in self.key_names:
+            key_input = layers.Input(shape=input_shape, name=safe_name(key_name) + "_input")
+            features = backbone(key_input)
+            head = layers.Dense(len(self.class_labels[key_name]), activation='softmax', name=safe_name(key_name))
+            inputs.append(key_input)
+            outputs.append(head(features))
+
+        self.model = models.Model(inputs=inputs, outputs=outputs, name="multi_head")
+        self.model.compile(
+            optimizer='adam',
+            loss={safe_name(key_name): 'sparse_categorical_crossentropy' for key_name in self.key_names},
+            metrics=['accuracy']
+        )
+
+    def train(
+        self,
+        epochs=10,
+        batch_size=32,
+        early_stopping_patience=None,
+        reduce_lr_patience=None,
+        reduce_lr_factor=0.5,
+        min_learning_rate=1e-6
+    ):
+        """
+        Trains all heads together, keeps the best checkpoint (by total val_loss) and
+        writes a sidecar JSON describing every key's input, output and class labels.
+        Early stopping and the learning rate schedule work as in KeyClassifier.train.
+        """
+        if self.X is None or self.y is None or self.model is None:
+            raise RuntimeError("Must call gather_data() and build_model() before train().")
+
+        h5_model_path = self.output_model_path + ".h5"
+        sidecar_path = self.output_model_path + ".json"
+        os.makedirs(os.path.dirname(h5_model_path), exist_ok=True)
+
+        checkpoint_cb = ModelCheckpoint(
+            filepath=h5_model_path,
+            monitor="val_loss",
+            mode="min",
+            save_best_only=True,
+            verbose=1
+        )
+
+        callbacks = [checkpoint_cb] + plateau_callbacks(
+            early_stopping_patience, reduce_lr_patience, reduce_lr_factor, min_learning_rate
         )
 
+        train_seq, val_seq = split_sequences(self.X, self.y, batch_size, 0.2, seed=self.seed)
+        with timed("fit", key=MULTI_HEAD_NAME):
+            self.model.fit(
+                train_seq,
+                epochs=epochs,
+                shuffle=False,
+                validation_data=val_seq,
+                verbose=1,
+                callbacks=callbacks
+            )
+
+        self.model = models.load_model(h5_model_path)
+
+        sidecar_data = {
+            "multi_head": True,
+            "image_size": self.image_size,
+            "channels": self.channels,
+            "keys": {
+                key_name: {
+                    "class_labels": self.class_labels[key_name],
+                    "roi": self.rois[key_name],
+                    "input": safe_name(key_name) + "_input",
+                    "output": safe_name(key_name)
+                }
+                for key_name in self.key_names
+            }
+        }
+        with open(sidecar_path, "w", encoding="utf-8") as f:
+            json.dump(sidecar_data, f, indent=2)
+
+        print(f"[INFO] Best model saved to {h5_model_path}")
+        print(f"[INFO] Sidecar metadata saved to {sidecar_path}")
+
+    def export_coreml(self):
+        """
+        Converts the multi-head model to one Core ML model with an image input and a
+        probability output per key. Core ML's ClassifierConfig only supports a single
+        classifier output, so each output's class labels are stored in the model's
+        metadata as '<key>.class_labels' (comma separated, in output index order).
+        """
+        if self.model is None:
+            raise RuntimeError("No trained model to export. Call train() first.")
+
+        height = self.image_size[1]
+        width = self.image_size[0]
+        color_layout = ct.colorlayout.GRAYSCALE if self.channels == 1 else ct.colorlayout.RGB
+        ml_inputs = [
+            ct.ImageType(name=safe_name(key_name) + "_input", shape=(1, height, width, self.channels),
+                         color_layout=color_layout)
+            for key_name in self.key_names
+        ]
+        ml_outputs = [ct.TensorType(name=safe_name(key_name)) for key_name in self.key_names]
+
+        with timed("export", key=MULTI_HEAD_NAME):
+            coreml_model = ct.convert(
+                self.model,
+                inputs=ml_inputs,
+                outputs=ml_outputs,
+                source="tensorflow",
+                convert_to="mlprogram",
+                minimum_deployment_target=ct.target.iOS15
+            )
+        for key_name in self.key_names:
+            coreml_model.user_defined_metadata[f"{key_name}.class_labels"] = ",".join(self.class_labels[key_name])
+            coreml_model.user_defined_metadata[f"{key_name}.output"] = safe_name(key_name)
+
         coreml_model_path = self.output_model_path + ".mlpackage"
         os.makedirs(os.path.dirname(coreml_model_path), exist_ok=True)
         coreml_model.save(coreml_model_path)